@@ -27,9 +27,10 @@
 from osgeo import gdal
 from osgeo.gdalconst import *
 from osgeo import ogr
-from collections import Counter
 import math
+import os
 import numpy
+from numpy.lib.stride_tricks import sliding_window_view
 from osgeo import osr
 # from rasterstats import zonal_stats
 
@@ -38,28 +39,42 @@ import processing
 from qgis.core import *
 
 from tbk_qgis.tbk.utility.tbk_utilities import *
+from tbk_qgis.tbk.utility.zonal_statistics import zonal_statistics
 
 
 class ClassificationHelper:
 
     ################################################
-    # getSortedList
+    # getSeedOrder
+    #
+    # Returns the flat index of all pixels with a value > 0, sorted by value
+    # (biggest value first). Pixels with the same value are sorted by descending
+    # row and col (same order as sorting [value, row, col] lists in reverse).
     @staticmethod
-    def getSortedList(data, count):
-        rows = data.shape[0]
-        cols = data.shape[1]
-        dataList = list()
-        for y in range(rows):
-            for x in range(cols):
-                if (data[y, x] > 0):
-                    dataList.append([data[y, x], y, x])
-        dataList.sort(reverse=True)
-        return dataList[:count]
+    def getSeedOrder(data):
+        data_flat = numpy.ascontiguousarray(data).ravel()
+        index_type = numpy.int32 if data_flat.size < 2 ** 31 else numpy.int64
+        m_seeds = data_flat > 0
+        seeds = numpy.flatnonzero(m_seeds).astype(index_type)
+        values = data_flat[m_seeds]
+        del m_seeds
+        # integer heights (e.g. Byte VHM) are sorted as 16 bit keys, which allows a linear time (radix) sort
+        if values.size > 0 and values.max() < 2 ** 16 and numpy.all(numpy.floor(values) == values):
+            values = values.astype(numpy.uint16)
+        # stable sort keeps ascending flat index for equal values -> reversed for descending order
+        order = numpy.argsort(values, kind='stable')
+        del values
+        return seeds[order[::-1]]
 
     ################################################
     # getWindowSize
+    #
+    # scale: pixel size relative to the VHM the window sizes are made for
+    # (e.g. 2 for a VHM downsampled by a factor of 2 -> half the window width).
     @staticmethod
-    def getWindowSize(value):
+    def getWindowSize(value, scale=1):
+        if scale != 1:
+            value = value / (scale * scale)
         if value < 0:
             value = 0
         pixelsTmp = math.sqrt(value)
@@ -75,6 +90,22 @@ class ClassificationHelper:
             pixels = int(3)
         return pixels
 
+    ################################################
+    # getWindowSizes
+    #
+    # Same as getWindowSize, but for an array of values.
+    @staticmethod
+    def getWindowSizes(values, scale=1):
+        if scale != 1:
+            values = values / (scale * scale)
+        pixelsTmp = numpy.sqrt(numpy.maximum(values, 0))
+        pixels = numpy.rint(pixelsTmp)
+        m_even = pixels % 2 == 0
+        m_up = pixelsTmp - pixels > 0
+        pixels[m_even & m_up] += 1
+        pixels[m_even & ~m_up] -= 1
+        return numpy.maximum(pixels, 3).astype(int)
+
     ################################################
     # Create polygons (ESRI Shapefile) from classified
     # raster.
@@ -104,36 +135,74 @@ class ClassificationHelper:
         gdal.Polygonize(band, mask_band, dst_layer, dst_field, callback=None)
         print("File %s saved" % output_file)
 
+    ################################################
+    # Create stand polygons with all stand attributes
+    #
+    # Polygonizes the classified raster into an in-memory GeoPackage, adds
+    # the stand attributes and VHM stats there and writes the output file
+    # (with its spatial index) once.
+    @staticmethod
+    def polygonize_stands(raster_file, output_file, stand_list, remainder_stand_id, vhm=None):
+        tmp_file = "/vsimem/" + os.path.basename(output_file)
+        try:
+            ClassificationHelper.polygonize(raster_file, tmp_file)
+            ClassificationHelper.add_stand_attributes(tmp_file, stand_list, remainder_stand_id, vhm)
+            ds_out = gdal.VectorTranslate(output_file, tmp_file, format="GPKG",
+                                          layerCreationOptions=["SPATIAL_INDEX=YES"])
+            ds_out = None
+        finally:
+            gdal.Unlink(tmp_file)
+        print("File %s saved" % output_file)
+
     ################################################
     # Add stand attributes to polygon shapefile
     @staticmethod
-    def add_stand_attributes(vector_file_path, stand_list, remainder_stand_id):
+    def add_stand_attributes(vector_file_path, stand_list, remainder_stand_id, vhm=None):
         # open stand polygon file
         dataSource = gdal.OpenEx(vector_file_path, 1)
         layer = dataSource.GetLayer()
 
+        # get max VHM value and 80 percentile per polygon
+        if vhm is not None:
+            vhm_max, vhm_p80 = ClassificationHelper.get_polygon_vhm_stats(dataSource, layer, vhm)
+
         # add stand attribute fields
         layer.CreateField(ogr.FieldDefn('OBJECTID', ogr.OFTInteger))
         layer.CreateField(ogr.FieldDefn('hmax', ogr.OFTInteger))
         layer.CreateField(ogr.FieldDefn('hdom', ogr.OFTInteger))
         layer.CreateField(ogr.FieldDefn('type', ogr.OFTString))
         layer.CreateField(ogr.FieldDefn('area_m2', ogr.OFTInteger64))
+        if vhm is not None:
+            layer.CreateField(ogr.FieldDefn('hmax_eff', ogr.OFTInteger))
+            layer.CreateField(ogr.FieldDefn('hp80', ogr.OFTInteger))
+
+        # stand attributes by stand ID (constant time lookup per polygon)
+        hmax_by_id, hdom_by_id = ClassificationHelper.getStandAttributesById(stand_list)
 
-        # iterate over all features and add stand attribute values
+        # iterate over all features and add stand attribute values (in one transaction)
+        dataSource.StartTransaction()
         new_id_counter = 0
         objectid_counter = 0
+        layer.ResetReading()
         for feature in layer:
             # get current stand ID
             current_id = feature.GetField("ID")
             objectid_counter += 1
+            is_listed = 0 <= current_id < len(hmax_by_id)
 
             # set stand attributes
             feature.SetField('OBJECTID', objectid_counter)
-            feature.SetField('hmax', round(ClassificationHelper.getHmaxByStandId(stand_list, current_id)))
-            feature.SetField('hdom', round(ClassificationHelper.getHdomByStandId(stand_list, current_id)))
+            feature.SetField('hmax', round(float(hmax_by_id[current_id])) if is_listed else 0)
+            feature.SetField('hdom', round(float(hdom_by_id[current_id])) if is_listed else 0)
             feature.SetField('type', ClassificationHelper.getStandType(current_id, remainder_stand_id))
             feature.SetField("area_m2", feature.GetGeometryRef().GetArea())
 
+            # set hmax effective and 80th percentile (0 for polygons without valid VHM cells)
+            if vhm is not None:
+                fid = feature.GetFID()
+                feature.SetField('hmax_eff', float(vhm_max[fid]) if fid < len(vhm_max) and not numpy.isnan(vhm_max[fid]) else 0)
+                feature.SetField('hp80', float(vhm_p80[fid]) if fid < len(vhm_p80) and not numpy.isnan(vhm_p80[fid]) else 0)
+
             # assign new, unique stand ID for remainders
             if ClassificationHelper.isRemainder(feature.GetField("type")):
                 feature.SetField('ID', remainder_stand_id + new_id_counter)
@@ -141,6 +210,7 @@ class ClassificationHelper:
 
             # store information
             layer.SetFeature(feature)
+        dataSource.CommitTransaction()
 
         try:
             # this threw errors in specific QGIS versions (e.g. QGIS 3.28.4
@@ -150,78 +220,33 @@ class ClassificationHelper:
             print(f"Closing dataSource >> {dataSource} << failed with exception (origin: \n {vector_file_path}")
 
     ################################################
-    # Add hmax effective and 80th percentile (zonal stats)
-    @staticmethod
-    def add_vhm_stats(vector_file_path, vhm):
-        # get max VHM value and 80 percentile per polygon
-        vectorfile_path_stat_path = vector_file_path.replace(".gpkg", "_stat.gpkg")
-        param = {'map': vector_file_path, 'raster': vhm, 'column_prefix': 'rs', 'method': [2, 12], 'percentile': 80,
-                 'output': vectorfile_path_stat_path, 'GRASS_REGION_PARAMETER': None,
-                 'GRASS_REGION_CELLSIZE_PARAMETER': 0, 'GRASS_SNAP_TOLERANCE_PARAMETER': -1,
-                 'GRASS_MIN_AREA_PARAMETER': 0.0001, 'GRASS_OUTPUT_TYPE_PARAMETER': 0, 'GRASS_VECTOR_DSCO': '',
-                 'GRASS_VECTOR_LCO': '', 'GRASS_VECTOR_EXPORT_NOCAT': False}
-        algoOutput = processing.run("grass7:v.rast.stats", param)
-
-        statLayer = QgsVectorLayer(vectorfile_path_stat_path, 'stats', 'ogr')
-        stats = {}
-        counter = 0
-        for feature in statLayer.getFeatures():
-            stats[feature["OBJECTID"]] = {"max": feature["rs_maximum"], "percentile_80": feature["rs_percentile_80"]}
-            counter += 1
-
-        # print(stats)
-
-        # open stand polygon file
-        dataSource = gdal.OpenEx(vector_file_path, 1)
-        layer = dataSource.GetLayer()
-
-        # add stand attribute fields
-        layer.CreateField(ogr.FieldDefn('hmax_eff', ogr.OFTInteger))
-        layer.CreateField(ogr.FieldDefn('hp80', ogr.OFTInteger))
-
-        # iterate over all features and add stand attribute values
-        counter = 0
-        for feature in layer:
-            fid = feature.GetField("OBJECTID")
-            hmax_eff = 0
-            if stats[fid].get('max') is not None and stats[fid].get('max') != NULL:
-                hmax_eff = stats[fid].get('max')
-
-            hp80 = 0
-            if stats[fid].get('percentile_80') is not None and stats[fid].get('percentile_80') != NULL:
-                hp80 = stats[fid].get('percentile_80')
-
-            # set and store hmax_eff
-            feature.SetField('hmax_eff', hmax_eff)
-            feature.SetField('hp80', hp80)
-            layer.SetFeature(feature)
-            counter += 1
-
-        try:
-            # this threw errors in specific QGIS versions (e.g. QGIS 3.28.4
-            #TODO : check if gdal actually needs close and/or how this is properly handled
-            dataSource.Close()
-        except:
-            print(f"Closing dataSource >> {dataSource} << failed with exception (origin: \n {vector_file_path}")
-        # delete_geopackage(vectorfile_path_stat_path)
-
-    ################################################
-    # get hmax by stand ID
+    # Get hmax effective and 80th percentile (zonal stats) per polygon
+    #
+    # The polygon FIDs are burnt into an in-memory raster on the VHM grid
+    # (polygons are connected parts of the stand raster, e.g. the remainder
+    # stand is split into many polygons). Returns the max and 80th percentile
+    # VHM value indexed by FID (NaN for polygons without valid VHM cells).
     @staticmethod
-    def getHmaxByStandId(stand_list, current_id):
-        for s in stand_list:
-            if s[0] == current_id:
-                return s[1]
-        return 0
+    def get_polygon_vhm_stats(dataSource, layer, vhm):
+        # cell centers within polygon (same as v.to.rast), NoData cells are ignored (same as GRASS null cells),
+        # percentiles without interpolation (same as r.univar)
+        table = zonal_statistics(dataSource, {"vhm": vhm}, ["max", "p80"], n_labels=layer.GetFeatureCount() + 1)
+        return table["vhm_max"], table["vhm_p80"]
 
     ################################################
-    # get hdom by stand ID
+    # get hmax and hdom by stand ID
+    #
+    # Returns hmax and hdom of all stands of the stand list as arrays indexed
+    # by stand ID (0 for IDs not in the stand list).
     @staticmethod
-    def getHdomByStandId(stand_list, current_id):
-        for s in stand_list:
-            if s[0] == current_id:
-                return s[2]
-        return 0
+    def getStandAttributesById(stand_list):
+        n_ids = max((s[0] for s in stand_list), default=0) + 1
+        hmax_by_id = numpy.zeros(n_ids)
+        hdom_by_id = numpy.zeros(n_ids)
+        for stand_id, hmax, hdom in stand_list:
+            hmax_by_id[stand_id] = hmax
+            hdom_by_id[stand_id] = hdom
+        return hmax_by_id, hdom_by_id
 
     ################################################
     # get stand type
@@ -275,47 +300,66 @@ class ClassificationHelper:
         dstband = None
 
     @staticmethod
-    def focal_majority(data, block_size, criteria, remove):
+    def focal_majority(data, block_size, criteria, remove, chunk_cells=2 ** 20):
         """ Reclassifies pixels based on the focal majority
         :param data: Raster data
         :param block_size: Block size (i.e. 3 -> 3 x 3 window)
         :param criteria: To reclassify on pixels with a certain value. Use None to run for all pixels.
         :param remove: Value to ignore. For example "0", to ignore NoData areas.
+        :param chunk_cells: Approximate number of raster cells processed at once (bounds the memory use)
         :return: Smoothed raster
         """
 
         data_copy = numpy.copy(data)
+        n_rows, n_cols = data.shape
+        h = block_size // 2
+        k = 2 * h + 1
+        center = k * k // 2
+
+        # process the raster in row blocks (with a halo of h rows)
+        block_rows = max(1, chunk_cells // max(n_cols, 1))
+        for r0 in range(0, n_rows, block_rows):
+            r1 = min(r0 + block_rows, n_rows)
+
+            # get subset pixels
+            subset = data[r0:r1]
+            if criteria != None:
+                m_subset = subset == criteria
+            else:
+                m_subset = subset != 0
+            if not m_subset.any():
+                continue
+
+            # pad the block with cells marked as invalid (outside the raster, same as get_matrix_subset2)
+            h0 = min(h, r0)
+            h1 = min(h, n_rows - r1)
+            block = numpy.pad(data[r0 - h0:r1 + h1], ((h - h0, h - h1), (h, h)))
+            valid = numpy.pad(numpy.ones((r1 - r0 + h0 + h1, n_cols), dtype=bool), ((h - h0, h - h1), (h, h)))
+            if remove != None:
+                valid &= block != remove
 
-        # get subset pixels
-        if criteria != None:
-            rows, cols = numpy.where(data == criteria)
-        else:
-            rows, cols = numpy.where(data != 0)
-
-        # loop over all cells (rows and cols)
-        for i in range(len(rows)):
-            r, c = rows[i], cols[i]
-            value_check = data[r, c]
-
-            # get pixel values within the search window (block)
-            block = ClassificationHelper.get_matrix_subset2(data, r, c, block_size)
-            block = block.flatten()
+            # pixel values within the search window (rows: pixels, cols: window cells in row-major order)
+            values = sliding_window_view(block, (k, k))[m_subset].reshape(-1, k * k)
+            values_valid = sliding_window_view(valid, (k, k))[m_subset].reshape(-1, k * k)
 
-            # get counts, and remove for examples zeros
-            b = Counter(block)
-            if remove != None:
-                del b[remove]
+            # count the occurrences of the value of each window cell (-1 for invalid or removed cells)
+            counts = numpy.zeros(values.shape, dtype=numpy.int32)
+            for j in range(k * k):
+                counts += (values == values[:, j:j + 1]) & values_valid[:, j:j + 1]
+            counts[~values_valid] = -1
 
-            # reclassify to the most common value
-            most_common = b.most_common(1)[0][0]
-            data_copy[r, c] = most_common
+            # reclassify to the most common value (ties: the value occurring first in the window, as Counter does)
+            i_most_common = numpy.argmax(counts, axis=1)
+            most_common = values[numpy.arange(len(values)), i_most_common]
+            # keep pixels without any valid value in the window
+            most_common = numpy.where(counts[numpy.arange(len(values)), i_most_common] > 0, most_common,
+                                      values[:, center])
 
             # check if the origin value should be kept (minimum of 3 neighbours needed) regardless
             if criteria == None:
-                for i in b.most_common():
-                    if (i[0] == value_check) and (i[1] > 3):
-                        # keep the current value
-                        data_copy[r, c] = value_check
+                most_common = numpy.where(counts[:, center] > 3, values[:, center], most_common)
+
+            data_copy[r0:r1][m_subset] = most_common
         return data_copy
 
     ################################################
@@ -367,6 +411,16 @@ class ClassificationHelper:
 
         return matrix[r_start:r_end, c_start:c_end]
 
+    ################################################
+    # get_window_offsets
+    #
+    # Returns the row and col offsets of all cells of a squared window
+    # of size s (flattened in row-major order, same order as get_matrix_subset).
+    @staticmethod
+    def get_window_offsets(s):
+        offsets = numpy.arange(-(s // 2), s // 2 + 1)
+        return numpy.repeat(offsets, s), numpy.tile(offsets, s)
+
     ################################################
     # replaceMatrixSubset
     #
@@ -39,6 +39,12 @@ from qgis.core import *
 
 from tbk_qgis.tbk.utility.tbk_utilities import *
 
+import numpy as np
+
+from osgeo import gdal
+
+from tbk_qgis.tbk.utility.zonal_statistics import zonal_statistics, ZonalAccumulator
+
 
 def add_coniferous_proportion(working_root, tmp_output_folder, tbk_result_dir, coniferous_raster, calc_main_layer, del_tmp=True):
     print("--------------------------------------------")
@@ -57,8 +63,9 @@ def add_coniferous_proportion(working_root, tmp_output_folder, tbk_result_dir, c
     print("calc mean coniferous proportion...")
 
 
-    param ={'INPUT_RASTER':nh_raster,'RASTER_BAND':1,'INPUT_VECTOR':stands_shapefile,'COLUMN_PREFIX':'nh_','STATS':[2]}
-    processing.run("qgis:zonalstatistics", param)
+    # mean per stand from the stand ID raster on the grid of the coniferous raster
+    nh_mean = zonal_statistics(stands_shapefile, {"nh": nh_raster}, ["mean"],
+                               tmp_output_folder=tmp_output_folder)["nh_mean"]
 
     stands_layer = QgsVectorLayer(stands_shapefile, "stands", "ogr")
 
@@ -66,101 +73,169 @@ def add_coniferous_proportion(working_root, tmp_output_folder, tbk_result_dir, c
         # Add NH fields
         provider = stands_layer.dataProvider()
         provider.addAttributes([QgsField("NH", QVariant.Int)])
+        if not del_tmp:
+            provider.addAttributes([QgsField("nh_mean", QVariant.Double)])
         stands_layer.updateFields()
 
-        # Write NH attribute per stand
+        # Write NH attribute per stand (NULL if the stand covers no valid pixel)
         for f in stands_layer.getFeatures():
-            f["NH"] = f["nh_mean"]
+            fid = f.id()
+            mean = float(nh_mean[fid]) if fid < len(nh_mean) and not np.isnan(nh_mean[fid]) else None
+            f["NH"] = mean
+            if not del_tmp:
+                f["nh_mean"] = mean
             stands_layer.updateFeature(f)  
     
-    if del_tmp:
-        delete_fields(stands_layer, ["nh_mean", 'nh_count', 'nh_sum'])
     del stands_layer
 
     # NH OS
     if calc_main_layer:
         print("calc mean coniferous proportion for main layer...")
         # dg raster layer
-        dg_layer_os = os.path.join(tbk_result_dir, r"dg_layers\dg_layer.tif")
+        dg_layer_os = resolve_raster_file(os.path.join(tbk_result_dir, r"dg_layers\dg_layer.tif"))
 
         # minimum degree of cover to select valid 10 m NH pixels
         cover = 40
 
-        # output raster file
-        dg_layer_os_nh = os.path.join(working_root, "tmp", "nh_os.tif")
-
-        # Output files tmp
-        dg_layer_os_1m = os.path.join(tmp_output_folder, "dg_layer_os_1m.tif")
-        dg_layer_os_10m_sum = os.path.join(tmp_output_folder, "dg_layer_os_10m_sum.tif")
-        dg_layer_os_10m_mask = os.path.join(tmp_output_folder, "dg_layer_os_10m_mask.tif")
-        nh_mean_table = os.path.join(tmp_output_folder, "nh_mean_table")
-        nh_sum_table = os.path.join(tmp_output_folder, "nh_sum_table")
-
-        # Resample os layer to 1m to align with 10m raster
-        param = {'INPUT':dg_layer_os,'SOURCE_CRS':None,'TARGET_CRS':None,'RESAMPLING':1,'NODATA':None,'TARGET_RESOLUTION':1,'OPTIONS':'COMPRESS=DEFLATE|PREDICTOR=2|ZLEVEL=9','DATA_TYPE':0,'TARGET_EXTENT':None,'TARGET_EXTENT_CRS':None,'MULTITHREADING':False,'EXTRA':'','OUTPUT':dg_layer_os_1m}
-        algoOutput = processing.run("gdal:warpreproject", param)
-        
-        # Aggregate os sum per 10m Sentinel-2 pixel
-        meta_data = get_raster_metadata(nh_raster)
-        extent = "{0},{1},{2},{3} [EPSG:{4}]".format(meta_data["extent"][0],meta_data["extent"][2],meta_data["extent"][1],meta_data["extent"][3],meta_data["epsg"]) 
-
-        param = {'input':dg_layer_os_1m,'method':8,'quantile':0.5,'-n':False,'-w':False,'output':dg_layer_os_10m_sum,
-                 'GRASS_REGION_PARAMETER':extent,'GRASS_REGION_CELLSIZE_PARAMETER':10,'GRASS_RASTER_FORMAT_OPT':'','GRASS_RASTER_FORMAT_META':''}
-        algoOutput = processing.run("grass7:r.resamp.stats", param)
-
-        meta_data = get_raster_metadata(dg_layer_os)
-        param = {'INPUT': dg_layer_os_10m_sum,'CRS':QgsCoordinateReferenceSystem('EPSG:{0}'.format(meta_data["epsg"]))}
-        processing.run("gdal:assignprojection", param)
-
-        # Reclassify
-        condition_string = "(A > {0})*1".format(str(cover))
-        param = {'INPUT_A':dg_layer_os_10m_sum,'BAND_A':1,'INPUT_B':None,'BAND_B':-1,'INPUT_C':None,'BAND_C':-1,'INPUT_D':None,'BAND_D':-1,'INPUT_E':None,'BAND_E':-1,'INPUT_F':None,'BAND_F':-1,
-                'FORMULA':condition_string,'NO_DATA':None,'RTYPE':0,'OPTIONS':'COMPRESS=DEFLATE|PREDICTOR=2|ZLEVEL=9','EXTRA':'','OUTPUT':dg_layer_os_10m_mask}
-        processing.run("gdal:rastercalculator", param)
-
-        # Extract pixels covered by OS
-        formula = "A*B"
-        param = {'INPUT_A':nh_raster,'BAND_A':1,
-                 'INPUT_B':dg_layer_os_10m_mask,'BAND_B':1,
-                 'INPUT_C':None,'BAND_C':-1,'INPUT_D':None,'BAND_D':-1,'INPUT_E':None,'BAND_E':-1,'INPUT_F':None,'BAND_F':-1,
-                'FORMULA':formula,'NO_DATA':None,'RTYPE':0,'OPTIONS':'COMPRESS=DEFLATE|PREDICTOR=2|ZLEVEL=9','EXTRA':'','OUTPUT':dg_layer_os_nh}
-        processing.run("gdal:rastercalculator", param)
-
-        # Calculate mean NH_OS
-        param ={'INPUT_RASTER':dg_layer_os_nh,'RASTER_BAND':1,'INPUT_VECTOR':stands_shapefile,'COLUMN_PREFIX':'nh_','STATS':[2]}
-        processing.run("qgis:zonalstatistics", param)
-
-        # Calculate sum NH_OS pixels
-        param ={'INPUT_RASTER':dg_layer_os_10m_mask,'RASTER_BAND':1,'INPUT_VECTOR':stands_shapefile,'COLUMN_PREFIX':'nhm_','STATS':[1]}
-        processing.run("qgis:zonalstatistics", param)
+        # OS cover per NH pixel, mask and NH_OS mean / pixel count per stand in one pass
+        stand_id_raster = get_stand_id_raster(stands_shapefile, nh_raster, tmp_output_folder)
+        nh_os_mean, nh_os_pix = calculate_nh_os(dg_layer_os, nh_raster, stand_id_raster, cover)
 
         stands_layer = QgsVectorLayer(stands_shapefile, "stands", "ogr")
 
         with edit(stands_layer):
-            # Add NH fields
+            # Add NH fields (number of NH_OS pixels only kept if temporary fields are not deleted)
             provider = stands_layer.dataProvider()
-            provider.addAttributes([QgsField("NH_OS", QVariant.Int),
-                                    QgsField("NH_OS_PIX", QVariant.Int)])
+            provider.addAttributes([QgsField("NH_OS", QVariant.Int)])
+            if not del_tmp:
+                provider.addAttributes([QgsField("NH_OS_PIX", QVariant.Int)])
             stands_layer.updateFields()
 
             # Write NH_OS attribute per stand
             for f in stands_layer.getFeatures():
-                f["NH_OS_PIX"] = f["nhm_sum"]
-                if f["NH_OS_PIX"] > 0:
-                    f["NH_OS"] = f["nh_mean"]
+                fid = f.id()
+                pix = int(nh_os_pix[fid]) if fid < len(nh_os_pix) else 0
+                if pix > 0:
+                    f["NH_OS"] = float(nh_os_mean[fid]) if not np.isnan(nh_os_mean[fid]) else None
                 else:
                     # set value to -1 if no NH_OS pixels
                     f["NH_OS"] = -1
+                if not del_tmp:
+                    f["NH_OS_PIX"] = pix
                 stands_layer.updateFeature(f)  
 
-        if del_tmp:
-            delete_fields(stands_layer, ["nh_mean", "nhm_sum", 'nh_count', 'nh_sum', 'nhm_count', 'nhm_mean', 'NH_OS_PIX'])
+    print("DONE!")
 
-        # Delete tmp files
-        if del_tmp:
-            delete_raster(dg_layer_os_1m)
-            delete_raster(dg_layer_os_10m_sum)
-            #delete_raster(dg_layer_os_10m_mask)
-            #shutil.rmtree(output_tmp_folder)
 
-    print("DONE!")
+def get_overlap_weights(offset, cell_size, n_cells, target_cell_size, n_target):
+    """
+    Overlap of the cells of a fine grid axis with the cells of a coarser target grid axis. Every fine cell overlaps
+    at most two target cells (cell_size <= target_cell_size).
+
+    :param offset: Start of the fine axis relative to the start of the target axis (in axis direction)
+    :return: Target cell index and overlap length of the first and second overlapped target cell per fine cell
+             (index -1 / overlap 0 if outside the target grid)
+    """
+    starts = offset + np.arange(n_cells) * cell_size
+    ends = starts + cell_size
+    first = np.floor(starts / target_cell_size).astype(np.int64)
+    boundary = (first + 1) * target_cell_size
+    overlap_first = np.minimum(ends, boundary) - starts
+    overlap_second = np.maximum(ends - boundary, 0)
+    second = first + 1
+    for index, overlap in ((first, overlap_first), (second, overlap_second)):
+        m_outside = (index < 0) | (index >= n_target)
+        index[m_outside] = -1
+        overlap[m_outside] = 0
+    return first, overlap_first, second, overlap_second
+
+
+def aggregate_overlap(values, axis, weights):
+    """Sum of the values weighted by the overlap with the target cells along an axis (see get_overlap_weights).
+    :return: Target cell indices and sums along the axis
+    """
+    indices = []
+    sums = []
+    for index, overlap in (weights[0:2], weights[2:4]):
+        m_inside = index >= 0
+        if not m_inside.any():
+            continue
+        # indices are sorted, so the cells of each target cell are contiguous
+        index = index[m_inside]
+        weighted = np.compress(m_inside, values, axis=axis) * np.expand_dims(overlap[m_inside], 1 - axis)
+        unique_index, starts = np.unique(index, return_index=True)
+        indices.append(unique_index)
+        sums.append(np.add.reduceat(weighted, starts, axis=axis))
+    return indices, sums
+
+
+def calculate_nh_os(dg_raster, nh_raster, stand_id_raster, cover=40, block_cells=2 ** 22):
+    """
+    Coniferous proportion of the main layer (NH_OS) per stand.
+
+    The DG layer is aggregated block by block onto the NH grid with the exact overlap area of its cells (cover in %
+    of the NH pixel, DG NoData counts as not covered). NH pixels with a cover > cover are OS pixels. Per stand the
+    OS pixels are counted and the mean NH of the OS pixels is calculated (NH 0 and NoData are not counted, same as
+    the NoData of the former raster calculator product).
+
+    :param dg_raster: DG layer (0/1, e.g. 1.5m) in the CRS of the NH raster
+    :param nh_raster: Coniferous raster (e.g. 10m)
+    :param stand_id_raster: Stand fid per NH pixel (see get_stand_id_raster)
+    :param cover: Minimum degree of cover [%] of OS pixels
+    :param block_cells: Approximate number of DG cells processed at once (bounds the memory use)
+    :return: Mean NH of the OS pixels (NaN if none) and number of OS pixels, arrays indexed by stand fid
+    """
+    nh_ds = gdal.Open(nh_raster, gdal.GA_ReadOnly)
+    nh_x0, nh_dx, _, nh_y0, _, nh_dy = nh_ds.GetGeoTransform()
+    nh_cols, nh_rows = nh_ds.RasterXSize, nh_ds.RasterYSize
+    nh_band = nh_ds.GetRasterBand(1)
+    nh_nodata = nh_band.GetNoDataValue()
+    nh = nh_band.ReadAsArray()
+    nh_ds = None
+
+    dg_ds = gdal.Open(dg_raster, gdal.GA_ReadOnly)
+    dg_x0, dg_dx, _, dg_y0, _, dg_dy = dg_ds.GetGeoTransform()
+    dg_cols, dg_rows = dg_ds.RasterXSize, dg_ds.RasterYSize
+    dg_band = dg_ds.GetRasterBand(1)
+    dg_nodata = dg_band.GetNoDataValue()
+    if abs(dg_dx) > abs(nh_dx) or abs(dg_dy) > abs(nh_dy):
+        raise ValueError("The DG layer must not be coarser than the NH raster")
+
+    # covered area per NH pixel
+    col_weights = get_overlap_weights(dg_x0 - nh_x0, dg_dx, dg_cols, nh_dx, nh_cols)
+    covered_area = np.zeros((nh_rows, nh_cols))
+    block_rows = max(1, block_cells // dg_cols)
+    for row in range(0, dg_rows, block_rows):
+        rows = min(block_rows, dg_rows - row)
+        dg = dg_band.ReadAsArray(0, row, dg_cols, rows)
+        covered = (dg == 1).astype(np.float64)
+        if dg_nodata is not None:
+            covered[dg == dg_nodata] = 0
+        # rows are counted from the top of both grids (negative y resolution)
+        row_weights = get_overlap_weights(nh_y0 - (dg_y0 + row * dg_dy), -dg_dy, rows, -nh_dy, nh_rows)
+        col_indices, col_sums = aggregate_overlap(covered, 1, col_weights)
+        for col_index, col_sum in zip(col_indices, col_sums):
+            row_indices, sums = aggregate_overlap(col_sum, 0, row_weights)
+            for row_index, area in zip(row_indices, sums):
+                covered_area[np.ix_(row_index, col_index)] += area
+    dg_ds = None
+
+    # OS pixels
+    m_os = covered_area * 100 / abs(nh_dx * nh_dy) > cover
+
+    label_ds = gdal.Open(stand_id_raster, gdal.GA_ReadOnly)
+    labels = label_ds.GetRasterBand(1).ReadAsArray()
+    label_ds = None
+    n_labels = int(labels.max()) + 1 if labels.size else 1
+
+    m_pix = m_os & (labels > 0)
+    m_nh = m_pix & (nh != 0)
+    if nh_nodata is not None:
+        m_nh &= nh != nh_nodata
+    if np.issubdtype(nh.dtype, np.floating):
+        m_nh &= ~np.isnan(nh)
+    nh_os_pix = ZonalAccumulator(["count"], n_labels)
+    nh_os_pix.add(labels[m_pix], m_os[m_pix])
+    nh_os_mean = ZonalAccumulator(["mean"], n_labels)
+    nh_os_mean.add(labels[m_nh], nh[m_nh])
+    return nh_os_mean.result(n_labels)["mean"], nh_os_pix.result(n_labels)["count"]
@@ -53,20 +53,17 @@ from qgis.core import *
 
 from tbk_qgis.tbk.utility.tbk_utilities import *
 
-from osgeo import gdal
+import numpy as np
+from osgeo import gdal, gdal_array
+from xml.sax.saxutils import escape
 
+from tbk_qgis.tbk.utility.zonal_statistics import ZonalAccumulator
 
-def calculate_dg(working_root, tmp_output_folder, tbk_result_dir, vhm, del_tmp=True):
+
+def calculate_dg(working_root, tmp_output_folder, tbk_result_dir, vhm, del_tmp=True, packed_layers=False):
     print("--------------------------------------------")
     print("START DG calculation...")
 
-    # TBk folder path
-    workspace = working_root
-    scratchWorkspace = tmp_output_folder
-
-    # Use half of the cores on the machine.
-    # arcpy.env.parallelProcessingFactor = "50%"
-
     # TBk shapefile
     stands_file = os.path.join(working_root, "stands_clipped.gpkg")
 
@@ -81,173 +78,247 @@ def calculate_dg(working_root, tmp_output_folder, tbk_result_dir, vhm, del_tmp=T
         if not os.path.exists(tmp_output_folder):
             os.makedirs(tmp_output_folder)
 
-    # DG layers
-    dg_ks_classified = os.path.join(dg_layers_dir, "dg_layer_ks.tif")
-    dg_us_classified = os.path.join(dg_layers_dir, "dg_layer_us.tif")
-    dg_ms_classified = os.path.join(dg_layers_dir, "dg_layer_ms.tif")
-    dg_os_classified = os.path.join(dg_layers_dir, "dg_layer_os.tif")
-    dg_ueb_classified = os.path.join(dg_layers_dir, "dg_layer_ueb.tif")
-    dg_classified = os.path.join(dg_layers_dir, "dg_layer.tif")
-
-    # tmp files
-    tmp_lim_ks = os.path.join(tmp_output_folder, "dg_ks_max.tif")
-    tmp_lim_us = os.path.join(tmp_output_folder, "dg_us_min.tif")
-    tmp_lim_ms = os.path.join(tmp_output_folder, "dg_ms_min.tif")
-    tmp_lim_os = os.path.join(tmp_output_folder, "dg_lim_os.tif")
-    tmp_lim_ueb = os.path.join(tmp_output_folder, "dg_lim_ueb.tif")
-    tmp_lim_dg = os.path.join(tmp_output_folder, "dg_lim_dg.tif")
-
-    # Layer threshold values (based on NFI definition, www.lfi.ch)
-    max_height_ks = 1.0
-    min_height_us = 1.0
-    min_height_hdom_factor_ms = 1.0 / 3.0
-    min_height_hdom_factor_os = 2.0 / 3.0
-    min_height_hmax_factor_ueb = 1.0
+    # DG layers (VRT views of one bit-packed raster if packed_layers is set)
+    layer_ext = ".vrt" if packed_layers else ".tif"
+    dg_layer_files = {'ks': os.path.join(dg_layers_dir, "dg_layer_ks" + layer_ext),
+                      'us': os.path.join(dg_layers_dir, "dg_layer_us" + layer_ext),
+                      'ms': os.path.join(dg_layers_dir, "dg_layer_ms" + layer_ext),
+                      'os': os.path.join(dg_layers_dir, "dg_layer_os" + layer_ext),
+                      'ueb': os.path.join(dg_layers_dir, "dg_layer_ueb" + layer_ext),
+                      'dg': os.path.join(dg_layers_dir, "dg_layer" + layer_ext)}
+    packed_file = os.path.join(dg_layers_dir, "dg_layers_packed.tif") if packed_layers else None
+
+    # DG fields per layer (and layer proportion fields, only kept if temporary fields are not deleted)
+    dg_fields = {'ks': "DG_ks", 'us': "DG_us", 'ms': "DG_ms", 'os': "DG_os", 'ueb': "DG_ueb", 'dg': "DG"}
+    mean_fields = {'ks': "dg_ks_mean", 'us': "dg_us_mean", 'ms': "dg_ms_mean", 'os': "dg_os_mean",
+                   'ueb': "dg_ueb_mean", 'dg': "dg_mean"}
 
     ########################################################################
 
     stands_layer = QgsVectorLayer(stands_file, "stands", "ogr")
 
-    # Add DG limits fields per stand
-    with edit(stands_layer):
-        provider = stands_layer.dataProvider()
-        provider.addAttributes([QgsField("dg_ks_max", QVariant.Double),
-                                QgsField("dg_us_min", QVariant.Double),
-                                QgsField("dg_ms_min", QVariant.Double),
-                                QgsField("dg_os_min", QVariant.Double),
-                                QgsField("dg_ueb_min", QVariant.Double),
-                                QgsField("dg_min", QVariant.Double)])
-        stands_layer.updateFields()
-
-        # Calculate DG limits per stand
-        print("calculating DG limits...")
+    # Calculate DG limits per stand (arrays indexed by stand fid, 0: no stand)
+    print("calculating DG limits...")
+    limits = calculate_dg_limits(stands_layer)
 
-        for f in stands_layer.getFeatures():
-            f["dg_ks_max"] = max_height_ks
-            f["dg_us_min"] = min_height_us
-            f["dg_ms_min"] = f["hdom"] * min_height_hdom_factor_ms
-            f["dg_os_min"] = f["hdom"] * min_height_hdom_factor_os
-            f["dg_ueb_min"] = f["hmax"] * min_height_hmax_factor_ueb
-            if f["hdom"] < 14:
-                # fix small stands issue
-                f["dg_min"] = f["hdom"] * min_height_hdom_factor_ms
-            else:
-                f["dg_min"] = f["dg_os_min"]
+    # Stand ID per VHM cell (shared with later stages)
+    stand_id_raster = get_stand_id_raster(stands_file, vhm, tmp_output_folder)
 
-            stands_layer.updateFeature(f)
-
-    # create a list (for iteration) with dg-classes to be calculated
-    # assign: 1. a column_prefix, 2. a limit (dg_lim_field),
-    # 3. - 5. the necessary raster layers (dg_tmp_file_B and C as well as dg_layer_file)
-    # and 6. the raster calculator formula for each dg-type
-    field_file_pairs = [
-        ['dg_ueb_', 'dg_ueb_min', tmp_lim_ueb, None, dg_ueb_classified, '((A>B) & True)*1'],
-        ['dg_os_', 'dg_os_min', tmp_lim_os, tmp_lim_ueb, dg_os_classified, '((A>B) & (A<=C))*1'],
-        ['dg_ms_', 'dg_ms_min', tmp_lim_ms, tmp_lim_os, dg_ms_classified, '((A>B) & (A<=C))*1'],
-        ['dg_us_', 'dg_us_min', tmp_lim_us, tmp_lim_ms, dg_us_classified, '((A>=B) & (A<=C))*1'],
-        ['dg_ks_', 'dg_ks_max', tmp_lim_ks, tmp_lim_us, dg_ks_classified, '((A<B) & True)*1'],
-        ['dg_', 'dg_min', tmp_lim_dg, tmp_lim_ks, dg_classified, '((A>B) & True)*1']
-    ]
-
-    # Produce final "1" / "0" raster for each layer
-    # iterate over the list above
-    # CreateCopy > rasterize over > calc/compress
+    # Classify all layers and calculate the layer proportion per stand in one pass
     print("classify stand layers...")
-    for column_prefix, \
-            dg_lim_field, \
-            dg_tmp_file_B, \
-            dg_tmp_file_C, \
-            dg_layer_file, \
-            formula \
-            in field_file_pairs:
-        start_time = time.time()
-        # print(dg_lim_field, "->", dg_tmp_file_B, "->", dg_layer_file)
-        if (column_prefix == 'dg_'):
-            # DG Layer can be created by using OS and UEB (need to be present)
-            processing.run("gdal:rastercalculator", {
-                'INPUT_A': dg_os_classified,
-                'BAND_A': 1,
-                'INPUT_B': dg_ueb_classified,
-                'BAND_B': None, 'INPUT_C': None, 'BAND_C': None, 'INPUT_D': None, 'BAND_D': None, 'INPUT_E': None,
-                'BAND_E': None, 'INPUT_F': None, 'BAND_F': None, 'FORMULA': 'logical_or(A, B)', 'NO_DATA': None,
-                'PROJWIN': None, 'RTYPE': 0, 'OPTIONS': 'COMPRESS=DEFLATE|PREDICTOR=2|ZLEVEL=9', 'EXTRA': '',
-                'OUTPUT': dg_layer_file})
-        else:
-            # create an empty DG layer based on vhm extents for each layer
-            create_empty_copy(vhm, dg_tmp_file_B)
-            # burn vector value into raster
-            processing.run("gdal:rasterize_over", {
-                'INPUT': stands_file,
-                'INPUT_RASTER': dg_tmp_file_B,
-                'FIELD': dg_lim_field,
-                'ADD': False, 'EXTRA': ''})
-            # classify raster
-            processing.run("gdal:rastercalculator", {
-                'INPUT_A': vhm, 'BAND_A': 1,
-                'INPUT_B': dg_tmp_file_B, 'BAND_B': 1,
-                'INPUT_C': dg_tmp_file_C, 'BAND_C': 1,
-                'INPUT_D': None, 'BAND_D': -1, 'INPUT_E': None, 'BAND_E': -1, 'INPUT_F': None, 'BAND_F': -1,
-                'FORMULA': formula, 'NO_DATA': None, 'RTYPE': 0,
-                'OPTIONS': 'COMPRESS=DEFLATE|PREDICTOR=2|ZLEVEL=9', 'EXTRA': '', 'OUTPUT': dg_layer_file})
-
-        # clean up temp files as soon as possible
-        if del_tmp:
-            if dg_tmp_file_C is not None:
-                if os.path.exists(dg_tmp_file_C):
-                    delete_raster(dg_tmp_file_C)
-                if os.path.exists(dg_tmp_file_C + ".aux.xml"):
-                    os.remove(dg_tmp_file_C + ".aux.xml")
-
-        end_time = time.time()
-        print(f'{column_prefix}layer classification execution time: {str(timedelta(seconds=(end_time - start_time)))}')
-
-    # Calculate DG per stand and per layer
-    print("zonal statistics...")
-    for column_prefix, x, x, x, dg_layer_file, x in field_file_pairs:
-        start_time = time.time()
-
-        # using the "old" zonalstatistics algorithm (not zonalstatisticsfb), that appends fields to input layer
-        # for more info, read https://github.com/qgis/QGIS/issues/40356
-        param = {'INPUT_RASTER': dg_layer_file, 'RASTER_BAND': 1,
-                 'INPUT_VECTOR': stands_file,
-                 'COLUMN_PREFIX': column_prefix, 'STATS': [2]}
-        processing.run("qgis:zonalstatistics", param)
-
-        end_time = time.time()
-        print(f'{column_prefix}layer classification execution time: {str(timedelta(seconds=(end_time - start_time)))}')
-
-    # re-read the input, as it was modified by zonal statistics
-    stands_layer = QgsVectorLayer(stands_file, "stands", "ogr")
+    start_time = time.time()
+    layer_stats = classify_dg_layers(vhm, stand_id_raster, limits, dg_layer_files, packed_file=packed_file)
+    print(f'layer classification execution time: {str(timedelta(seconds=(time.time() - start_time)))}')
+
+    # Store DG per stand
     with edit(stands_layer):
         # Add DG fields
         provider = stands_layer.dataProvider()
-        provider.addAttributes([QgsField("DG_ks", QVariant.Int),
-                                QgsField("DG_us", QVariant.Int),
-                                QgsField("DG_ms", QVariant.Int),
-                                QgsField("DG_os", QVariant.Int),
-                                QgsField("DG_ueb", QVariant.Int),
-                                QgsField("DG", QVariant.Int)])
+        provider.addAttributes([QgsField(dg_fields[layer], QVariant.Int) for layer in dg_layer_files.keys()])
+        # keep DG limits and layer proportions if temporary fields are not deleted
+        if not del_tmp:
+            provider.addAttributes([QgsField(limit, QVariant.Double) for limit in limits.keys()] +
+                                   [QgsField(mean_fields[layer], QVariant.Double) for layer in dg_layer_files.keys()])
         stands_layer.updateFields()
 
         # Calculate DG per stand
         for f in stands_layer.getFeatures():
-            # round if is a number, copy NULL values without rounding to avoid errors
-            f["DG_ks"] = round(f["dg_ks_mean"] * 100) if f["dg_ks_mean"] != core.NULL else f["dg_ks_mean"]
-            f["DG_us"] = round(f["dg_us_mean"] * 100) if f["dg_us_mean"] != core.NULL else f["dg_us_mean"]
-            f["DG_ms"] = round(f["dg_ms_mean"] * 100) if f["dg_ms_mean"] != core.NULL else f["dg_ms_mean"]
-            f["DG_os"] = round(f["dg_os_mean"] * 100) if f["dg_os_mean"] != core.NULL else f["dg_os_mean"]
-            f["DG_ueb"] = round(f["dg_ueb_mean"] * 100) if f["dg_ueb_mean"] != core.NULL else f["dg_ueb_mean"]
-            f["DG"] = round(f["dg_mean"] * 100) if f["dg_mean"] != core.NULL else f["dg_mean"]
+            fid = f.id()
+            for layer in dg_layer_files.keys():
+                layer_means = layer_stats[layer + "_mean"]
+                # NULL if there are no valid VHM cells within the stand
+                if fid < len(layer_means) and not np.isnan(layer_means[fid]):
+                    layer_mean = float(layer_means[fid])
+                    f[dg_fields[layer]] = round(layer_mean * 100)
+                else:
+                    layer_mean = core.NULL
+                    f[dg_fields[layer]] = layer_mean
+                if not del_tmp:
+                    f[mean_fields[layer]] = layer_mean
+            if not del_tmp:
+                for limit, values in limits.items():
+                    f[limit] = float(values[fid]) if fid < len(values) else core.NULL
 
             stands_layer.updateFeature(f)
 
     # Delete temporary fields
     if del_tmp:
-        delete_fields(stands_layer,
-                      ["dg_ks_max", "dg_us_min", "dg_ms_min", "dg_os_min", "dg_ueb_min", "dg_min", "dissolve",
-                       "dg_ks_mean", "dg_us_mean", "dg_ms_mean", "dg_os_mean", "dg_ueb_mean", "dg_mean",
-                       'dg_ks_count', 'dg_ks_sum', 'dg_us_count', 'dg_us_sum', 'dg_ms_count', 'dg_ms_sum', 'dg_os_count',
-                       'dg_os_sum', 'dg_ueb_count', 'dg_ueb_sum', 'dg_count', 'dg_sum',
-                       ])
+        delete_fields(stands_layer, ["dissolve"])
 
     print("DONE!")
+
+
+def calculate_dg_limits(stands_layer):
+    '''
+    Height limits of the stand layers (based on NFI definition, www.lfi.ch) per stand.
+
+    :return: Dict with the limit arrays (dg_ks_max, dg_us_min, dg_ms_min, dg_os_min, dg_ueb_min, dg_min) indexed by
+             stand fid, all limits are 0 for index 0 and fids without stand (same as outside the stands).
+    '''
+    # Layer threshold values (based on NFI definition, www.lfi.ch)
+    max_height_ks = 1.0
+    min_height_us = 1.0
+    min_height_hdom_factor_ms = 1.0 / 3.0
+    min_height_hdom_factor_os = 2.0 / 3.0
+    min_height_hmax_factor_ueb = 1.0
+
+    stands = [(f.id(), f["hdom"], f["hmax"]) for f in stands_layer.getFeatures()]
+    n_ids = max((fid for fid, hdom, hmax in stands), default=0) + 1
+    limits = {name: np.zeros(n_ids) for name in ["dg_ks_max", "dg_us_min", "dg_ms_min", "dg_os_min",
+                                                 "dg_ueb_min", "dg_min"]}
+    for fid, hdom, hmax in stands:
+        limits["dg_ks_max"][fid] = max_height_ks
+        limits["dg_us_min"][fid] = min_height_us
+        limits["dg_ms_min"][fid] = hdom * min_height_hdom_factor_ms
+        limits["dg_os_min"][fid] = hdom * min_height_hdom_factor_os
+        limits["dg_ueb_min"][fid] = hmax * min_height_hmax_factor_ueb
+        if hdom < 14:
+            # fix small stands issue
+            limits["dg_min"][fid] = hdom * min_height_hdom_factor_ms
+        else:
+            limits["dg_min"][fid] = limits["dg_os_min"][fid]
+    return limits
+
+
+# Bit of each layer in the bit-packed DG raster
+DG_LAYER_BITS = {'ks': 1, 'us': 2, 'ms': 4, 'os': 8, 'ueb': 16, 'dg': 32}
+
+
+def classify_dg_layers(vhm, stand_id_raster, limits, dg_layer_files, block_cells=2 ** 22, packed_file=None):
+    '''
+    Classify the stand layers (ks/us/ms/os/ueb/dg) of a detailed VHM block by block and calculate the proportion of
+    each layer per stand in the same pass (see ZonalAccumulator).
+
+    Layers are 1 where the VHM is within the limits of the stand of the cell (limits are 0 outside stands),
+    VHM NoData cells are 255 (NoData) in all layers:
+    ueb: vhm > dg_ueb_min, os: dg_os_min < vhm <= dg_ueb_min, ms: dg_ms_min < vhm <= dg_os_min,
+    us: dg_us_min <= vhm <= dg_ms_min, ks: vhm < dg_ks_max, dg: os or ueb.
+
+    :param vhm: Detailed VHM (e.g. 1.5m)
+    :param stand_id_raster: Stand fid per VHM cell (0: no stand)
+    :param limits: Limit arrays indexed by stand fid (see calculate_dg_limits)
+    :param dg_layer_files: Dict with output file per layer (ks, us, ms, os, ueb, dg)
+    :param block_cells: Approximate number of cells processed at once (bounds the memory use)
+    :param packed_file: If set, all layers are stored in this Byte raster as bit flags (see DG_LAYER_BITS, NoData
+                        255) and dg_layer_files are written as VRT views of the single layers
+    :return: Zonal statistics table with the columns <layer>_count (valid VHM cells) and <layer>_mean (layer
+             proportion) per layer, arrays indexed by stand fid
+    '''
+    nodata_out = 255
+    vhm_ds = gdal.Open(vhm, gdal.GA_ReadOnly)
+    vhm_band = vhm_ds.GetRasterBand(1)
+    vhm_nodata = vhm_band.GetNoDataValue()
+    label_ds = gdal.Open(stand_id_raster, gdal.GA_ReadOnly)
+    label_band = label_ds.GetRasterBand(1)
+    n_cols, n_rows = vhm_ds.RasterXSize, vhm_ds.RasterYSize
+
+    # limits in the data type of the VHM (same as the limits burnt into an empty copy of the VHM)
+    vhm_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(vhm_band.DataType)
+    if np.issubdtype(vhm_dtype, np.integer):
+        limits = {name: np.rint(values).astype(vhm_dtype) for name, values in limits.items()}
+    else:
+        limits = {name: values.astype(vhm_dtype) for name, values in limits.items()}
+    n_ids = len(limits["dg_min"])
+
+    # create output rasters
+    driver = gdal.GetDriverByName('GTiff')
+    out_bands = {}
+    out_datasets = []
+    for layer, out_file in ({'packed': packed_file} if packed_file else dg_layer_files).items():
+        out_ds = driver.Create(out_file, n_cols, n_rows, 1, gdal.GDT_Byte,
+                               options=['COMPRESS=DEFLATE', 'PREDICTOR=2', 'ZLEVEL=9'])
+        out_ds.SetGeoTransform(vhm_ds.GetGeoTransform())
+        out_ds.SetProjection(vhm_ds.GetProjection())
+        out_bands[layer] = out_ds.GetRasterBand(1)
+        out_bands[layer].SetNoDataValue(nodata_out)
+        out_datasets.append(out_ds)
+
+    accumulators = {layer: ZonalAccumulator(["count", "mean"], n_ids) for layer in dg_layer_files.keys()}
+
+    block_rows = max(1, block_cells // n_cols)
+    for row in range(0, n_rows, block_rows):
+        rows = min(block_rows, n_rows - row)
+        a = vhm_band.ReadAsArray(0, row, n_cols, rows)
+        ids = label_band.ReadAsArray(0, row, n_cols, rows)
+        ids[ids >= n_ids] = 0
+
+        m_nodata = np.zeros(a.shape, dtype=bool)
+        if vhm_nodata is not None:
+            m_nodata = np.isnan(a) if np.isnan(vhm_nodata) else a == vhm_nodata
+
+        ueb_min = limits["dg_ueb_min"][ids]
+        os_min = limits["dg_os_min"][ids]
+        ms_min = limits["dg_ms_min"][ids]
+        layers = {'ueb': a > ueb_min,
+                  'os': (a > os_min) & (a <= ueb_min),
+                  'ms': (a > ms_min) & (a <= os_min),
+                  'us': (a >= limits["dg_us_min"][ids]) & (a <= ms_min),
+                  'ks': a < limits["dg_ks_max"][ids]}
+        layers['dg'] = layers['os'] | layers['ueb']
+
+        # layer proportion of the valid cells per stand
+        m_count = ~m_nodata & (ids > 0)
+        ids_valid = ids[m_count]
+        for layer in dg_layer_files.keys():
+            m_layer = layers[layer]
+            accumulators[layer].add(ids_valid, m_layer[m_count].astype(np.uint8))
+            if not packed_file:
+                out = m_layer.astype(np.uint8)
+                out[m_nodata] = nodata_out
+                out_bands[layer].WriteArray(out, 0, row)
+        if packed_file:
+            out = np.zeros(a.shape, dtype=np.uint8)
+            for layer in dg_layer_files.keys():
+                out[layers[layer]] |= DG_LAYER_BITS[layer]
+            out[m_nodata] = nodata_out
+            out_bands['packed'].WriteArray(out, 0, row)
+
+    out_bands = None
+    out_datasets = None
+    vhm_ds = None
+    label_ds = None
+    if packed_file:
+        print("File %s saved" % packed_file)
+        for layer, dg_layer_file in dg_layer_files.items():
+            write_dg_layer_vrt(packed_file, dg_layer_file, DG_LAYER_BITS[layer])
+    for dg_layer_file in dg_layer_files.values():
+        print("File %s saved" % dg_layer_file)
+    layer_stats = {}
+    for layer, accumulator in accumulators.items():
+        for statistic, values in accumulator.result(n_ids).items():
+            layer_stats[f"{layer}_{statistic}"] = values
+    return layer_stats
+
+
+def write_dg_layer_vrt(packed_file, vrt_file, bit):
+    '''
+    Write a VRT exposing one layer (0/1, NoData 255) of the bit-packed DG raster. The bit is extracted with a lookup
+    table of all flag combinations, so the VRT can be read by any GDAL based consumer (no pixel functions needed).
+
+    :param packed_file: Bit-packed DG raster (see classify_dg_layers)
+    :param vrt_file: Output VRT
+    :param bit: Bit of the layer (see DG_LAYER_BITS)
+    '''
+    packed_ds = gdal.Open(packed_file, gdal.GA_ReadOnly)
+    n_cols, n_rows = packed_ds.RasterXSize, packed_ds.RasterYSize
+    geotransform = ", ".join(repr(v) for v in packed_ds.GetGeoTransform())
+    srs = escape(packed_ds.GetProjection())
+    packed_ds = None
+
+    n_flags = 2 * max(DG_LAYER_BITS.values())
+    lut = ",".join(f"{v}:{1 if v & bit else 0}" for v in range(n_flags)) + ",255:255"
+    source = os.path.relpath(packed_file, os.path.dirname(os.path.abspath(vrt_file)))
+    with open(vrt_file, "w") as f:
+        f.write(f'''<VRTDataset rasterXSize="{n_cols}" rasterYSize="{n_rows}">
+  <SRS>{srs}</SRS>
+  <GeoTransform>{geotransform}</GeoTransform>
+  <VRTRasterBand dataType="Byte" band="1">
+    <NoDataValue>255</NoDataValue>
+    <ComplexSource>
+      <SourceFilename relativeToVRT="1">{escape(source)}</SourceFilename>
+      <SourceBand>1</SourceBand>
+      <LUT>{lut}</LUT>
+    </ComplexSource>
+  </VRTRasterBand>
+</VRTDataset>
+''')
@@ -38,6 +38,11 @@ from qgis.core import *
 
 from tbk_qgis.tbk.utility.tbk_utilities import *
 
+import numpy as np
+from osgeo import gdal, ogr
+
+from tbk_qgis.tbk.utility.tiled_overlay import clip_to_perimeter_tiled as clip_stands_tiled
+
 def clip_to_perimeter(working_root, tmp_output_folder, perimeter, del_tmp=True):
     print("--------------------------------------------")
     print("START Clip to perimeter...")
@@ -49,6 +54,9 @@ def clip_to_perimeter(working_root, tmp_output_folder, perimeter, del_tmp=True):
     param = {'INPUT':stands_merged_path,'OVERLAY':perimeter,'OUTPUT':stands_clip_path}
     processing.run("native:clip", param)
 
+    clip_highest_trees(working_root, tmp_output_folder, perimeter, del_tmp=del_tmp)
+
+def clip_highest_trees(working_root, tmp_output_folder, perimeter, del_tmp=True):
     #Clip highest trees
     highest_point_path = os.path.join(tmp_output_folder,"stands_highest_tree_tmp.gpkg")
     highest_point_clip_path = os.path.join(working_root,"stands_highest_tree.gpkg")
@@ -172,3 +180,244 @@ def eliminate_gaps(working_root, tmp_output_folder, perimeter, del_tmp=True):
         delete_shapefile(gaps_tmp_path)
         delete_shapefile(union_tmp_path)
         delete_shapefile(in_shape_path)
+
+
+def fill_gaps_nearest(labels, gaps):
+    """
+    Fill gap cells with the label of the nearest labelled cell (city block distance). The gaps are filled from their
+    border inwards, a cell takes the majority label of its labelled 4-neighbours (the first one on ties).
+    Gap cells without connection to a labelled cell stay 0.
+
+    :param labels: 2d array with the labels (> 0), changed in place
+    :param gaps: 2d boolean array with the cells to fill
+    """
+    n_rows, n_cols = labels.shape
+    flat = labels.reshape(-1)
+    idx = np.flatnonzero(gaps & (labels == 0))
+    while idx.size:
+        rows, cols = np.divmod(idx, n_cols)
+        neighbours = np.zeros((idx.size, 4), dtype=labels.dtype)
+        for i, (m_inside, offset) in enumerate(((rows > 0, -n_cols), (rows < n_rows - 1, n_cols),
+                                                (cols > 0, -1), (cols < n_cols - 1, 1))):
+            neighbours[m_inside, i] = flat[idx[m_inside] + offset]
+        # number of labelled neighbours with the same label
+        counts = np.zeros((idx.size, 4), dtype=np.int8)
+        for i in range(4):
+            counts[:, i] = (neighbours == neighbours[:, i:i + 1]).sum(axis=1) * (neighbours[:, i] > 0)
+        m_fill = counts.max(axis=1) > 0
+        if not m_fill.any():
+            break
+        # all cells of a distance step are filled at once
+        flat[idx[m_fill]] = neighbours[m_fill, np.argmax(counts[m_fill], axis=1)]
+        idx = idx[~m_fill]
+
+
+def rasterize_perimeter(perimeter, reference_raster, all_touched=False):
+    """
+    :param perimeter: Perimeter polygons (QGIS layer source, e.g. "forest.gpkg|layername=forest")
+    :param reference_raster: Raster file defining extent, resolution and projection (same CRS as the perimeter)
+    :param all_touched: Cells touched by the perimeter instead of the cells whose center is within the perimeter
+    :return: 2d boolean array with the cells within the perimeter
+    """
+    path, _, options = perimeter.partition("|")
+    layer_name = dict(option.split("=", 1) for option in options.split("|") if "=" in option).get("layername")
+    ref_ds = gdal.Open(reference_raster, gdal.GA_ReadOnly)
+    mask_ds = gdal.GetDriverByName("MEM").Create("", ref_ds.RasterXSize, ref_ds.RasterYSize, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform(ref_ds.GetGeoTransform())
+    mask_ds.SetProjection(ref_ds.GetProjection())
+    ref_ds = None
+    vector_ds = gdal.OpenEx(path, gdal.OF_VECTOR)
+    layer = vector_ds.GetLayerByName(layer_name) if layer_name else vector_ds.GetLayer()
+    gdal.RasterizeLayer(mask_ds, [1], layer, burn_values=[1], options=["ALL_TOUCHED=TRUE"] if all_touched else [])
+    vector_ds = None
+    return mask_ds.GetRasterBand(1).ReadAsArray() > 0
+
+
+def _get_polygon_parts(geom):
+    """:return: The polygon parts of a QGIS geometry (e.g. of an intersection) as multipolygon (may be empty)"""
+    if QgsWkbTypes.flatType(geom.wkbType()) == QgsWkbTypes.GeometryCollection:
+        geom = QgsGeometry.collectGeometry([part for part in geom.asGeometryCollection()
+                                            if part.type() == QgsWkbTypes.PolygonGeometry])
+    geom.convertToMultiType()
+    return geom
+
+
+def polygonize_raster(array, reference_ds, output_path, layer_name, field_name):
+    """
+    Polygonize the cells > 0 of an array into a GeoPackage layer (one polygon per connected area with the same value).
+
+    :param reference_ds: GDAL dataset defining geotransform and projection of the array
+    """
+    data_type = gdal.GDT_Byte if array.dtype == bool else gdal.GDT_UInt32
+    array_ds = gdal.GetDriverByName("MEM").Create("", reference_ds.RasterXSize, reference_ds.RasterYSize, 1,
+                                                  data_type)
+    array_ds.SetGeoTransform(reference_ds.GetGeoTransform())
+    array_ds.SetProjection(reference_ds.GetProjection())
+    band = array_ds.GetRasterBand(1)
+    band.WriteArray(array.astype(np.uint8) if array.dtype == bool else array)
+    polygons_ds = ogr.GetDriverByName("GPKG").CreateDataSource(output_path)
+    polygons_layer = polygons_ds.CreateLayer(layer_name, array_ds.GetSpatialRef(), ogr.wkbPolygon)
+    polygons_layer.CreateField(ogr.FieldDefn(field_name, ogr.OFTInteger64))
+    # cells with value 0 are masked
+    gdal.Polygonize(band, band, polygons_layer, 0, callback=None)
+    polygons_ds = None
+    band = None
+    array_ds = None
+
+
+def clip_to_perimeter_raster(working_root, tmp_output_folder, perimeter, reference_raster, exact_clip=True,
+                             del_tmp=True):
+    """
+    Clip the stands to the perimeter and eliminate the gaps between stands and perimeter with the gaps determined on
+    the grid of a raster instead of vector overlays (replaces clip_to_perimeter and eliminate_gaps): gap cells (within
+    the rasterized perimeter, but without stand) are assigned to the nearest stand (see fill_gaps_nearest),
+    polygonized and merged into the (vector) stands without the parts already covered by other stands.
+    Gaps without stand are removed.
+
+    :param reference_raster: Raster defining the grid (e.g. VHM 150cm)
+    :param exact_clip: Clip the stands with the perimeter (exact outer boundary). The gap cells are all cells touched
+                       by the perimeter, so the clip only trims the gap cells. Otherwise the outer boundary follows
+                       the cells whose center is within the perimeter: the stands crossing it are cut at the cell
+                       boundaries and no vector clip of the whole mosaic is needed.
+    """
+    print("--------------------------------------------")
+    print("START Clip to perimeter on raster and eliminate gaps...")
+
+    stands_merged_path = os.path.join(working_root, "stands_merged.gpkg")
+    output_shape_path = os.path.join(working_root, "stands_clipped.gpkg")
+    gaps_tmp_path = os.path.join(tmp_output_folder, "stands_clip_gaps_tmp.gpkg")
+    mask_tmp_path = os.path.join(tmp_output_folder, "stands_clip_perimeter_tmp.gpkg")
+
+    ########################################
+    # Gap cells of the perimeter and the nearest stand
+    print("rasterizing stands and perimeter...")
+    label_ds = gdal.Open(get_stand_id_raster(stands_merged_path, reference_raster, tmp_output_folder),
+                         gdal.GA_ReadOnly)
+    labels = label_ds.GetRasterBand(1).ReadAsArray()
+    m_perimeter = rasterize_perimeter(perimeter, reference_raster, all_touched=exact_clip)
+    m_gaps = m_perimeter & (labels == 0)
+    # stand cells outside the perimeter are clipped, they don't fill gaps
+    labels[~m_perimeter] = 0
+
+    print("filling gaps...")
+    fill_gaps_nearest(labels, m_gaps)
+    labels[~m_gaps] = 0
+    del m_gaps
+
+    ########################################
+    # Polygonize the filled gaps and (without exact clip) the rasterized perimeter
+    print("polygonizing gaps...")
+    polygonize_raster(labels, label_ds, gaps_tmp_path, "gaps", "stand_id")
+    del labels
+    n_rows, n_cols = m_perimeter.shape
+    x_origin, cell_width, _, y_origin, _, cell_height = label_ds.GetGeoTransform()
+    if not exact_clip:
+        polygonize_raster(m_perimeter, label_ds, mask_tmp_path, "perimeter", "inside")
+        mask_index = QgsSpatialIndex(QgsVectorLayer(mask_tmp_path, "perimeter_polygons", "ogr").getFeatures(),
+                                     flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+    label_ds = None
+
+    stands_layer = QgsVectorLayer(stands_merged_path, "stands_merged", "ogr")
+    stand_index = QgsSpatialIndex(stands_layer.getFeatures(), flags=QgsSpatialIndex.FlagStoreFeatureGeometries)
+
+    # the gap cells may partly cover stands (cell center outside of all stands), only the gap area is added
+    gap_geometries = {}
+    for f in QgsVectorLayer(gaps_tmp_path, "gaps_polygons", "ogr").getFeatures():
+        geom = f.geometry()
+        for stand_id in stand_index.intersects(geom.boundingBox()):
+            stand_geom = stand_index.geometry(stand_id)
+            if geom.intersects(stand_geom):
+                geom = geom.difference(stand_geom)
+        geom = _get_polygon_parts(geom)
+        if not geom.isEmpty():
+            gap_geometries.setdefault(f["stand_id"], []).append(geom)
+
+    def is_within_perimeter(rect):
+        # all cells intersecting the rectangle are within the rasterized perimeter
+        col_min = int(np.floor((rect.xMinimum() - x_origin) / cell_width))
+        col_max = int(np.ceil((rect.xMaximum() - x_origin) / cell_width))
+        row_min = int(np.floor((rect.yMaximum() - y_origin) / cell_height))
+        row_max = int(np.ceil((rect.yMinimum() - y_origin) / cell_height))
+        if col_min < 0 or row_min < 0 or col_max > n_cols or row_max > n_rows:
+            return False
+        return bool(m_perimeter[row_min:row_max, col_min:col_max].all())
+
+    ########################################
+    # Merge the gaps into the stands, the stands keep their attributes and geometry
+    print("eliminate gaps...")
+    fields_to_keep = ["OBJECTID", "area_m2", "hmax_eff", "hp80", "FID_orig", "ID", "hmax", "hdom", "type"]
+    fields = QgsFields()
+    for field in stands_layer.fields():
+        if field.name() in fields_to_keep:
+            fields.append(field)
+    clipped_layer = QgsMemoryProviderUtils.createMemoryLayer("stands_clipped", fields, QgsWkbTypes.MultiPolygon,
+                                                             stands_layer.crs())
+    out_features = []
+    for f in stands_layer.getFeatures():
+        geom = f.geometry()
+        # without exact clip, the stands crossing the rasterized perimeter are cut at its cell boundaries
+        if not exact_clip and not is_within_perimeter(geom.boundingBox()):
+            rect = geom.boundingBox()
+            mask_parts = [mask_index.geometry(i).clipped(rect) for i in mask_index.intersects(rect)]
+            if not mask_parts:
+                continue
+            geom = _get_polygon_parts(geom.intersection(QgsGeometry.unaryUnion(mask_parts)))
+            if geom.isEmpty() and f.id() not in gap_geometries:
+                continue
+        if f.id() in gap_geometries:
+            geom = QgsGeometry.unaryUnion([part for part in [geom] + gap_geometries[f.id()] if not part.isEmpty()])
+        geom.convertToMultiType()
+        out_feature = QgsFeature(fields)
+        out_feature.setAttributes([f[field.name()] for field in fields])
+        out_feature.setGeometry(geom)
+        out_features.append(out_feature)
+    clipped_layer.dataProvider().addFeatures(out_features)
+    del m_perimeter
+
+    if exact_clip:
+        param = {'INPUT': clipped_layer, 'OVERLAY': perimeter, 'OUTPUT': output_shape_path}
+        processing.run("native:clip", param)
+    else:
+        ctc = QgsProject.instance().transformContext()
+        QgsVectorFileWriter.writeAsVectorFormatV3(clipped_layer, output_shape_path, ctc,
+                                                  getVectorSaveOptions('GPKG', 'utf-8'))
+
+    clip_highest_trees(working_root, tmp_output_folder, perimeter, del_tmp=del_tmp)
+
+    print("DONE!")
+
+    # Delete layers
+    if del_tmp:
+        delete_geopackage(gaps_tmp_path)
+        delete_geopackage(mask_tmp_path)
+
+
+def clip_to_perimeter_tiled(working_root, tmp_output_folder, perimeter, tile_size, n_processes=None, del_tmp=True):
+    """
+    Clip the stands to the perimeter and eliminate the gaps (same result as clip_to_perimeter and eliminate_gaps) on
+    a regular grid of tiles in parallel processes (see tiled_overlay.clip_to_perimeter_tiled).
+
+    :param tile_size: Tile size in map units
+    :param n_processes: Number of worker processes (None: number of CPUs)
+    """
+    print("--------------------------------------------")
+    print("START Clip to perimeter and eliminate gaps in tiles...")
+
+    stands_merged_path = os.path.join(working_root, "stands_merged.gpkg")
+    output_shape_path = os.path.join(working_root, "stands_clipped.gpkg")
+
+    stands_layer = QgsVectorLayer(stands_merged_path, "stands_merged", "ogr")
+    perimeter_layer = QgsVectorLayer(perimeter, "perimeter", "ogr")
+    clipped_layer = clip_stands_tiled(stands_layer, perimeter_layer, tile_size, n_processes)
+
+    # keep only major fields
+    fields_to_keep = ["OBJECTID", "area_m2", "hmax_eff", "hp80", "FID_orig", "ID", "hmax", "hdom", "type"]
+    delete_fields(clipped_layer, [field.name() for field in clipped_layer.fields() if field.name() not in fields_to_keep])
+
+    ctc = QgsProject.instance().transformContext()
+    QgsVectorFileWriter.writeAsVectorFormatV3(clipped_layer, output_shape_path, ctc,
+                                              getVectorSaveOptions('GPKG', 'utf-8'))
+
+    clip_highest_trees(working_root, tmp_output_folder, perimeter, del_tmp=del_tmp)
+
+    print("DONE!")
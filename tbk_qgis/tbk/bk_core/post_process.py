@@ -39,9 +39,48 @@ import os
 from qgis.core import *
 
 from tbk_qgis.tbk.utility.tbk_utilities import *
-
-
-def post_process(working_root, tmp_output_folder, min_area, simplification_tolerance=8, del_tmp=True):
+from tbk_qgis.tbk.utility.stand_graph import eliminate_selected_polygons
+from tbk_qgis.tbk.utility.mosaic_simplification import simplify_polygon_mosaic
+
+
+def update_stand_attributes(layer, delete_field_names=()):
+    """
+    Set the attributes of the simplified stands in one pass over the layer (changed in place):
+    area_m2 = area of the geometry, hmax = hmax_eff and hdom = hp80 for remainders, FID_orig = OBJECTID.
+
+    :param layer: QgsVectorLayer with the stands (fields area_m2, type, hmax, hdom, hmax_eff, hp80, OBJECTID)
+    :param delete_field_names: Fields deleted afterwards
+    """
+    provider = layer.dataProvider()
+    if layer.fields().lookupField('FID_orig') < 0:
+        provider.addAttributes([QgsField('FID_orig', QVariant.Double, len=10, prec=0)])
+        layer.updateFields()
+    fields = layer.fields()
+    i_area = fields.lookupField('area_m2')
+    i_type = fields.lookupField('type')
+    i_hmax = fields.lookupField('hmax')
+    i_hdom = fields.lookupField('hdom')
+    i_hmax_eff = fields.lookupField('hmax_eff')
+    i_hp80 = fields.lookupField('hp80')
+    i_objectid = fields.lookupField('OBJECTID')
+    i_fid_orig = fields.lookupField('FID_orig')
+
+    changes = {}
+    for f in layer.getFeatures():
+        attributes = f.attributes()
+        values = {i_area: int(round(f.geometry().area())) if f.hasGeometry() else NULL,
+                  i_fid_orig: attributes[i_objectid] if i_objectid >= 0 else NULL}
+        if attributes[i_type] == 'remainder':
+            values[i_hmax] = attributes[i_hmax_eff]
+            values[i_hdom] = attributes[i_hp80]
+        changes[f.id()] = values
+    provider.changeAttributeValues(changes)
+
+    delete_fields(layer, delete_field_names)
+
+
+def post_process(working_root, tmp_output_folder, min_area, simplification_tolerance=8, del_tmp=True,
+                 n_processes=None):
     # -------- INIT -------#
     print("--------------------------------------------")
     print("START post processing...")
@@ -105,9 +144,8 @@ def post_process(working_root, tmp_output_folder, min_area, simplification_toler
 
     tmp_reduced_path = os.path.join(tmp_output_folder, tmp_reduced)
 
-    ##Does not persist results when writing directly to file
-    param = {'INPUT': stand_boundaries_layer, 'MODE': 2, 'OUTPUT': 'memory:'}
-    algoOutput = processing.run("qgis:eliminateselectedpolygons", param)
+    # merge into neighbour with longest common boundary (same as qgis:eliminateselectedpolygons MODE 2)
+    algoOutput = {'OUTPUT': eliminate_selected_polygons(stand_boundaries_layer)}
 
     ctc = QgsProject.instance().transformContext()
     QgsVectorFileWriter.writeAsVectorFormatV3(algoOutput['OUTPUT'], tmp_reduced_path, ctc,
@@ -137,28 +175,14 @@ def post_process(working_root, tmp_output_folder, min_area, simplification_toler
     tmp_simplified_path = os.path.join(tmp_output_folder, tmp_simplified)
     tmp_simplified_error_path = os.path.join(tmp_output_folder, tmp_simplified_error)
 
-    param = {'input': tmp_reduced_path, 'type': [0, 1, 2], 'cats': '', 'where': '', 'method': 0,
-             'threshold': simplification_tolerance, 'look_ahead': 7, 'reduction': 50, 'slide': 0.5, 'angle_thresh': 3,
-             'degree_thresh': 0, 'closeness_thresh': 0, 'betweeness_thresh': 0, 'alpha': 1, 'beta': 1, 'iterations': 1,
-             '-t': False, '-l': True, 'output': tmp_simplified_path, 'error': tmp_simplified_error_path,
-             'GRASS_REGION_PARAMETER': None, 'GRASS_SNAP_TOLERANCE_PARAMETER': -1, 'GRASS_MIN_AREA_PARAMETER': 0.0001,
-             'GRASS_OUTPUT_TYPE_PARAMETER': 0, 'GRASS_VECTOR_DSCO': '', 'GRASS_VECTOR_LCO': ''}
-    algoOutput = processing.run("grass7:v.generalize", param)
-
-    tmp_simplified_layer = QgsVectorLayer(tmp_simplified_path, "stand_boundaries_reduced", "ogr")
-
-    # Delete unimportant fields
-    # apparently these are some dummy fields created by grass
-    fields = ['cat', 'cat_', 'foo']
-    delete_fields(tmp_simplified_layer, fields)
+    # simplify the shared edges of the stands once (Douglas-Peucker, same as v.generalize method 0),
+    # the result has no gaps or overlaps and is valid without fixing the geometries
+    tmp_simplified_layer = simplify_polygon_mosaic(algoOutput['OUTPUT'], simplification_tolerance, n_processes)
 
     ########################################
     # Recalculate area
     print("recalculating area...")
-    param = {'INPUT': tmp_simplified_path, 'OUTPUT': 'memory:'}
-    algoOutput = processing.run("native:fixgeometries", param)
-
-    param = {'INPUT': algoOutput['OUTPUT'], 'FIELD_NAME': 'area_m2', 'FIELD_TYPE': 0, 'FIELD_LENGTH': 10,
+    param = {'INPUT': tmp_simplified_layer, 'FIELD_NAME': 'area_m2', 'FIELD_TYPE': 0, 'FIELD_LENGTH': 10,
              'FIELD_PRECISION': 3, 'NEW_FIELD': False, 'FORMULA': eArea, 'OUTPUT': 'memory:'}
     algoOutput = processing.run("qgis:fieldcalculator", param)
 
@@ -169,8 +193,7 @@ def post_process(working_root, tmp_output_folder, min_area, simplification_toler
 
     ########################################
     # Redo elimination of small polygons
-    # because sometimes it's not possible in one GO
-    # and simplification also alters polygon area
+    # because simplification alters polygon area
 
     # Create tmp layer
     tmp_simplified_layer = QgsVectorLayer(tmp_simplified_path, "stand_boundaries_simplified", "ogr")
@@ -181,68 +204,18 @@ def post_process(working_root, tmp_output_folder, min_area, simplification_toler
     # Execute Eliminate
     print("eliminating small polygons...")
 
-    ##Does not persist results when writing directly to file
-    param = {'INPUT': tmp_simplified_layer, 'MODE': 2, 'OUTPUT': 'memory:'}
-    algoOutput = processing.run("qgis:eliminateselectedpolygons", param)
+    algoOutput = {'OUTPUT': eliminate_selected_polygons(tmp_simplified_layer)}
 
     QgsVectorFileWriter.writeAsVectorFormatV3(algoOutput['OUTPUT'], tmp_reduced_path, ctc,
                                               getVectorSaveOptions('GPKG', 'utf-8'))
 
-    ########################################
-    # Recalculate area
-    print("recalculating area...")
-    param = {'INPUT': algoOutput['OUTPUT'], 'FIELD_NAME': 'area_m2', 'FIELD_TYPE': 0, 'FIELD_LENGTH': 10,
-             'FIELD_PRECISION': 3, 'NEW_FIELD': False, 'FORMULA': eArea, 'OUTPUT': 'memory:'}
-    algoOutput = processing.run("qgis:fieldcalculator", param)
-
     del tmp_simplified_layer
-    # QgsVectorFileWriter.writeAsVectorFormatV3(algoOutput['OUTPUT'],tmp_simplified_path,ctc,getVectorSaveOptions('GPKG','utf-8'))
-
-    ########################################
-    # Calculate hmax and hdom for remainders
-    print("calculating hmax and hdom for remainders...")
-    # Create tmp layer
-    # tmp_simplified_layer = QgsVectorLayer(tmp_simplified_path, "stand_boundaries_simplified", "ogr")
-    tmp_simplified_layer = algoOutput['OUTPUT']
-
-    # Select remainders and calculate hmax, hdom
-    param = {'INPUT': tmp_simplified_layer, 'FIELD': 'type', 'OPERATOR': 0, 'VALUE': 'remainder', 'METHOD': 0}
-    algoOutput = processing.run("qgis:selectbyattribute", param)
-
-    param = {'INPUT': algoOutput['OUTPUT'], 'FIELD_NAME': 'hmax', 'FIELD_TYPE': 0, 'FIELD_LENGTH': 10,
-             'FIELD_PRECISION': 3, 'NEW_FIELD': False, 'FORMULA': 'if(is_selected(),hmax_eff,hmax)',
-             'OUTPUT': 'memory:'}
-    algoOutput = processing.run("qgis:fieldcalculator", param)
-
-    param = {'INPUT': algoOutput['OUTPUT'], 'FIELD': 'type', 'OPERATOR': 0, 'VALUE': 'remainder', 'METHOD': 0}
-    algoOutput = processing.run("qgis:selectbyattribute", param)
-
-    param = {'INPUT': algoOutput['OUTPUT'], 'FIELD_NAME': 'hdom', 'FIELD_TYPE': 0, 'FIELD_LENGTH': 10,
-             'FIELD_PRECISION': 3, 'NEW_FIELD': False, 'FORMULA': 'if(is_selected(),hp80,hdom)', 'OUTPUT': 'memory:'}
-    algoOutput = processing.run("qgis:fieldcalculator", param)
-
-    # with edit(tmp_simplified_layer):
-    #         for f in tmp_simplified_layer.getFeatures():
-    #             if f['type'] == "remainder":
-    #                 f['hmax'] == f['hmax_eff']
-    #                 f['hdom'] == f['hp80']
-    #                 tmp_simplified_layer.updateFeature(f)
 
     ########################################
-    # Prepare for further analysis of neighbours
-    param = {'INPUT': algoOutput['OUTPUT'], 'FIELD_NAME': 'FID_orig', 'FIELD_TYPE': 1, 'FIELD_LENGTH': 10,
-             'FIELD_PRECISION': 0, 'OUTPUT': 'memory:'}
-    algoOutput = processing.run("qgis:addfieldtoattributestable", param)
-    ##May be the wrong field!
-    param = {'INPUT': algoOutput['OUTPUT'], 'FIELD_NAME': 'FID_orig', 'FIELD_TYPE': 0, 'FIELD_LENGTH': 10,
-             'FIELD_PRECISION': 3, 'NEW_FIELD': False, 'FORMULA': 'OBJECTID', 'OUTPUT': 'memory:'}
-    algoOutput = processing.run("qgis:fieldcalculator", param)
-
-    # Delete fields
+    # Recalculate area, calculate hmax and hdom for remainders and prepare for further analysis of neighbours
+    print("recalculating area, calculating hmax and hdom for remainders...")
     mLayer = algoOutput['OUTPUT']
-    fields = ['hmax_eff', 'hp80']
-    if del_tmp:
-        delete_fields(mLayer, fields)
+    update_stand_attributes(mLayer, delete_field_names=['hmax_eff', 'hp80'] if del_tmp else [])
 
     shape_out_path = os.path.join(working_root, shape_out)
     QgsVectorFileWriter.writeAsVectorFormatV3(mLayer, shape_out_path, ctc,
@@ -30,6 +30,8 @@ from osgeo import gdal, osr
 from osgeo.gdalconst import *
 import numpy as np
 from tbk_qgis.tbk.bk_core.Classification import ClassificationHelper as CH
+from tbk_qgis.tbk.utility.tbk_utilities import get_process_pool
+from concurrent.futures import as_completed
 import time
 import logging
 from datetime import datetime
@@ -54,7 +56,15 @@ def run_stand_classification(workingRoot,
                              min_cells_per_stand=10,
                              min_cells_per_pure_stand=30,
                              vhm_min_height=0,
-                             vhm_max_height=60):
+                             vhm_max_height=60,
+                             vectorized_classification=True,
+                             tile_size=0,
+                             tile_halo=50,
+                             n_processes=None,
+                             zone_parallel=False,
+                             preview=False,
+                             preview_window=None,
+                             preview_scale=1):
     '''
     Run stand classification based on VHM input raster.
 
@@ -72,6 +82,18 @@ def run_stand_classification(workingRoot,
     :param min_cells_per_pure_stand: Min amount of cells to be classified as pure mixture stand if option is chosen.
     :param vhm_min_height: Min VHM height in meters for cells to be processed -> set to zero
     :param vhm_max_height: Max VHM height in meters for cells to be processed -> set to zero
+    :param vectorized_classification: Use the vectorized classification engine (same result, much faster).
+    :param tile_size: Tile size in pixels for tiled classification in parallel processes. Use 0 to classify at once.
+    :param tile_halo: Overlap of the tiles in pixels. Stands can grow at most this far beyond their tile.
+    :param n_processes: Number of processes for tiled or zone-wise classification. Use None for the number of CPUs.
+    :param zone_parallel: Classify the zones of zoneRasterFile independently in parallel processes (same stands as
+                          without, stand IDs are assigned zone by zone). Has no effect without zoneRasterFile.
+    :param preview: Only classify (preview_window / preview_scale) for parameter tuning. The stand raster is saved as
+                    classified_preview.tif, smoothing, polygonize and stand attributes are skipped.
+    :param preview_window: Window (xoff, yoff, xsize, ysize) in pixels to classify in preview mode. None: whole VHM.
+    :param preview_scale: Downsampling factor of the VHM in preview mode (search windows and min. cells per stand
+                          are scaled to match).
+    :return: Output directory, in preview mode the stand raster and summary statistics (see classify_preview).
     '''
 
     # -------- INIT --------#
@@ -111,86 +133,74 @@ def run_stand_classification(workingRoot,
     logging.info('Output path: %s' % out_path)
     logging.info('VHM path: %s' % inputRasterFile)
 
-    # Opening the raster file and getting band 1 as numpy array
+    # Opening the raster file and getting the raster information
     if not os.path.exists(inputRasterFile):
         sys.exit(f"Error: Raster input file {inputRasterFile} not found!")
     ds = gdal.Open(inputRasterFile, GA_ReadOnly)
-    band = ds.GetRasterBand(1)
-    data = band.ReadAsArray().astype(float)  # format: data[row, col] -> data[y, x]
+    n_rows, n_cols = ds.RasterYSize, ds.RasterXSize
 
     # Get and print main input raster information
     geotransform = ds.GetGeoTransform()
     projectionfrom = ds.GetProjection()
     print("VHM raster info: %s bands, %s rows x %s cols, %s resolution, X: %s, Y: %s, CRS: %s"
-          % (ds.RasterCount, data.shape[0], data.shape[1], geotransform[1], round(geotransform[0], 2),
+          % (ds.RasterCount, n_rows, n_cols, geotransform[1], round(geotransform[0], 2),
              round(geotransform[3], 2), osr.SpatialReference(wkt=projectionfrom).GetAttrValue('projcs')))
 
-    # get NoData value
-    nodata_value = band.GetNoDataValue()
-
-    # set unrealistically low or height values to zero
-    tmp_zero_mask = (data < vhm_min_height) | (data > vhm_max_height)
-    data[tmp_zero_mask & (data != nodata_value)] = 0
-    # set NoData value to -128, so it will not be processed
-    data[data == nodata_value] = -128
-
-    # Get sorted list of pixel values (biggest value=largest tree on top)
-    dataList = CH.getSortedList(data, data.size)
-
-    # Init stand, hmax, hdom arrays
-    stand = np.zeros(data.shape, dtype=int)
-    hmax = np.zeros(data.shape, dtype=float)
-    hdom = np.zeros(data.shape, dtype=float)
-
-    # Init list to store stand information [ID, hmax, hdom]
-    standList = list()
-
-    # if provided, load coniferous raster
-    coniferous = None
-    if coniferousRasterFile:
-        ds = gdal.Open(coniferousRasterFile, GA_ReadOnly)
-        band = ds.GetRasterBand(1)
-        coniferous = band.ReadAsArray().astype(int)  # format: data[row, col] -> data[y, x]
-        # logging.info('read coniferousRasterFile as ' + type(coniferous))
-        if not CH.compare_raster(inputRasterFile, coniferousRasterFile):
-            logging.warning("VHM and MG raster have different extents and/or projections!")
-
-    # if provided, load zone raster
-    zone = np.ones(data.shape, dtype=int)
-    if zoneRasterFile:
-        ds = gdal.Open(zoneRasterFile, GA_ReadOnly)
-        band = ds.GetRasterBand(1)
-        zone = band.ReadAsArray().astype(int)  # format: data[row, col] -> data[y, x]
-        logging.info('read zone as ' + type(zone))
-        if not CH.compare_raster(inputRasterFile, zoneRasterFile):
-            logging.warning("VHM and ZONE raster have different extents and/or projections!")
-
-    print("--- %s minutes, input data loaded---" % round((time.time() - start_time) / 60, 2))
+    if coniferousRasterFile and not CH.compare_raster(inputRasterFile, coniferousRasterFile):
+        logging.warning("VHM and MG raster have different extents and/or projections!")
+    if zoneRasterFile and not CH.compare_raster(inputRasterFile, zoneRasterFile):
+        logging.warning("VHM and ZONE raster have different extents and/or projections!")
+
+    # parameters of the stand classification (same for all tiles)
+    classification_params = {'min_tol': min_tol, 'max_tol': max_tol, 'min_corr': min_corr, 'max_corr': max_corr,
+                             'min_valid_cells': min_valid_cells, 'min_cells_per_stand': min_cells_per_stand,
+                             'min_cells_per_pure_stand': min_cells_per_pure_stand,
+                             'vectorized_classification': vectorized_classification}
+
+    # ------- PREVIEW -------#
+
+    if preview:
+        stand, stats, preview_geotransform = classify_preview(inputRasterFile, coniferousRasterFile, zoneRasterFile,
+                                                              vhm_min_height, vhm_max_height, classification_params,
+                                                              geotransform, preview_window, preview_scale)
+        outputPreviewFilePath = os.path.join(out_path, 'classified_preview.tif')
+        CH.store_raster(stand, outputPreviewFilePath, projectionfrom, preview_geotransform, gdal.GDT_UInt32)
+        print("File %s saved" % outputPreviewFilePath)
+        logging.info("Preview: %s stands, %s %% remainder, stand size histogram [m2]: %s"
+                     % (stats['n_stands'], round(stats['remainder_share'] * 100, 1),
+                        list(zip(stats['size_bins_m2'][:-1], stats['size_histogram']))))
+        print("--- %s minutes, preview classification finished ---" % round((time.time() - start_time) / 60, 2))
+        return stand, stats
 
     # ------- STAND CLASSIFICATION -------#
 
-    # Init stand number with one
-    standNbr = 1
-
-    if coniferous is not None:
-        print("pre-classification with mixture information...")
-        stand, standNbr, standList, hdom, hmax = classify_pixels(data, dataList, standNbr,
-                                                                 min_tol, max_tol, min_corr, max_corr, min_valid_cells,
-                                                                 min_cells_per_pure_stand,
-                                                                 zone, coniferous,
-                                                                 stand, standList, hdom, hmax)
-
-    print("classification without mixture information...")
-    stand, standNbr, standList, hdom, hmax = classify_pixels(data, dataList, standNbr,
-                                                             min_tol, max_tol, min_corr, max_corr, min_valid_cells,
-                                                             min_cells_per_stand,
-                                                             zone, None,
-                                                             stand, standList, hdom, hmax)
+    if zone_parallel and zoneRasterFile:
+        if tile_size > 0:
+            print("zone-wise classification, tile_size %s is ignored (zones are classified as a whole)" % tile_size)
+        print("zone-wise classification...")
+        stand, standNbr, standList, hdom, hmax, valid = classify_zones(inputRasterFile, coniferousRasterFile,
+                                                                       zoneRasterFile, vhm_min_height,
+                                                                       vhm_max_height, classification_params,
+                                                                       n_processes)
+    elif tile_size > 0:
+        print("tiled classification (%s x %s pixels, halo %s pixels)..." % (tile_size, tile_size, tile_halo))
+        stand, standNbr, standList, hdom, hmax, valid = classify_tiled(inputRasterFile, coniferousRasterFile,
+                                                                       zoneRasterFile, n_rows, n_cols,
+                                                                       vhm_min_height, vhm_max_height,
+                                                                       classification_params,
+                                                                       tile_size, tile_halo, n_processes)
+    else:
+        data, coniferous, zone = read_classification_input(inputRasterFile, coniferousRasterFile, zoneRasterFile,
+                                                           vhm_min_height, vhm_max_height)
+        print("--- %s minutes, input data loaded---" % round((time.time() - start_time) / 60, 2))
+
+        stand, standNbr, standList, hdom, hmax = classify_stands(data, zone, coniferous, **classification_params)
+        valid = data >= 0
 
     print("--- %s minutes, classification finished ---" % round((time.time() - start_time) / 60, 2))
 
     # classify all value not classified till now (assign standNbr - is last stand +1)
-    m_tmp = (data >= 0) & (stand == 0)
+    m_tmp = valid & (stand == 0)
     stand[m_tmp] = standNbr
 
     # Save raw classification file
@@ -222,18 +232,12 @@ def run_stand_classification(workingRoot,
 
     # ------- POLYGONIZE, ADD ATTRIBUTES -------#
 
-    # polygonize the raster -> to vector file
-    CH.polygonize(outputSmooth2FilePath, outputVectorFilePath)
-    print("--- %s minutes, vector file saved ---" % round((time.time() - start_time) / 60, 2))
-
-    # add stand information to polygon vector file
-    CH.add_stand_attributes(outputVectorFilePath, standList, standNbr)
-    print("--- %s minutes, stand attributes added ---" % round((time.time() - start_time) / 60, 2))
-
-    # zonal statistics for vhm per polygon, which is later used to calculate remainder hmax & hdom
+    # polygonize the raster -> to vector file, with stand information and zonal statistics for vhm per polygon
+    # (later used to calculate remainder hmax & hdom)
     print("stats input file path", inputRasterFile)
-    CH.add_vhm_stats(outputVectorFilePath, inputRasterFile)
-    print("--- %s minutes, vhm stats calculated ---" % round((time.time() - start_time) / 60, 2))
+    CH.polygonize_stands(outputSmooth2FilePath, outputVectorFilePath, standList, standNbr, inputRasterFile)
+    print("--- %s minutes, vector file with stand attributes and vhm stats saved ---" %
+          round((time.time() - start_time) / 60, 2))
 
     # DONE
     print('DONE ! ')
@@ -242,8 +246,491 @@ def run_stand_classification(workingRoot,
     return out_path
 
 
+def read_classification_input(inputRasterFile,
+                              coniferousRasterFile,
+                              zoneRasterFile,
+                              vhm_min_height,
+                              vhm_max_height,
+                              window=None):
+    '''
+    Read VHM, coniferous and zone raster (or a window of them) and prepare them for the stand classification.
+
+    :param window: Window (xoff, yoff, xsize, ysize) to read. Use None to read the whole rasters.
+    :return: data, coniferous (None if not provided), zone
+    '''
+    if window is None:
+        window = ()
+
+    ds = gdal.Open(inputRasterFile, GA_ReadOnly)
+    band = ds.GetRasterBand(1)
+    data = band.ReadAsArray(*window).astype(float)  # format: data[row, col] -> data[y, x]
+
+    # get NoData value
+    nodata_value = band.GetNoDataValue()
+
+    # set unrealistically low or height values to zero
+    tmp_zero_mask = (data < vhm_min_height) | (data > vhm_max_height)
+    data[tmp_zero_mask & (data != nodata_value)] = 0
+    # set NoData value to -128, so it will not be processed
+    data[data == nodata_value] = -128
+
+    # if provided, load coniferous raster
+    coniferous = None
+    if coniferousRasterFile:
+        ds = gdal.Open(coniferousRasterFile, GA_ReadOnly)
+        band = ds.GetRasterBand(1)
+        coniferous = band.ReadAsArray(*window).astype(int)  # format: data[row, col] -> data[y, x]
+
+    # if provided, load zone raster
+    zone = np.ones(data.shape, dtype=int)
+    if zoneRasterFile:
+        ds = gdal.Open(zoneRasterFile, GA_ReadOnly)
+        band = ds.GetRasterBand(1)
+        zone = band.ReadAsArray(*window).astype(int)  # format: data[row, col] -> data[y, x]
+
+    return data, coniferous, zone
+
+
+def downsample_classification_input(data, coniferous, zone, scale):
+    '''
+    Downsample the classification input by an integer factor (rows/cols not filling a whole block are cut off).
+    Heights are averaged over the valid cells of a block (NoData if there are none), mixture values are averaged and
+    the zone of the center cell is used.
+
+    :return: data, coniferous (None if not provided), zone
+    '''
+    n_rows, n_cols = data.shape[0] // scale, data.shape[1] // scale
+
+    def blocks(array):
+        return array[:n_rows * scale, :n_cols * scale].reshape(n_rows, scale, n_cols, scale)
+
+    data_blocks = blocks(data)
+    m_valid = data_blocks >= 0
+    n_valid = np.count_nonzero(m_valid, axis=(1, 3))
+    data_sum = np.sum(np.where(m_valid, data_blocks, 0), axis=(1, 3))
+    data = np.where(n_valid > 0, data_sum / np.maximum(n_valid, 1), -128)
+    if coniferous is not None:
+        coniferous = np.rint(np.mean(blocks(coniferous), axis=(1, 3))).astype(int)
+    zone = blocks(zone)[:, scale // 2, :, scale // 2]
+    return data, coniferous, zone
+
+
+def classify_preview(inputRasterFile,
+                     coniferousRasterFile,
+                     zoneRasterFile,
+                     vhm_min_height,
+                     vhm_max_height,
+                     classification_params,
+                     geotransform,
+                     window=None,
+                     scale=1):
+    '''
+    Fast stand classification of a window and/or a downsampled VHM to tune the classification parameters.
+
+    :param window: Window (xoff, yoff, xsize, ysize) in pixels to classify. Use None for the whole VHM.
+    :param scale: Downsampling factor (integer). Search windows and min. cells per stand are scaled to match.
+    :return: stand (remainder included), stats (dict with n_stands, size_bins_m2, size_histogram, remainder_share),
+             geotransform of the stand raster
+    '''
+    scale = max(1, int(scale))
+    data, coniferous, zone = read_classification_input(inputRasterFile, coniferousRasterFile, zoneRasterFile,
+                                                       vhm_min_height, vhm_max_height, window)
+    params = dict(classification_params)
+    if scale > 1:
+        data, coniferous, zone = downsample_classification_input(data, coniferous, zone, scale)
+        for name in ('min_cells_per_stand', 'min_cells_per_pure_stand'):
+            # at least one cell, otherwise empty stands are counted
+            params[name] = max(1, int(round(params[name] / (scale * scale))))
+
+    stand, standNbr, standList, hdom, hmax = classify_stands(data, zone, coniferous, **params, window_scale=scale)
+    valid = data >= 0
+    stand[valid & (stand == 0)] = standNbr
+
+    # summary statistics
+    cell_area = abs(geotransform[1] * geotransform[5]) * scale * scale
+    stand_area = np.bincount(stand.ravel(), minlength=standNbr + 1)[1:standNbr] * cell_area
+    size_bins_m2 = [0, 1000, 2500, 5000, 10000, 25000, 50000, 100000, np.inf]
+    n_valid = np.count_nonzero(valid)
+    stats = {'n_stands': standNbr - 1,
+             'size_bins_m2': size_bins_m2,
+             'size_histogram': np.histogram(stand_area, bins=size_bins_m2)[0].tolist(),
+             'remainder_share': float(np.count_nonzero(stand == standNbr) / n_valid) if n_valid > 0 else 0.0}
+
+    xoff, yoff = (window[0], window[1]) if window else (0, 0)
+    preview_geotransform = (geotransform[0] + xoff * geotransform[1] + yoff * geotransform[2],
+                            geotransform[1] * scale, geotransform[2] * scale,
+                            geotransform[3] + xoff * geotransform[4] + yoff * geotransform[5],
+                            geotransform[4] * scale, geotransform[5] * scale)
+    return stand, stats, preview_geotransform
+
+
+def classify_stands(data,
+                    zone,
+                    coniferous,
+                    min_tol,
+                    max_tol,
+                    min_corr,
+                    max_corr,
+                    min_valid_cells,
+                    min_cells_per_stand,
+                    min_cells_per_pure_stand,
+                    vectorized_classification=True,
+                    standSeeds=None,
+                    seed_zone=None,
+                    window_scale=1,
+                    standPasses=None):
+    '''
+    Stand classification of a VHM (first with, then without mixture information).
+
+    :param standSeeds: If a list is provided, the flat index of the starting cell of each stand is appended.
+    :param standPasses: If a list is provided, the classification pass of each stand is appended (0: with, 1: without
+                        mixture information).
+    :param seed_zone: If provided, only cells of this zone are used as starting cells (-> only stands of this zone).
+    :param window_scale: Pixel size relative to the 10m VHM (search windows are scaled accordingly).
+    :return: stand, standNbr (next free stand number), standList ([ID, hmax, hdom] per stand), hdom, hmax
+    '''
+    # Get seed order of pixels (flat index, biggest value=largest tree first), shared by both classification passes
+    seeds = CH.getSeedOrder(data)
+    if seed_zone is not None:
+        seeds = seeds[np.ascontiguousarray(zone).ravel()[seeds] == seed_zone]
+
+    # Init stand, hmax, hdom arrays
+    stand = np.zeros(data.shape, dtype=int)
+    hmax = np.zeros(data.shape, dtype=float)
+    hdom = np.zeros(data.shape, dtype=float)
+
+    # Init list to store stand information [ID, hmax, hdom]
+    standList = list()
+
+    # Init stand number with one
+    standNbr = 1
+
+    # select classification engine
+    classify = classify_pixels_vectorized if vectorized_classification else classify_pixels
+
+    if coniferous is not None:
+        print("pre-classification with mixture information...")
+        stand, standNbr, standList, hdom, hmax = classify(data, seeds, standNbr,
+                                                          min_tol, max_tol, min_corr, max_corr, min_valid_cells,
+                                                          min_cells_per_pure_stand,
+                                                          zone, coniferous,
+                                                          stand, standList, hdom, hmax, standSeeds,
+                                                          window_scale=window_scale)
+        if standPasses is not None:
+            standPasses.extend([0] * (standNbr - 1))
+
+    print("classification without mixture information...")
+    stand, standNbr, standList, hdom, hmax = classify(data, seeds, standNbr,
+                                                      min_tol, max_tol, min_corr, max_corr, min_valid_cells,
+                                                      min_cells_per_stand,
+                                                      zone, None,
+                                                      stand, standList, hdom, hmax, standSeeds,
+                                                      window_scale=window_scale)
+    if standPasses is not None:
+        standPasses.extend([1] * (standNbr - 1 - len(standPasses)))
+    return stand, standNbr, standList, hdom, hmax
+
+
+def classify_tile(tile):
+    '''
+    Stand classification of one tile (incl. halo), run in a worker process by classify_tiled.
+
+    :param tile: Dict with input files, window (xoff, yoff, xsize, ysize), VHM height limits and
+                 classification parameters.
+    :return: Dict with the tile window, the local stand raster and standList, the starting cells and classification
+             passes of the stands, and the VHM of the tile.
+    '''
+    data, coniferous, zone = read_classification_input(tile['inputRasterFile'], tile['coniferousRasterFile'],
+                                                       tile['zoneRasterFile'], tile['vhm_min_height'],
+                                                       tile['vhm_max_height'], tile['window'])
+    standSeeds = list()
+    standPasses = list()
+    stand, standNbr, standList, hdom, hmax = classify_stands(data, zone, coniferous, **tile['classification_params'],
+                                                             standSeeds=standSeeds, standPasses=standPasses)
+    return {'window': tile['window'],
+            'stand': stand.astype(np.uint32),
+            'standList': standList,
+            'standSeeds': standSeeds,
+            'standPasses': standPasses,
+            'data': data.astype(np.float32)}
+
+
+def classify_tiled(inputRasterFile,
+                   coniferousRasterFile,
+                   zoneRasterFile,
+                   n_rows,
+                   n_cols,
+                   vhm_min_height,
+                   vhm_max_height,
+                   classification_params,
+                   tile_size,
+                   tile_halo,
+                   n_processes=None):
+    '''
+    Tiled stand classification in parallel processes. The raster is split in tiles of tile_size pixels, each tile is
+    read and classified with a halo of tile_halo pixels, so stands can grow across the tile seams.
+
+    Stitching rule: a stand belongs to the tile containing its starting cell (stands started in the halo are dropped,
+    the neighbouring tile classifies them). Where stands of different tiles overlap, the stand with the higher
+    priority wins: stands of the classification with mixture information first, then the higher starting value
+    (hmax), for equal values the one which comes first in the seed order (see getSeedOrder). A stand whose starting
+    cell is won by a stand of higher priority is dropped (in the classification of the whole raster it would not
+    have been started), its cells stay unclassified. This approximates the classification of the whole raster: the
+    stands of a tile grow without the competition of the stands of the neighbouring tiles, cells lost at the seams
+    are not reassigned. The result does not depend on the processing order of the tiles. Stand IDs are assigned in
+    priority order, hdom is the mean height of the cells a stand keeps.
+
+    :return: stand, standNbr (next free stand number), standList ([ID, hmax, hdom] per stand), hdom, hmax, valid
+             (True/False raster of the cells with VHM data)
+    '''
+    tile_halo = max(0, tile_halo)
+    tiles = list()
+    for row in range(0, n_rows, tile_size):
+        for col in range(0, n_cols, tile_size):
+            row_start, row_end = max(0, row - tile_halo), min(n_rows, row + tile_size + tile_halo)
+            col_start, col_end = max(0, col - tile_halo), min(n_cols, col + tile_size + tile_halo)
+            tiles.append({'inputRasterFile': inputRasterFile,
+                          'coniferousRasterFile': coniferousRasterFile,
+                          'zoneRasterFile': zoneRasterFile,
+                          'window': (col_start, row_start, col_end - col_start, row_end - row_start),
+                          'core': (col, row, min(col + tile_size, n_cols), min(row + tile_size, n_rows)),
+                          'vhm_min_height': vhm_min_height,
+                          'vhm_max_height': vhm_max_height,
+                          'classification_params': classification_params})
+
+    print("classify %s tiles..." % len(tiles))
+    with get_process_pool(n_processes) as pool:
+        results = list(pool.map(classify_tile, tiles))
+
+    # --- collect the stands started within the core of their tile
+    tile_ids, local_ids, passes, hmax_values, seed_cells = [], [], [], [], []
+    valid = np.zeros((n_rows, n_cols), dtype=bool)
+    for tile_id, (tile, result) in enumerate(zip(tiles, results)):
+        xoff, yoff, xsize, ysize = tile['window']
+        core_col_start, core_row_start, core_col_end, core_row_end = tile['core']
+        valid[core_row_start:core_row_end, core_col_start:core_col_end] = \
+            result['data'][core_row_start - yoff:core_row_end - yoff, core_col_start - xoff:core_col_end - xoff] >= 0
+
+        for (local_id, hmax_stand, _), seed, stand_pass in zip(result['standList'], result['standSeeds'],
+                                                               result['standPasses']):
+            seed_row, seed_col = divmod(seed, xsize)
+            seed_row += yoff
+            seed_col += xoff
+            if core_row_start <= seed_row < core_row_end and core_col_start <= seed_col < core_col_end:
+                tile_ids.append(tile_id)
+                local_ids.append(local_id)
+                passes.append(stand_pass)
+                hmax_values.append(hmax_stand)
+                seed_cells.append(seed_row * n_cols + seed_col)
+
+    tile_ids = np.array(tile_ids, dtype=int)
+    local_ids = np.array(local_ids, dtype=int)
+    passes = np.array(passes, dtype=int)
+    hmax_values = np.array(hmax_values, dtype=float)
+    seed_cells = np.array(seed_cells, dtype=int)
+    n_stands = len(seed_cells)
+
+    # --- stitch: stand IDs in priority order (pass, hmax descending, then seed order), lower ID wins
+    priority = np.lexsort((-seed_cells, -hmax_values, passes))
+    stand_ids = np.empty(n_stands, dtype=int)
+    stand_ids[priority] = np.arange(1, n_stands + 1)
+    # local stand number -> stand ID per tile, starting cell per stand ID
+    luts = list()
+    for tile_id, result in enumerate(results):
+        m_tile = tile_ids == tile_id
+        lut = np.zeros(len(result['standList']) + 1, dtype=int)
+        lut[local_ids[m_tile]] = stand_ids[m_tile]
+        luts.append(lut)
+    seed_by_id = seed_cells[priority]
+    ids = np.arange(1, n_stands + 1)
+
+    def stitch(m_alive):
+        stand = np.zeros((n_rows, n_cols), dtype=int)
+        for tile, result, lut in zip(tiles, results, luts):
+            xoff, yoff, xsize, ysize = tile['window']
+            tile_stand = (lut * m_alive[lut])[result['stand']]
+            stand_sub = stand[yoff:yoff + ysize, xoff:xoff + xsize]
+            m_wins = (tile_stand > 0) & ((stand_sub == 0) | (tile_stand < stand_sub))
+            stand_sub[m_wins] = tile_stand[m_wins]
+        return stand
+
+    # drop the stands whose starting cell is won by a stand of higher priority. A stand is only dropped if the
+    # winner keeps its own starting cell (dropping stands frees cells, a dropped winner may release the cell).
+    m_alive = np.ones(n_stands + 1, dtype=bool)
+    m_alive[0] = False
+    while True:
+        stand = stitch(m_alive)
+        seed_owner = stand.ravel()[seed_by_id]
+        m_lost = m_alive[1:] & (seed_owner > 0) & (seed_owner < ids)
+        if not m_lost.any():
+            break
+        m_winner_lost = np.zeros(n_stands, dtype=bool)
+        m_winner_lost[m_lost] = m_lost[seed_owner[m_lost] - 1]
+        m_alive[1:][m_lost & ~m_winner_lost] = False
+
+    # hdom: mean height of the cells a stand keeps
+    hdom_sum = np.zeros(n_stands + 1, dtype=float)
+    n_cells = np.zeros(n_stands + 1, dtype=np.int64)
+    for tile, result in zip(tiles, results):
+        xoff, yoff, xsize, ysize = tile['window']
+        core_col_start, core_row_start, core_col_end, core_row_end = tile['core']
+        stand_core = stand[core_row_start:core_row_end, core_col_start:core_col_end].ravel()
+        data_core = result['data'][core_row_start - yoff:core_row_end - yoff,
+                                   core_col_start - xoff:core_col_end - xoff].ravel()
+        hdom_sum += np.bincount(stand_core, weights=data_core, minlength=n_stands + 1)
+        n_cells += np.bincount(stand_core, minlength=n_stands + 1)
+    del results
+
+    # --- remove stands which were dropped or lost all their cells and renumber consecutively
+    m_keep = n_cells[1:] > 0
+    new_ids = np.zeros(n_stands + 1, dtype=int)
+    new_ids[1:][m_keep] = np.arange(1, np.sum(m_keep) + 1)
+    seed_kept = seed_owner[m_keep] == ids[m_keep]
+    stand = new_ids[stand]
+
+    # stand information ordered by (new) ID
+    order = priority[m_keep]
+    standNbr = len(order) + 1
+    hdom_lut = np.zeros(standNbr, dtype=float)
+    hdom_lut[1:] = hdom_sum[1:][m_keep] / n_cells[1:][m_keep]
+    standList = [[i + 1, hmax_values[o], hdom_lut[i + 1]] for i, o in enumerate(order)]
+
+    # hmax at the starting cell (if the stand kept it), hdom for all cells of a stand
+    hmax = np.zeros((n_rows, n_cols), dtype=float)
+    hmax.ravel()[seed_cells[order][seed_kept]] = hmax_values[order][seed_kept]
+    hdom = hdom_lut[stand]
+
+    print("%s stands in %s tiles" % (standNbr - 1, len(tiles)))
+    return stand, standNbr, standList, hdom, hmax, valid
+
+
+def classify_zone(task):
+    '''
+    Stand classification of one zone, run in a worker process by classify_zones.
+
+    :param task: Dict with input files, zone value, window (xoff, yoff, xsize, ysize) of the zone, VHM height limits
+                 and classification parameters.
+    :return: Dict with the zone value, window, and the local stand, hmax and hdom rasters and standList.
+    '''
+    data, coniferous, zone = read_classification_input(task['inputRasterFile'], task['coniferousRasterFile'],
+                                                       task['zoneRasterFile'], task['vhm_min_height'],
+                                                       task['vhm_max_height'], task['window'])
+    stand, standNbr, standList, hdom, hmax = classify_stands(data, zone, coniferous, **task['classification_params'],
+                                                             seed_zone=task['zone'])
+    return {'zone': task['zone'],
+            'window': task['window'],
+            'stand': stand.astype(np.uint32),
+            'standList': standList,
+            'hmax': hmax,
+            'hdom': hdom,
+            'valid': data >= 0}
+
+
+def classify_zones(inputRasterFile,
+                   coniferousRasterFile,
+                   zoneRasterFile,
+                   vhm_min_height,
+                   vhm_max_height,
+                   classification_params,
+                   n_processes=None):
+    '''
+    Zone-wise stand classification in parallel processes. As stands never cross zone boundaries, each zone is
+    classified independently on its bounding box (plus a margin of the largest search window, so all search windows
+    see the same cells as in the classification of the whole raster). The stands of each zone are the same as in the
+    classification of the whole raster, stand IDs are assigned zone by zone (ID offset per zone).
+
+    :return: stand, standNbr (next free stand number), standList ([ID, hmax, hdom] per stand), hdom, hmax, valid
+             (True/False raster of the cells with VHM data)
+    '''
+    ds = gdal.Open(zoneRasterFile, GA_ReadOnly)
+    zone = ds.GetRasterBand(1).ReadAsArray()
+    n_rows, n_cols = zone.shape
+    ds = gdal.Open(inputRasterFile, GA_ReadOnly)
+    vhm_max = min(ds.GetRasterBand(1).ComputeRasterMinMax(False)[1], vhm_max_height)
+    margin = CH.getWindowSize(vhm_max)
+
+    # bounding box and size of each zone, reduced row by row (no full-raster index arrays)
+    zones = np.unique(zone)
+    row_min = np.full(len(zones), n_rows)
+    row_max = np.full(len(zones), -1)
+    col_min = np.full(len(zones), n_cols)
+    col_max = np.full(len(zones), -1)
+    zone_size = np.zeros(len(zones), dtype=np.int64)
+    for row in range(n_rows):
+        row_zones, first, counts = np.unique(zone[row], return_index=True, return_counts=True)
+        last = n_cols - 1 - np.unique(zone[row][::-1], return_index=True)[1]
+        i = np.searchsorted(zones, row_zones)
+        row_min[i] = np.minimum(row_min[i], row)
+        row_max[i] = row
+        col_min[i] = np.minimum(col_min[i], first)
+        col_max[i] = np.maximum(col_max[i], last)
+        zone_size[i] += counts
+
+    tasks = list()
+    # biggest zones first, for an even load of the worker processes
+    for i in np.argsort(-zone_size, kind='stable'):
+        row_start, row_end = max(0, row_min[i] - margin), min(n_rows, row_max[i] + margin + 1)
+        col_start, col_end = max(0, col_min[i] - margin), min(n_cols, col_max[i] + margin + 1)
+        tasks.append({'inputRasterFile': inputRasterFile,
+                      'coniferousRasterFile': coniferousRasterFile,
+                      'zoneRasterFile': zoneRasterFile,
+                      'zone': zones[i],
+                      'window': (int(col_start), int(row_start), int(col_end - col_start), int(row_end - row_start)),
+                      'vhm_min_height': vhm_min_height,
+                      'vhm_max_height': vhm_max_height,
+                      'classification_params': classification_params})
+
+    # --- merge the zones as they are completed (only the results in progress are kept in memory), stand IDs are
+    # offset in order of completion first ...
+    stand = np.zeros((n_rows, n_cols), dtype=int)
+    hmax = np.zeros((n_rows, n_cols), dtype=float)
+    hdom = np.zeros((n_rows, n_cols), dtype=float)
+    valid = np.zeros((n_rows, n_cols), dtype=bool)
+    standLists = dict()
+    offsets = dict()
+    offset = 0
+    print("classify %s zones..." % len(tasks))
+    with get_process_pool(n_processes) as pool:
+        futures = [pool.submit(classify_zone, task) for task in tasks]
+        del tasks
+        for future in as_completed(futures):
+            result = future.result()
+            futures.remove(future)
+            xoff, yoff, xsize, ysize = result['window']
+            window = (slice(yoff, yoff + ysize), slice(xoff, xoff + xsize))
+            m_zone = zone[window] == result['zone']
+            m_stand = m_zone & (result['stand'] > 0)
+
+            stand[window][m_stand] = result['stand'][m_stand] + offset
+            hdom[window][m_stand] = result['hdom'][m_stand]
+            hmax[window][m_zone] = result['hmax'][m_zone]
+            valid[window][m_zone] = result['valid'][m_zone]
+
+            standLists[result['zone']] = result['standList']
+            offsets[result['zone']] = offset
+            offset += len(result['standList'])
+            result.clear()
+
+    # ... and renumbered with an ID offset per zone ordered by zone value (same IDs as merging in zone order)
+    new_ids = np.zeros(offset + 1, dtype=int)
+    standList = list()
+    new_offset = 0
+    for zone_value in sorted(standLists):
+        n_stands = len(standLists[zone_value])
+        new_ids[offsets[zone_value] + 1:offsets[zone_value] + n_stands + 1] = \
+            np.arange(new_offset + 1, new_offset + n_stands + 1)
+        standList.extend([[stand_id + new_offset, hmax_stand, hdom_stand]
+                          for stand_id, hmax_stand, hdom_stand in standLists[zone_value]])
+        new_offset += n_stands
+    np.take(new_ids, stand, out=stand)
+
+    standNbr = offset + 1
+    print("%s stands in %s zones" % (offset, len(standLists)))
+    return stand, standNbr, standList, hdom, hmax, valid
+
+
 def classify_pixels(data,
-                    dataList,
+                    seeds,
                     standNbr,
                     min_tol,
                     max_tol,
@@ -256,18 +743,22 @@ def classify_pixels(data,
                     stand,
                     standList,
                     hdom,
-                    hmax):
-    prz10 = len(dataList) / 10
+                    hmax,
+                    standSeeds=None,
+                    window_scale=1):
+    n_cols = data.shape[1]
+    prz10 = len(seeds) / 10
     przPrint = prz10
     # loop over all pixels, starting with the biggest value
-    for i in range(len(dataList)):
+    for i in range(len(seeds)):
         # get value, row and col of current pixel
-        v, r, c = dataList[i]
+        r, c = divmod(int(seeds[i]), n_cols)
+        v = data[r, c]
 
         # print every 10 % of pixel processed
         if i > przPrint:
             print("%s%% pixels classified --> (%s from %s), value %s, standNbr %s" % (
-                round(przPrint / prz10) * 10, i, len(dataList), round(v, 1), standNbr))
+                round(przPrint / prz10) * 10, i, len(seeds), round(v, 1), standNbr))
             przPrint += prz10
 
         # proceed if not already classified
@@ -291,7 +782,7 @@ def classify_pixels(data,
 
                 # calculate window size
                 if counter == 0 or counter == 1:
-                    s = CH.getWindowSize(v)
+                    s = CH.getWindowSize(v, window_scale)
 
                 # get matrix subsets
                 data_sub = CH.get_matrix_subset(data, r, c, s)
@@ -362,6 +853,8 @@ def classify_pixels(data,
 
                 # add stand information to the list
                 standList.append([standNbr, hmax_stand, hdom_stand])
+                if standSeeds is not None:
+                    standSeeds.append(r_start * n_cols + c_start)
 
                 # store information as arrays
                 hmax[r_start, c_start] = hmax_stand
@@ -373,3 +866,297 @@ def classify_pixels(data,
                 # reset classification
                 stand[rows_classified, cols_classified] = 0
     return stand, standNbr, standList, hdom, hmax
+
+
+def classify_pixels_vectorized(data,
+                               seeds,
+                               standNbr,
+                               min_tol,
+                               max_tol,
+                               min_corr,
+                               max_corr,
+                               min_valid_cells,
+                               min_cells_per_stand,
+                               zone,
+                               coniferous,
+                               stand,
+                               standList,
+                               hdom,
+                               hmax,
+                               standSeeds=None,
+                               window_scale=1):
+    '''
+    Same stand classification as classify_pixels (identical stand, standList, hdom and hmax outputs),
+    but a stand is grown front by front instead of cell by cell.
+
+    Within the growth of one stand the reference value, the window size and the set of cells allowed to join
+    (similar height, same zone, same mixture class, not yet assigned to another stand) do not change. The todo list
+    of classify_pixels can therefore be processed as a sequence of fronts: all cells of a front are evaluated at once
+    with precomputed window offsets, and a visited bitmap (the stand raster itself) makes sure each cell is added to
+    the front only once. Cells are added in the same order as in classify_pixels, so hdom is bit-identical.
+    '''
+    n_rows, n_cols = data.shape
+
+    # rasters smaller than the largest search window are sliced differently (negative indices wrap around),
+    # use the cell by cell implementation for these
+    if data.size == 0 or min(n_rows, n_cols) < CH.getWindowSize(np.max(data), window_scale):
+        return classify_pixels(data, seeds, standNbr, min_tol, max_tol, min_corr, max_corr, min_valid_cells,
+                               min_cells_per_stand, zone, coniferous, stand, standList, hdom, hmax, standSeeds,
+                               window_scale)
+
+    # flat views on the rasters (stand and hdom are written through these views)
+    stand = np.ascontiguousarray(stand)
+    hdom = np.ascontiguousarray(hdom)
+    data_flat = np.ascontiguousarray(data).ravel()
+    stand_flat = stand.ravel()
+    hdom_flat = hdom.ravel()
+    zone_flat = np.ascontiguousarray(zone).ravel()
+    coniferous_flat = np.ascontiguousarray(coniferous).ravel() if coniferous is not None else None
+    # no zone check needed if there is only one zone
+    single_zone = zone_flat.min() == zone_flat.max()
+
+    # precomputed window offsets per window size
+    window_offsets = {}
+
+    def get_windows(cells, s):
+        # flat indices of the window cells (one row per cell) and mask of the cells inside the raster
+        off_rows, off_cols, off_flat = window_offsets[s]
+        cell_rows = cells // n_cols
+        cell_cols = cells - cell_rows * n_cols
+        if cell_rows.min() >= s // 2 and cell_rows.max() < n_rows - s // 2 and \
+                cell_cols.min() >= s // 2 and cell_cols.max() < n_cols - s // 2:
+            return cells[:, None] + off_flat, True
+        # windows are cut at the lower/right border, windows crossing the upper/left border are empty
+        # (same as slicing in get_matrix_subset)
+        win_rows = cell_rows[:, None] + off_rows
+        win_cols = cell_cols[:, None] + off_cols
+        m_inside = (win_rows < n_rows) & (win_cols < n_cols) & \
+                   ((cell_rows >= s // 2) & (cell_cols >= s // 2))[:, None]
+        return np.where(m_inside, win_rows * n_cols + win_cols, 0), m_inside
+
+    # starting cells which can not find enough similar cells (even if no other stand is around) are skipped,
+    # in classify_pixels they only produce an empty stand which is reset right away
+    if min_cells_per_stand > 0:
+        seed_candidates = np.flatnonzero(get_seed_candidates(data, seeds, zone, coniferous,
+                                                             min_tol, max_tol, min_corr, max_corr, min_valid_cells,
+                                                             window_offsets, window_scale)).astype(seeds.dtype)
+    else:
+        seed_candidates = np.arange(len(seeds), dtype=seeds.dtype)
+
+    prz10 = len(seeds) / 10
+    przPrint = prz10
+    # loop over all candidate pixels not classified yet, starting with the biggest value
+    for i in get_unclassified_seeds(seed_candidates, seeds, stand_flat):
+        # get value, row and col of current pixel
+        r, c = divmod(int(seeds[i]), n_cols)
+        v = data[r, c]
+
+        # print every 10 % of pixel processed
+        if i > przPrint:
+            print("%s%% pixels classified --> (%s from %s), value %s, standNbr %s" % (
+                round(przPrint / prz10) * 10, i, len(seeds), round(v, 1), standNbr))
+            przPrint += prz10
+
+        # store starting cell information
+        v_start, r_start, c_start = v, r, c
+        zone_start = zone[r, c]
+
+        # starting cell is processed (and counted) in any case
+        front = seeds[i:i + 1].astype(int)
+        processed = [front]
+
+        # --- starting cell: same evaluation as in classify_pixels
+        s = CH.getWindowSize(v, window_scale)
+        if s not in window_offsets:
+            window_offsets[s] = get_window_offsets(s, n_cols)
+        win_idx, m_inside = get_windows(front, s)
+        win_idx = win_idx[0]
+        if m_inside is not True:
+            m_inside = m_inside[0]
+        win_data = data_flat[win_idx]
+        win_stand = stand_flat[win_idx]
+        m_tol = m_inside & (win_data >= (v - v * min_tol) - min_corr) & (win_data <= (v + v * max_tol) + max_corr)
+        m_comb = m_tol & ((win_stand == 0) | (win_stand == standNbr))
+        if not single_zone:
+            m_comb &= zone_flat[win_idx] == zone_start
+        coniferous_mean = None
+        if coniferous is not None:
+            win_coniferous = coniferous_flat[win_idx]
+            if np.any(m_tol):
+                coniferous_mean = np.mean(win_coniferous[m_tol])
+                m_comb &= CH.get_similar_neighbours_coniferous(win_coniferous, coniferous_mean)
+
+        if np.sum(m_comb) > int(round(s * s * min_valid_cells)):
+            stand_flat[win_idx[m_comb]] = standNbr
+
+            # calculate new check value
+            v = np.mean(win_data[m_comb])
+            if coniferous is not None:
+                coniferous_mean = np.mean(win_coniferous[m_comb])
+
+            # first front: cells found in the window of the starting cell (row-major order)
+            front = win_idx[m_comb & (win_stand == 0)]
+
+            # window size and thresholds are fixed for the rest of the stand
+            s = CH.getWindowSize(v, window_scale)
+            if s not in window_offsets:
+                window_offsets[s] = get_window_offsets(s, n_cols)
+            min_cells = int(round(s * s * min_valid_cells))
+            v_min = (v - v * min_tol) - min_corr
+            v_max = (v + v * max_tol) + max_corr
+
+            # --- grow stand front by front
+            while front.size > 0:
+                processed.append(front)
+
+                # window cells of all cells in the front (one row per front cell)
+                win_idx, m_inside = get_windows(front, s)
+                win_data = data_flat[win_idx]
+                win_stand = stand_flat[win_idx]
+                m_free = win_stand == 0
+                m_comb = m_inside & (win_data >= v_min) & (win_data <= v_max) & (m_free | (win_stand == standNbr))
+                if not single_zone:
+                    m_comb &= zone_flat[win_idx] == zone_start
+                if coniferous is not None:
+                    m_comb &= CH.get_similar_neighbours_coniferous(coniferous_flat[win_idx], coniferous_mean)
+
+                # cells with enough similar cells in their window expand the stand
+                m_valid = np.count_nonzero(m_comb, axis=1) > min_cells
+                m_expand = m_comb & m_free
+                m_expand &= m_valid[:, None]
+
+                # next front: new cells in order of discovery, each cell only once
+                front = win_idx[m_expand]
+                if front.size > 0:
+                    front_unique, first_pos = np.unique(front, return_index=True)
+                    if front_unique.size < front.size:
+                        front = front[np.sort(first_pos)]
+                    stand_flat[front] = standNbr
+
+        processed = np.concatenate(processed)
+
+        # the starting cell is counted twice if it was added to the stand
+        classified_pixels = len(processed) - 1
+
+        # a minimum amount of pixels is needed, otherwise remove classification
+        if classified_pixels >= min_cells_per_stand:
+            # get hmax, which is the initial value for this stand (crystallisation point)
+            hmax_stand = v_start
+            # get hdom, which is the mean height of all classified cells within the stand
+            hdom_stand = np.mean(data_flat[processed])
+
+            # add stand information to the list
+            standList.append([standNbr, hmax_stand, hdom_stand])
+            if standSeeds is not None:
+                standSeeds.append(r_start * n_cols + c_start)
+
+            # store information as arrays
+            hmax[r_start, c_start] = hmax_stand
+            hdom_flat[processed] = hdom_stand
+
+            # increment stand number
+            standNbr += 1
+        else:
+            # reset classification
+            stand_flat[processed] = 0
+    return stand, standNbr, standList, hdom, hmax
+
+
+def get_window_offsets(s, n_cols):
+    '''
+    Returns the row, col and flat index offsets (for a raster with n_cols columns) of a squared window of size s.
+    '''
+    off_rows, off_cols = CH.get_window_offsets(s)
+    return off_rows, off_cols, off_rows * n_cols + off_cols
+
+
+def get_unclassified_seeds(seed_candidates, seed_cells, stand_flat, block_size=256):
+    '''
+    Yields the seed candidates (in order) whose cell is not assigned to a stand yet. The stand raster is checked
+    block-wise and again after each yield, as the caller assigns stands in between.
+
+    :param seed_candidates: Indices of the seeds to check.
+    :param seed_cells: Flat raster index of all seeds (see getSeedOrder).
+    :param stand_flat: Flat view of the stand raster.
+    '''
+    pos = 0
+    while pos < len(seed_candidates):
+        block = seed_candidates[pos:pos + block_size]
+        free = np.flatnonzero(stand_flat[seed_cells[block]] == 0)
+        if free.size == 0:
+            pos += block_size
+            continue
+        pos += free[0] + 1
+        yield block[free[0]]
+
+
+def get_seed_candidates(data,
+                        seeds,
+                        zone,
+                        coniferous,
+                        min_tol,
+                        max_tol,
+                        min_corr,
+                        max_corr,
+                        min_valid_cells,
+                        window_offsets,
+                        window_scale=1,
+                        chunk_cells=2 ** 22):
+    '''
+    Returns a true/false array indicating which starting cells (flat raster index, see getSeedOrder) find enough
+    similar cells of the same zone (and mixture class) in their search window to start a stand, ignoring the stand
+    assignment of the neighbours. A starting cell rejected here can therefore never start a stand.
+
+    :param window_offsets: Dict with precomputed window offsets per window size (filled if needed).
+    :param window_scale: Pixel size relative to the 10m VHM (search windows are scaled accordingly).
+    :param chunk_cells: Max amount of window cells evaluated at once (bounds the memory usage).
+    '''
+    n_rows, n_cols = data.shape
+    data_flat = np.ascontiguousarray(data).ravel()
+    zone_flat = np.ascontiguousarray(zone).ravel()
+    # the mixture class of the window is only checked for integer mixture values, as their mean is exact
+    # regardless of the summation order (the same mean as in classify_pixels is needed)
+    coniferous_flat = None
+    if coniferous is not None and np.issubdtype(coniferous.dtype, np.integer):
+        coniferous_flat = np.ascontiguousarray(coniferous).ravel()
+
+    candidates = np.zeros(len(seeds), dtype=bool)
+    # seeds are processed in chunks (usually at most 9x9 windows -> 81 window cells per seed)
+    chunk = max(1, chunk_cells // 81)
+    for chunk_start in range(0, len(seeds), chunk):
+        cells = seeds[chunk_start:chunk_start + chunk].astype(int)
+        values = data_flat[cells]
+        window_sizes = CH.getWindowSizes(values, window_scale)
+        for s in np.unique(window_sizes):
+            s = int(s)
+            if s not in window_offsets:
+                window_offsets[s] = get_window_offsets(s, n_cols)
+            off_rows, off_cols, off_flat = window_offsets[s]
+            min_cells = int(round(s * s * min_valid_cells))
+
+            idx = np.flatnonzero((window_sizes == s) & (values > 0))
+            v = values[idx][:, None]
+            seed_rows = cells[idx] // n_cols
+            seed_cols = cells[idx] % n_cols
+
+            # same window cells as in the stand growth of classify_pixels_vectorized
+            win_rows = seed_rows[:, None] + off_rows
+            win_cols = seed_cols[:, None] + off_cols
+            m_inside = (win_rows < n_rows) & (win_cols < n_cols) & \
+                       ((seed_rows >= s // 2) & (seed_cols >= s // 2))[:, None]
+            win_idx = np.where(m_inside, win_rows * n_cols + win_cols, 0)
+
+            win_data = data_flat[win_idx]
+            m_tol = m_inside & (win_data >= (v - v * min_tol) - min_corr) & (win_data <= (v + v * max_tol) + max_corr)
+            m_similar = m_tol & (zone_flat[win_idx] == zone_flat[cells[idx]][:, None])
+            if coniferous_flat is not None:
+                win_coniferous = coniferous_flat[win_idx]
+                n_tol = np.maximum(np.sum(m_tol, axis=1), 1)
+                coniferous_mean = (np.sum(np.where(m_tol, win_coniferous, 0), axis=1) / n_tol)[:, None]
+                # same classes as in get_similar_neighbours_coniferous
+                m_low = (coniferous_mean >= 0.0) & (coniferous_mean <= 20.0)
+                m_high = (coniferous_mean >= 80.0) & (coniferous_mean <= 100.0)
+                m_similar &= (m_low & (win_coniferous >= 0.0) & (win_coniferous <= 50.0)) | \
+                             (m_high & (win_coniferous >= 50.0) & (win_coniferous <= 100.0))
+            candidates[chunk_start + idx] = np.sum(m_similar, axis=1) > min_cells
+    return candidates
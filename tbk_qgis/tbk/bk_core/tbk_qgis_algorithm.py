@@ -70,6 +70,7 @@ from .add_coniferous_proportion import *
 from .attributes_default import *
 from tbk_qgis.tbk.utility.tbk_utilities import dict_diff
 from tbk_qgis.tbk.utility.qgis_processing_utility import QgisHandler
+from tbk_qgis.tbk.utility.stage_cache import StageCache
 from tbk_qgis.tbk.utility.persistence_utility import (read_dict_from_toml_file,
                                                       write_dict_to_toml_file)
 
@@ -167,6 +168,16 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
     VHM_MIN_HEIGHT = "vhm_min_height"
     # VHM maximum height                                                   
     VHM_MAX_HEIGHT = "vhm_max_height"
+    # Use vectorized classification engine
+    VECTORIZED_CLASSIFICATION = "vectorized_classification"
+    # Tile size for parallel classification
+    TILE_SIZE = "tile_size"
+    # Tile overlap for parallel classification
+    TILE_HALO = "tile_halo"
+    # Number of parallel processes
+    N_PROCESSES = "n_processes"
+    # Classify zones of the zone raster in parallel
+    ZONE_PARALLEL = "zone_parallel"
     # Simplification tolerance                                                   
     SIMPLIFICATION_TOLERANCE = "simplification_tolerance"
 
@@ -177,10 +188,22 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
     SIMILAR_NEIGHBOURS_MIN_AREA_M2 = "similar_neighbours_min_area"
     # hdom relative diff to merge similar stands                                  
     SIMILAR_NEIGHBOURS_HDOM_DIFF_REL = "similar_neighbours_hdom_diff_rel"
+    # Max. area of merged similar stands (0: no limit)
+    SIMILAR_NEIGHBOURS_MAX_MERGED_AREA_M2 = "similar_neighbours_max_merged_area"
     # Also calc coniferous prop. for main layer                          
     CALC_MIXTURE_FOR_MAIN_LAYER = "calc_mixture_for_main_layer"
+    # Store the DG layers as one bit-packed raster
+    PACKED_DG_LAYERS = "packed_dg_layers"
+    # Clip to perimeter and fill gaps on the raster grid
+    RASTER_PERIMETER_CLIP = "raster_perimeter_clip"
+    # Clip exactly with the perimeter in the raster clip (else cut the stands at the rasterized perimeter)
+    RASTER_PERIMETER_EXACT_CLIP = "raster_perimeter_exact_clip"
+    # Tile size (map units) to clip to perimeter and fill gaps in parallel processes (0: no tiles)
+    PERIMETER_TILE_SIZE = "perimeter_tile_size"
     # Delete temporary files and fields
     DEL_TMP = "del_tmp"
+    # Reuse outputs of unchanged stages from a cache directory
+    STAGE_CACHE = "stage_cache"
 
     # ------- List of Algorithm Parameters -------#
     # Parameters with default values
@@ -301,6 +324,36 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
                                                  type=QgsProcessingParameterNumber.Double, defaultValue=60)
         self.addAdvancedParameter(parameter)
 
+        parameter = QgsProcessingParameterBoolean(self.VECTORIZED_CLASSIFICATION,
+                                                  self.tr("Use vectorized stand classification (faster, same result)"),
+                                                  defaultValue=True)
+        self.addAdvancedParameter(parameter)
+
+        parameter = QgsProcessingParameterNumber(self.TILE_SIZE,
+                                                 self.tr("Tile size [pixels] for parallel stand classification "
+                                                         "(0: no tiles)"),
+                                                 type=QgsProcessingParameterNumber.Integer, defaultValue=0,
+                                                 minValue=0)
+        self.addAdvancedParameter(parameter)
+
+        parameter = QgsProcessingParameterNumber(self.TILE_HALO,
+                                                 self.tr("Tile overlap [pixels] for parallel stand classification"),
+                                                 type=QgsProcessingParameterNumber.Integer, defaultValue=50,
+                                                 minValue=0)
+        self.addAdvancedParameter(parameter)
+
+        parameter = QgsProcessingParameterNumber(self.N_PROCESSES,
+                                                 self.tr("Number of parallel processes (0: number of CPUs)"),
+                                                 type=QgsProcessingParameterNumber.Integer, defaultValue=0,
+                                                 minValue=0)
+        self.addAdvancedParameter(parameter)
+
+        parameter = QgsProcessingParameterBoolean(self.ZONE_PARALLEL,
+                                                  self.tr("Classify the zones of the zone raster in parallel processes"
+                                                          "\nHas no effect if no zone raster is provided."),
+                                                  defaultValue=False)
+        self.addAdvancedParameter(parameter)
+
         parameter = QgsProcessingParameterNumber(self.SIMPLIFICATION_TOLERANCE, self.tr("Simplification tolerance [m]"),
                                                  type=QgsProcessingParameterNumber.Double, defaultValue=8)
         self.addAdvancedParameter(parameter)
@@ -319,17 +372,54 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
                                                  type=QgsProcessingParameterNumber.Double, defaultValue=0.15)
         self.addAdvancedParameter(parameter)
 
+        parameter = QgsProcessingParameterNumber(self.SIMILAR_NEIGHBOURS_MAX_MERGED_AREA_M2,
+                                                 self.tr("Max. area of merged similar stands (0: no limit)"),
+                                                 type=QgsProcessingParameterNumber.Integer, defaultValue=0,
+                                                 minValue=0)
+        self.addAdvancedParameter(parameter)
+
         parameter = QgsProcessingParameterBoolean(self.CALC_MIXTURE_FOR_MAIN_LAYER,
                                                   self.tr("Also calc coniferous prop. for main layer (Oberschicht).\n"
                                                           "Has no effect if no mixture raster is provided."),
                                                   defaultValue=True)
         self.addAdvancedParameter(parameter)
 
+        parameter = QgsProcessingParameterBoolean(self.PACKED_DG_LAYERS,
+                                                  self.tr("Store the DG layers as one bit-packed raster "
+                                                          "(dg_layers_packed.tif, legacy layers as VRT)"),
+                                                  defaultValue=False)
+        self.addAdvancedParameter(parameter)
+
+        parameter = QgsProcessingParameterBoolean(self.RASTER_PERIMETER_CLIP,
+                                                  self.tr("Clip to perimeter and determine the gaps on the VHM 150cm grid "
+                                                          "(gap boundaries follow the raster cells)"),
+                                                  defaultValue=False)
+        self.addAdvancedParameter(parameter)
+
+        parameter = QgsProcessingParameterBoolean(self.RASTER_PERIMETER_EXACT_CLIP,
+                                                  self.tr("Clip exactly with the perimeter when clipping on the "
+                                                          "raster grid (else cut the stands at the cell boundaries "
+                                                          "of the rasterized perimeter)"),
+                                                  defaultValue=True)
+        self.addAdvancedParameter(parameter)
+
+        parameter = QgsProcessingParameterNumber(self.PERIMETER_TILE_SIZE,
+                                                 self.tr("Tile size (map units) to clip to perimeter and fill gaps "
+                                                         "in parallel processes (0: no tiles)"),
+                                                 type=QgsProcessingParameterNumber.Double, defaultValue=0, minValue=0)
+        self.addAdvancedParameter(parameter)
+
         # Additional parameters
         parameter = QgsProcessingParameterBoolean(self.DEL_TMP, self.tr("Delete temporary files and fields"),
                                                   defaultValue=True)
         self.addAdvancedParameter(parameter)
 
+        parameter = QgsProcessingParameterBoolean(self.STAGE_CACHE,
+                                                  self.tr("Reuse results of unchanged stages (cache in "
+                                                          "<output folder>/stage_cache)"),
+                                                  defaultValue=False)
+        self.addAdvancedParameter(parameter)
+
     def processAlgorithm(self, parameters, context, feedback):
         """
         Here is where the processing itself takes place.
@@ -405,6 +495,14 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
         calc_mixture_for_main_layer = self.parameterAsBool(parameters, self.CALC_MIXTURE_FOR_MAIN_LAYER,
                                                            context)
 
+        # get packed_dg_layers flag
+        packed_dg_layers = self.parameterAsBool(parameters, self.PACKED_DG_LAYERS, context)
+
+        # get raster_perimeter_clip flag
+        raster_perimeter_clip = self.parameterAsBool(parameters, self.RASTER_PERIMETER_CLIP, context)
+        raster_perimeter_exact_clip = self.parameterAsBool(parameters, self.RASTER_PERIMETER_EXACT_CLIP, context)
+        perimeter_tile_size = self.parameterAsDouble(parameters, self.PERIMETER_TILE_SIZE, context)
+
         # get and check perimeter file
         perimeter = str(self.parameterAsVectorLayer(parameters, self.PERIMETER, context).source())
 
@@ -451,6 +549,13 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
         min_cells_per_pure_stand = self.parameterAsInt(parameters, self.MIN_CELLS_PER_PURE_STAND, context)
         vhm_min_height = self.parameterAsDouble(parameters, self.VHM_MIN_HEIGHT, context)
         vhm_max_height = self.parameterAsDouble(parameters, self.VHM_MAX_HEIGHT, context)
+        vectorized_classification = self.parameterAsBool(parameters, self.VECTORIZED_CLASSIFICATION, context)
+        tile_size = self.parameterAsInt(parameters, self.TILE_SIZE, context)
+        tile_halo = self.parameterAsInt(parameters, self.TILE_HALO, context)
+        n_processes = self.parameterAsInt(parameters, self.N_PROCESSES, context)
+        if n_processes <= 0:
+            n_processes = None
+        zone_parallel = self.parameterAsBool(parameters, self.ZONE_PARALLEL, context)
 
         simplification_tolerance = self.parameterAsDouble(parameters, self.SIMPLIFICATION_TOLERANCE, context)
 
@@ -460,9 +565,12 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
         similar_neighbours_hdom_diff_rel = self.parameterAsDouble(parameters,
                                                                   self.SIMILAR_NEIGHBOURS_HDOM_DIFF_REL,
                                                                   context)
+        similar_neighbours_max_merged_area = self.parameterAsInt(parameters,
+                                                                 self.SIMILAR_NEIGHBOURS_MAX_MERGED_AREA_M2, context)
 
         # get and check miscellaneous parameters
         del_tmp = self.parameterAsBool(parameters, self.DEL_TMP, context)
+        use_stage_cache = self.parameterAsBool(parameters, self.STAGE_CACHE, context)
 
         # --- init directory
         ensure_dir(output_root)
@@ -534,21 +642,38 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
             feedback.pushWarning('The TOML file was not written in the output folder because an error occurred')
             feedback.pushWarning(f'Error: {error}')
 
+        # Cache for the stage outputs (stages with unchanged inputs and parameters are not run again)
+        stage_cache_dir = os.path.join(output_root, "stage_cache") if use_stage_cache else None
+        stage_cache = StageCache(stage_cache_dir, tbk_result_dir, exclude_files=[logfile_tmp_path])
+
         # Run TBk
         start_time = time.time()
         start_time_section = time.time()
 
         # --- Stand delineation (Main)
         log.info(' 1 --- Stand delineation')
-        run_stand_classification(working_root, tmp_output_folder,
-                                 vhm_10m,
-                                 coniferous_raster_for_classification,  # is None if not provided, handled in function
-                                 zoneRasterFile,
-                                 description,
-                                 min_tol, max_tol,
-                                 min_corr, max_corr,
-                                 min_valid_cells, min_cells_per_stand, min_cells_per_pure_stand,
-                                 vhm_min_height, vhm_max_height)
+        stage_cache.run('1_stand_delineation',
+                        lambda: run_stand_classification(working_root, tmp_output_folder,
+                                                         vhm_10m,
+                                                         # is None if not provided, handled in function
+                                                         coniferous_raster_for_classification,
+                                                         zoneRasterFile,
+                                                         description,
+                                                         min_tol, max_tol,
+                                                         min_corr, max_corr,
+                                                         min_valid_cells, min_cells_per_stand,
+                                                         min_cells_per_pure_stand,
+                                                         vhm_min_height, vhm_max_height,
+                                                         vectorized_classification,
+                                                         tile_size, tile_halo, n_processes,
+                                                         zone_parallel),
+                        params={'description': description, 'min_tol': min_tol, 'max_tol': max_tol,
+                                'min_corr': min_corr, 'max_corr': max_corr, 'min_valid_cells': min_valid_cells,
+                                'min_cells_per_stand': min_cells_per_stand,
+                                'min_cells_per_pure_stand': min_cells_per_pure_stand,
+                                'vhm_min_height': vhm_min_height, 'vhm_max_height': vhm_max_height,
+                                'tile_size': tile_size, 'tile_halo': tile_halo, 'zone_parallel': zone_parallel},
+                        input_files=[vhm_10m, coniferous_raster_for_classification, zoneRasterFile])
         log.info("   --- done: %s (h:min:sec)" % str(timedelta(seconds=(time.time() - start_time_section))))
         log.info("   --- 15%" + " | estimated remaining time: %s (h:min:sec)\n" % str(
             timedelta(seconds=((time.time() - start_time) * 100 / 15 - (time.time() - start_time)))))
@@ -556,8 +681,12 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
         # --- Simplify & Eliminate
         log.info(' 2 --- Simplify & Eliminate')
         start_time_section = time.time()
-        post_process(working_root, tmp_output_folder, min_area_m2, simplification_tolerance=simplification_tolerance,
-                     del_tmp=del_tmp)
+        stage_cache.run('2_simplify_eliminate',
+                        lambda: post_process(working_root, tmp_output_folder, min_area_m2,
+                                             simplification_tolerance=simplification_tolerance, del_tmp=del_tmp,
+                                             n_processes=n_processes),
+                        params={'min_area_m2': min_area_m2, 'simplification_tolerance': simplification_tolerance,
+                                'del_tmp': del_tmp})
         log.info("   --- done: %s (h:min:sec)" % str(timedelta(seconds=(time.time() - start_time_section))))
         log.info("   --- 30%" + " | estimated remaining time: %s (h:min:sec)\n" % str(
             timedelta(seconds=((time.time() - start_time) * 100 / 30 - (time.time() - start_time)))))
@@ -565,9 +694,15 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
         # --- Merge similar neighbours
         log.info(' 3 --- Merge similar neighbours')
         start_time_section = time.time()
-        merge_similar_neighbours(working_root, similar_neighbours_min_area,
-                                 similar_neighbours_hdom_diff_rel,
-                                 del_tmp=del_tmp)
+        stage_cache.run('3_merge_similar_neighbours',
+                        lambda: merge_similar_neighbours(working_root, similar_neighbours_min_area,
+                                                         similar_neighbours_hdom_diff_rel,
+                                                         del_tmp=del_tmp,
+                                                         max_merged_area_m2=similar_neighbours_max_merged_area or None),
+                        params={'similar_neighbours_min_area': similar_neighbours_min_area,
+                                'similar_neighbours_hdom_diff_rel': similar_neighbours_hdom_diff_rel,
+                                'similar_neighbours_max_merged_area': similar_neighbours_max_merged_area,
+                                'del_tmp': del_tmp})
         log.info("   --- done: %s (h:min:sec)" % str(timedelta(seconds=(time.time() - start_time_section))))
         log.info("   --- 50%" + " | estimated remaining time: %s (h:min:sec)\n" % str(
             timedelta(seconds=((time.time() - start_time) * 100 / 50 - (time.time() - start_time)))))
@@ -575,10 +710,35 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
         # --- Clip to perimeter and eliminate gaps
         log.info(' 4 --- Clip to perimeter and eliminate gaps')
         start_time_section = time.time()
-        # run clip function
-        clip_to_perimeter(working_root, tmp_output_folder, perimeter, del_tmp=del_tmp)
-        # run gaps function
-        eliminate_gaps(working_root, tmp_output_folder, perimeter, del_tmp=del_tmp)
+        def clip_and_eliminate_gaps():
+            if raster_perimeter_clip:
+                # clip and fill gaps on the raster grid
+                clip_to_perimeter_raster(working_root, tmp_output_folder, perimeter, vhm_150cm,
+                                         exact_clip=raster_perimeter_exact_clip, del_tmp=del_tmp)
+                return
+            if perimeter_tile_size > 0:
+                # clip and fill gaps tile by tile in parallel processes
+                clip_to_perimeter_tiled(working_root, tmp_output_folder, perimeter, perimeter_tile_size,
+                                        n_processes=n_processes, del_tmp=del_tmp)
+                return
+            # run clip function
+            clip_to_perimeter(working_root, tmp_output_folder, perimeter, del_tmp=del_tmp)
+            # run gaps function
+            eliminate_gaps(working_root, tmp_output_folder, perimeter, del_tmp=del_tmp)
+
+        stage_cache.run('4_clip_eliminate_gaps', clip_and_eliminate_gaps,
+                        params={'del_tmp': del_tmp, 'raster_perimeter_clip': raster_perimeter_clip,
+                                'raster_perimeter_exact_clip': raster_perimeter_exact_clip,
+                                'perimeter_tile_size': perimeter_tile_size},
+                        input_files=[perimeter] + ([vhm_150cm] if raster_perimeter_clip else []))
+
+        # Rasterize the stand IDs once per target grid (shared by DG and coniferous proportion)
+        stand_id_grids = [vhm_150cm] + ([coniferous_raster] if coniferous_raster else [])
+        def create_stand_id_rasters():
+            for grid in stand_id_grids:
+                get_stand_id_raster(os.path.join(working_root, "stands_clipped.gpkg"), grid, tmp_output_folder)
+
+        stage_cache.run('4_stand_id_rasters', create_stand_id_rasters, input_files=stand_id_grids)
         log.info("   --- done: %s (h:min:sec)" % str(timedelta(seconds=(time.time() - start_time_section))))
         log.info("   --- 65%" + " | estimated remaining time: %s (h:min:sec)\n" % str(
             timedelta(seconds=((time.time() - start_time) * 100 / 65 - (time.time() - start_time)))))
@@ -586,7 +746,11 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
         # --- Calculate DG
         log.info(' 5 --- Calculate DG')
         start_time_section = time.time()
-        calculate_dg(working_root, tmp_output_folder, tbk_result_dir, vhm_150cm, del_tmp=del_tmp)
+        stage_cache.run('5_calculate_dg',
+                        lambda: calculate_dg(working_root, tmp_output_folder, tbk_result_dir, vhm_150cm,
+                                             del_tmp=del_tmp, packed_layers=packed_dg_layers),
+                        params={'del_tmp': del_tmp, 'packed_dg_layers': packed_dg_layers},
+                        input_files=[vhm_150cm])
         log.info("   --- done: %s (h:min:sec)" % str(timedelta(seconds=(time.time() - start_time_section))))
         log.info("   --- 80%" + " | estimated remaining time: %s (h:min:sec)\n" % str(
             timedelta(seconds=((time.time() - start_time) * 100 / 80 - (time.time() - start_time)))))
@@ -595,8 +759,13 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
         if coniferous_raster:
             log.info(' 6 --- Add coniferous proportion')
             start_time_section = time.time()
-            add_coniferous_proportion(working_root, tmp_output_folder, tbk_result_dir, coniferous_raster,
-                                      calc_mixture_for_main_layer, del_tmp=del_tmp)
+            stage_cache.run('6_coniferous_proportion',
+                            lambda: add_coniferous_proportion(working_root, tmp_output_folder, tbk_result_dir,
+                                                              coniferous_raster, calc_mixture_for_main_layer,
+                                                              del_tmp=del_tmp),
+                            params={'calc_mixture_for_main_layer': calc_mixture_for_main_layer,
+                                    'del_tmp': del_tmp},
+                            input_files=[coniferous_raster])
             log.info("   --- done: %s (h:min:sec)" % str(timedelta(seconds=(time.time() - start_time_section))))
             log.info("   --- 85%" + " | estimated remaining time: %s (h:min:sec)\n" % str(
                 timedelta(seconds=((time.time() - start_time) * 100 / 85 - (time.time() - start_time)))))
@@ -604,7 +773,12 @@ class TBkAlgorithm(QgsProcessingAlgorithm):
         # --- Calc specific attributes
         log.info(' 7 --- Calc specific attributes')
         start_time_section = time.time()
-        stands_file_attributed = calc_attributes(working_root, tmp_output_folder, tbk_result_dir, del_tmp=del_tmp)
+        stands_file_attributed = stage_cache.run('7_calc_attributes',
+                                                 lambda: calc_attributes(working_root, tmp_output_folder,
+                                                                         tbk_result_dir, del_tmp=del_tmp),
+                                                 params={'del_tmp': del_tmp})
+        if use_stage_cache:
+            log.info(f"   --- stage cache: {stage_cache.hits} hits, {stage_cache.misses} misses")
         log.info("   --- done: %s (h:min:sec)" % str(timedelta(seconds=(time.time() - start_time_section))))
 
         # --- Cleanup stand file
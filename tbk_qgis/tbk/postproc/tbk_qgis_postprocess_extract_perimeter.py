@@ -473,6 +473,8 @@ class TBkPostprocessExtractPerimeter(QgsProcessingAlgorithm):
 
         # if required add degree of cover to list of raster datasets
         if dg:
+            # DG layers may be VRT views of a bit-packed raster (extracted as GeoTIFF)
+            dg_path = os.path.relpath(resolve_raster_file(os.path.join(path_tbk_input, dg_path)), path_tbk_input)
             path_dg = os.path.join(path_tbk_input, dg_path)
             if os.path.exists(path_dg) == False:
                 raise QgsProcessingException("No degree of cover raster layer found:\n" + path_dg + "\ndoes not exist.")
@@ -481,11 +483,11 @@ class TBkPostprocessExtractPerimeter(QgsProcessingAlgorithm):
         # if required add degree of cover layer for specific height ranges (relative to hdom) to list of raster datasets
         if all_dg:
             for i in ["ks", "us", "ms", "os", "ueb"]:
-                path_dg_i = os.path.join(path_tbk_input, all_dg_path, "dg_layer_" + i + ".tif")
+                path_dg_i = resolve_raster_file(os.path.join(path_tbk_input, all_dg_path, "dg_layer_" + i + ".tif"))
                 if os.path.exists(path_dg_i) == False:
                     raise QgsProcessingException(
                         "For the " + i.upper() + " height range no degree of cover raster layer found:\n" + path_dg_i + "\ndoes not exist.")
-                tbk_raster_datasets[os.path.join(all_dg_path, "dg_layer_" + i + ".tif")] = "extract 5 degree of cover raster layers specific to height ranges relative to hdom ... "
+                tbk_raster_datasets[os.path.relpath(path_dg_i, path_tbk_input)] = "extract 5 degree of cover raster layers specific to height ranges relative to hdom ... "
 
         # if required add VHM with detail resolution to list of raster datasets
         if vhm_10m:
@@ -671,6 +673,9 @@ class TBkPostprocessExtractPerimeter(QgsProcessingAlgorithm):
                 # build input and output path
                 dataset_in = os.path.join(path_tbk_input, ds)
                 dataset_out = os.path.join(path_output, ds)
+                # VRT views (bit-packed DG layers) are extracted as GeoTIFF
+                if dataset_out.lower().endswith(".vrt"):
+                    dataset_out = os.path.splitext(dataset_out)[0] + ".tif"
 
                 # check if output(-folder) does not exist
                 if not os.path.exists(dataset_out):
@@ -31,6 +31,7 @@ import os  # os is used below, so make sure it's available in any case
 import time
 from datetime import datetime, timedelta
 import math
+import numpy as np
 
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsProcessing,
@@ -49,6 +50,10 @@ from qgis.core import (QgsProcessing,
 import processing
 
 from tbk_qgis.tbk.utility.tbk_utilities import *
+from tbk_qgis.tbk.utility.zonal_statistics import zonal_statistics, write_zonal_statistics
+from tbk_qgis.tbk.utility.focal_statistics import focal_mean
+from tbk_qgis.tbk.utility.local_density import (classify_local_densities, local_density_statistics,
+                                                polygonize_local_densities)
 
 
 class TBkPostprocessLocalDensity(QgsProcessingAlgorithm):
@@ -96,6 +101,10 @@ class TBkPostprocessLocalDensity(QgsProcessingAlgorithm):
     SAVE_UNCLIPPED = "save_unclipped"
     # grid cell size for grouping stands (km)
     GRID_CELL_SIZE = "grid_cell_size"
+    # classify local densities per stand on the raster grid instead of intersecting polygons (boolean)
+    RASTER_FIRST = "raster_first"
+    # save polygons of local densities (only used by raster_first, boolean)
+    SAVE_DENSITY_POLYGONS = "save_density_polygons"
 
     def initAlgorithm(self, config):
         """
@@ -254,6 +263,25 @@ class TBkPostprocessLocalDensity(QgsProcessingAlgorithm):
         parameter.setMetadata({'widget_wrapper': {'decimals': 3}})
         self.addAdvancedParameter(parameter)
 
+        # classify local densities per stand on the raster grid instead of intersecting polygons (boolean)
+        parameter = QgsProcessingParameterBoolean(
+            self.RASTER_FIRST,
+            self.tr(
+                "Raster-first: classify local densities per stand on the degree of cover raster grid."
+                "\n(no holes removal, buffer smoothing and polygon intersection)"
+            ),
+            defaultValue=False
+        )
+        self.addAdvancedParameter(parameter)
+
+        # save polygons of local densities (only used by raster_first, boolean)
+        parameter = QgsProcessingParameterBoolean(
+            self.SAVE_DENSITY_POLYGONS,
+            self.tr("Raster-first: save polygons of local densities (TBk_local_densities.gpkg)"),
+            defaultValue=True
+        )
+        self.addAdvancedParameter(parameter)
+
     def processAlgorithm(self, parameters, context, feedback):
         """
         Here is where the processing itself takes place.
@@ -377,6 +405,12 @@ class TBkPostprocessLocalDensity(QgsProcessingAlgorithm):
         # grid cell size for grouping stands (km)
         grid_cell_size = self.parameterAsDouble(parameters, self.GRID_CELL_SIZE, context)
 
+        # classify local densities per stand on the raster grid instead of intersecting polygons (boolean)
+        raster_first = self.parameterAsBool(parameters, self.RASTER_FIRST, context)
+
+        # save polygons of local densities (only used by raster_first, boolean)
+        save_density_polygons = self.parameterAsBool(parameters, self.SAVE_DENSITY_POLYGONS, context)
+
         start_time = time.time()
 
         # lump together density classes
@@ -392,13 +426,14 @@ class TBkPostprocessLocalDensity(QgsProcessingAlgorithm):
             )
         # for i in den_classes: print(i)
 
-        path_dg = os.path.join(path_tbk_input, "dg_layers/dg_layer.tif")
+        # DG layers (VRT if Generate BK stored them bit-packed)
+        path_dg = resolve_raster_file(os.path.join(path_tbk_input, "dg_layers/dg_layer.tif"))
 
-        path_dg_ks = os.path.join(path_tbk_input, "dg_layers/dg_layer_ks.tif")
-        path_dg_us = os.path.join(path_tbk_input, "dg_layers/dg_layer_us.tif")
-        path_dg_ms = os.path.join(path_tbk_input, "dg_layers/dg_layer_ms.tif")
-        path_dg_os = os.path.join(path_tbk_input, "dg_layers/dg_layer_os.tif")
-        path_dg_ueb = os.path.join(path_tbk_input, "dg_layers/dg_layer_ueb.tif")
+        path_dg_ks = resolve_raster_file(os.path.join(path_tbk_input, "dg_layers/dg_layer_ks.tif"))
+        path_dg_us = resolve_raster_file(os.path.join(path_tbk_input, "dg_layers/dg_layer_us.tif"))
+        path_dg_ms = resolve_raster_file(os.path.join(path_tbk_input, "dg_layers/dg_layer_ms.tif"))
+        path_dg_os = resolve_raster_file(os.path.join(path_tbk_input, "dg_layers/dg_layer_os.tif"))
+        path_dg_ueb = resolve_raster_file(os.path.join(path_tbk_input, "dg_layers/dg_layer_ueb.tif"))
 
         path_stands = os.path.join(path_tbk_input, tbk_input_file)
 
@@ -432,6 +467,78 @@ class TBkPostprocessLocalDensity(QgsProcessingAlgorithm):
             ctc = QgsProject.instance().transformContext()
             QgsVectorFileWriter.writeAsVectorFormatV3(input, path_, ctc, getVectorSaveOptions('GPKG', 'utf-8'))
 
+        # helper function to tidy up attributes of local densities and save them
+        def f_save_local_densities(den_polys, rasters_4_stats):
+            feedback.pushInfo("tidy up attributes of local densities ...")
+            # sequence fields of local densities for output. note: tmp. id for stands (= fid_stand) is not part of output!
+            field_names = ['class', 'ID_stand', 'area', 'area_stand', 'area_pct']
+            for raster in rasters_4_stats:
+                field_names.append(raster)
+                field_names.append(raster + '_stand')
+            field_names.append('hdom_stand')
+            # print(field_names)
+
+            # get ID_stand's meta data
+            ID_stand_field = den_polys.fields()['ID_stand']
+            ID_stand_type = ID_stand_field.type()
+            ID_stand_type_name = ID_stand_field.typeName()
+
+            # select fields for local-density-output according sequence created above and prettify zonal-stats-attributes
+            fields_mapping = []
+            for field in field_names:
+                if field == 'class':
+                    type = int(10)
+                    type_name = 'text'
+                    exp = '"class"'  # keep as is
+                elif field == 'ID_stand':
+                    type = ID_stand_type  # inherit data type
+                    type_name = ID_stand_type_name # inherit data type
+                    exp = '"ID_stand"'  # keep as is
+                elif field == 'area_pct':
+                    type = int(6)
+                    type_name = 'double precision'
+                    exp = '"area_pct"'  # keep as is
+                elif field == 'NH':
+                    type = int(2)
+                    type_name = 'integer'
+                    exp = 'round("NH")'  # already %-tage
+                elif field != 'NH' and field in rasters_4_stats:
+                    type = int(2)
+                    type_name = 'integer'
+                    exp = 'round("' + field + '" * 100)'  # [0, 1] --> [0, 100]%
+                else:
+                    type = int(2)
+                    type_name = 'integer'
+                    exp = '' + '"' + field + '"' + ''  # keep as is
+                map = {'alias': '', 'comment': '', 'expression': exp, 'length': 0, 'name': field, 'precision': 0,
+                       'sub_type': 0, 'type': type, 'type_name': type_name}
+                fields_mapping.append(map)
+            param = {'INPUT': den_polys, 'FIELDS_MAPPING': fields_mapping, 'OUTPUT': 'TEMPORARY_OUTPUT'}
+            algoOutput = processing.run("native:refactorfields", param)
+            den_polys = algoOutput["OUTPUT"]
+
+            feedback.pushInfo("save output: TBk_local_densities" + output_suffix + ".gpkg ...")
+            # save local densities output
+            path_local_den_out = os.path.join(path_output, "TBk_local_densities" + output_suffix + ".gpkg")
+            ctc = QgsProject.instance().transformContext()
+            QgsVectorFileWriter.writeAsVectorFormatV3(den_polys, path_local_den_out, ctc,
+                                                      getVectorSaveOptions('GPKG', 'utf-8'))
+
+        # helper function to save the stands with the local density metrics
+        def f_save_stands(stands_all):
+            feedback.pushInfo("save output: TBk_Bestandeskarte_local_densities" + output_suffix + ".gpkg ...")
+            # tmp. id (= fid_stand) and its derivative (fid_stand_group) are not part of output, same goes to attributes
+            # added by native:mergevectorlayers (layer, path)!
+            col_to_delete = ['fid_stand', 'fid_stand_group', 'layer', 'path']
+            param = {'INPUT': stands_all, 'COLUMN': col_to_delete, 'OUTPUT': 'TEMPORARY_OUTPUT'}
+            algoOutput = processing.run("native:deletecolumn", param)
+            stands_all = algoOutput["OUTPUT"]
+            # output original stands + local density stats
+            path_stands_out = os.path.join(path_output, "TBk_Bestandeskarte_local_densities" + output_suffix + ".gpkg")
+            ctc = QgsProject.instance().transformContext()
+            QgsVectorFileWriter.writeAsVectorFormatV3(stands_all, path_stands_out, ctc,
+                                                      getVectorSaveOptions('GPKG', 'utf-8'))
+
         # select stands with min. area size
         feedback.pushInfo("select stands with area > " + str(min_size_stand) + "m^2 ...")
         param = {'INPUT': stands_all, 'EXPRESSION': '$area > ' + str(min_size_stand), 'OUTPUT': 'TEMPORARY_OUTPUT'}
@@ -503,15 +610,15 @@ class TBkPostprocessLocalDensity(QgsProcessingAlgorithm):
             )
 
         # dict for focal layers (for each unique neighbour size one layer)
-        focal_dg_layers = {}
-        for i in den_classes:
-            if not str(i["size"]) in focal_dg_layers:
-                feedback.pushInfo(focal_dg_layers_feedback[str(i["size"])])
-                param = {'input': dg, 'selection': dg, 'method': 0, 'size': i["size"], 'gauss': None, 'quantile': '',
-                         '-c': True, '-a': False, 'weight': '', 'output': 'TEMPORARY_OUTPUT', 'GRASS_REGION_PARAMETER': None,
-                         'GRASS_REGION_CELLSIZE_PARAMETER': 0, 'GRASS_RASTER_FORMAT_OPT': '', 'GRASS_RASTER_FORMAT_META': ''}
-                algoOutput = processing.run("grass7:r.neighbors", param)
-                focal_dg_layers[str(i["size"])] = QgsRasterLayer(algoOutput["output"])
+        # all sizes are calculated from one read of the dg raster (same as r.neighbors average, circular, with dg as
+        # selection)
+        focal_sizes = sorted(set(i["size"] for i in den_classes))
+        focal_files = [os.path.join(QgsProcessingUtils.tempFolder(), "focal_dg_" + str(size) + ".tif")
+                       for size in focal_sizes]
+        for size in focal_sizes:
+            feedback.pushInfo(focal_dg_layers_feedback[str(size)])
+        focal_mean(dg.source(), focal_sizes, focal_files, circular=True)
+        focal_dg_layers = {str(size): QgsRasterLayer(focal_file) for size, focal_file in zip(focal_sizes, focal_files)}
         # check
         # for i in focal_dg_layers:
         #     print(i)
@@ -519,6 +626,112 @@ class TBkPostprocessLocalDensity(QgsProcessingAlgorithm):
         #     res_i = processing.run("native:rasterlayerproperties", param)['PIXEL_HEIGHT']
         #     print(res_i)
 
+        # all density classes
+        all_classes = []
+        for cl in den_classes:
+            all_classes.append(str(cl["class"]))
+        # all value types included in stats on local densities (s. long table below)
+        value_types = ['area', 'area_pct', 'dg']
+        if mg_use:
+            value_types.append('nh')
+        # list of new fields for stats on local densities
+        new_fields = []
+        for cl in all_classes:
+            for v in value_types:
+                new_fields.append("z" + cl + "_" + v)
+        # define new fields / attributes for stands layers (z<class>_<value type>)
+        new_attributes = []
+        for i in new_fields:
+            if i[-8:] == "area_pct":
+                new_attributes.append(QgsField(i, QVariant.Double))
+            else:
+                new_attributes.append(QgsField(i, QVariant.Int))
+
+        if raster_first:
+            feedback.pushInfo("classify local densities of all classes per stand on the dg_layer grid ...")
+            # stand ID raster on the DG grid (labels = fid = fid_stand) of the stands with min. area size
+            stand_id_raster = get_stand_id_raster(path_stands, dg.source(), QgsProcessingUtils.tempFolder())
+            area_stand = {f["fid_stand"]: f["area_stand"] for f in stands.getFeatures()}
+            cell_area = dg.rasterUnitsPerPixelX() * dg.rasterUnitsPerPixelY()
+            path_classes = os.path.join(QgsProcessingUtils.tempFolder(), "local_density_classes.tif")
+            classify_local_densities(stand_id_raster, dict(zip(focal_sizes, focal_files)), den_classes, path_classes,
+                                     min_clump_cells=math.floor(min_size_clump / cell_area) + 1,
+                                     stand_ids=area_stand.keys())
+
+            # rasters for zonal statistics, Mishungsgrad / Nadelholzanteil raster resampled to the DG grid
+            # (nearest neighbour)
+            if calc_all_dg:
+                rasters_4_stats = {'DG': path_dg, 'DG_ks': path_dg_ks, 'DG_us': path_dg_us, 'DG_ms': path_dg_ms,
+                                   'DG_os': path_dg_os, 'DG_ueb': path_dg_ueb}
+            else:
+                rasters_4_stats = {'DG': path_dg}
+            if mg_use:
+                path_mg = os.path.join(QgsProcessingUtils.tempFolder(), "mg_dg_grid.vrt")
+                extent = dg.extent()
+                gdal.Warp(path_mg, mg_input, format="VRT", width=dg.width(), height=dg.height(),
+                          outputBounds=(extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum()),
+                          resampleAlg="near")
+                rasters_4_stats['NH'] = path_mg
+
+            # area, mean DG and mean NH per stand and class with grouped reductions over stand ID * class
+            feedback.pushInfo("calculate local density metrics per stand ...")
+            fid_stands = {f.id(): f["fid_stand"] for f in stands_all.getFeatures()}
+            # note: min / max are local variables of the class loop below, numpy is used instead
+            n_labels = int(np.max(list(fid_stands.values()), initial=0)) + 1
+            stats = local_density_statistics(path_classes, {raster: rasters_4_stats[raster] for raster in ('DG', 'NH')
+                                                            if raster in rasters_4_stats}, len(den_classes), n_labels)
+            area_stand_values = np.full(len(stats["count"]), np.nan)
+            area_stand_values[list(area_stand.keys())] = list(area_stand.values())
+            table = {}
+            for i, cl in enumerate(all_classes):
+                # classes not detected within a stand are NULL (same as the stands without local densities below)
+                area = np.where(stats["count"][:, i] > 0, np.round(stats["count"][:, i] * cell_area), np.nan)
+                table["z" + cl + "_area"] = area
+                table["z" + cl + "_area_pct"] = np.round(area / area_stand_values, 2)
+                table["z" + cl + "_dg"] = np.round(stats["DG"][:, i] * 100)
+                if mg_use:
+                    table["z" + cl + "_nh"] = np.round(stats["NH"][:, i])
+            # table indexed by the feature IDs of stands_all (-1 --> NULL)
+            stand_index = np.full(int(np.max(list(fid_stands.keys()), initial=0)) + 1, -1)
+            stand_index[list(fid_stands.keys())] = list(fid_stands.values())
+            table = {column: np.append(values, np.nan)[stand_index] for column, values in table.items()}
+            write_zonal_statistics(stands_all, table, {field.name(): field for field in new_attributes})
+
+            if save_density_polygons:
+                feedback.pushInfo("polygonize local densities of all classes ...")
+                path_den_polys = os.path.join(QgsProcessingUtils.tempFolder(), "den_polys_raster_first.gpkg")
+                polygonize_local_densities(path_classes, all_classes, path_den_polys)
+                den_polys = QgsVectorLayer(path_den_polys, 'den_polys', 'ogr')
+                # the classes overlap (e.g. class 12 covers 1 and 2)
+                table = zonal_statistics(path_den_polys, rasters_4_stats, ['mean'], overlapping=True)
+                write_zonal_statistics(den_polys, table, {raster + '_mean': QgsField(raster, QVariant.Double)
+                                                          for raster in rasters_4_stats})
+
+                # attributes of the stands (suffixed with _stand), area of local densities and ratio to area of stand
+                param = {'INPUT': den_polys, 'FIELD': 'fid_stand', 'INPUT_2': stands, 'FIELD_2': 'fid_stand',
+                         'FIELDS_TO_COPY': [], 'METHOD': 1, 'DISCARD_NONMATCHING': False, 'PREFIX': '',
+                         'OUTPUT': 'TEMPORARY_OUTPUT'}
+                algoOutput = processing.run("native:joinattributestable", param)
+                den_polys = algoOutput["OUTPUT"]
+                param = {'INPUT': den_polys, 'FIELD_NAME': 'area', 'FIELD_TYPE': 1, 'FIELD_LENGTH': 10,
+                         'FIELD_PRECISION': 0, 'FORMULA': 'round($area)', 'OUTPUT': 'TEMPORARY_OUTPUT'}
+                algoOutput = processing.run("native:fieldcalculator", param)
+                den_polys = algoOutput["OUTPUT"]
+                param = {'INPUT': den_polys, 'FIELD_NAME': 'area_pct', 'FIELD_TYPE': 0, 'FIELD_LENGTH': 0,
+                         'FIELD_PRECISION': 0, 'FORMULA': 'round($area / area_stand, 2)', 'OUTPUT': 'TEMPORARY_OUTPUT'}
+                algoOutput = processing.run("native:fieldcalculator", param)
+                den_polys = algoOutput["OUTPUT"]
+
+                f_save_local_densities(den_polys, rasters_4_stats)
+            f_save_stands(stands_all)
+
+            feedback.pushInfo("====================================================================")
+            feedback.pushInfo("FINISHED")
+            feedback.pushInfo("TOTAL PROCESSING TIME: %s (h:min:sec)" % str(timedelta(seconds=(time.time() - start_time))))
+            feedback.pushInfo("====================================================================")
+
+            return {self.OUTPUT: path_output}
+
         # list to gather polygons of oll density classes
         den_polys = []
 
@@ -765,17 +978,17 @@ class TBkPostprocessLocalDensity(QgsProcessingAlgorithm):
             rasters_4_stats = {'DG': dg}
         if mg_use:
             rasters_4_stats['NH'] = mg
-
-        for raster in rasters_4_stats:
-            # actual zonal stats: 'STATISTICS': [2] --> mean
-            param = {'INPUT': den_polys, 'INPUT_RASTER': rasters_4_stats[raster], 'RASTER_BAND': 1,
-                     'COLUMN_PREFIX': raster + '_', 'STATISTICS': [2], 'OUTPUT': 'TEMPORARY_OUTPUT'}
-            algoOutput = processing.run("native:zonalstatisticsfb", param)
-            den_polys = algoOutput["OUTPUT"]
-            # get rid attribute suffix _mean
-            param = {'INPUT': den_polys, 'FIELD': raster + '_mean', 'NEW_NAME': raster, 'OUTPUT': 'TEMPORARY_OUTPUT'}
-            algoOutput = processing.run("native:renametablefield", param)
-            den_polys = algoOutput["OUTPUT"]
+        rasters_4_stats = {raster: layer if isinstance(layer, str) else layer.source()
+                           for raster, layer in rasters_4_stats.items()}
+
+        # mean of all rasters per local density polygon in one pass (feature IDs of a GeoPackage copy as zones)
+        f_save_as_gpkg(den_polys, "den_polys_zonal_stats", QgsProcessingUtils.tempFolder())
+        path_den_polys = os.path.join(QgsProcessingUtils.tempFolder(), "den_polys_zonal_stats.gpkg")
+        den_polys = QgsVectorLayer(path_den_polys, 'den_polys', 'ogr')
+        # local densities of different classes and buffered local densities overlap
+        table = zonal_statistics(path_den_polys, rasters_4_stats, ['mean'], overlapping=True)
+        write_zonal_statistics(den_polys, table, {raster + '_mean': QgsField(raster, QVariant.Double)
+                                                  for raster in rasters_4_stats})
         # f_save_as_gpkg(den_polys, "den_polys_zonal_stats")
 
         feedback.pushInfo("calculate local density metrics for overlapping stands ...")
@@ -821,27 +1034,6 @@ class TBkPostprocessLocalDensity(QgsProcessingAlgorithm):
                  'length': 0, 'name': 'nh', 'precision': 0, 'sub_type': 0, 'type': 2, 'type_name': 'integer'}
             )
 
-        # all density classes
-        all_classes = []
-        for cl in den_classes:
-            all_classes.append(str(cl["class"]))
-        # all value types included in stats on local densities (s. long table above)
-        value_types = ['area', 'area_pct', 'dg']
-        if mg_use:
-            value_types.append('nh')
-        # list of new fields for stats on local densities
-        new_fields = []
-        for cl in all_classes:
-            for v in value_types:
-                new_fields.append("z" + cl + "_" + v)
-        # define new fields / attributes for stands layers generated in below loop
-        new_attributes = []
-        for i in new_fields:
-            if i[-8:] == "area_pct":
-                new_attributes.append(QgsField(i, QVariant.Double))
-            else:
-                new_attributes.append(QgsField(i, QVariant.Int))
-
         # get unique values from tmp. group id (fid_stand_group) add to original stand map
         fid_stand_group_index = stands_all.fields().indexFromName("fid_stand_group")
         fid_stand_group_index_unique = list(stands_all.uniqueValues(fid_stand_group_index))
@@ -901,73 +1093,8 @@ class TBkPostprocessLocalDensity(QgsProcessingAlgorithm):
         stands_all = algoOutput["OUTPUT"]
         # f_save_as_gpkg(stands_all, "stands_all_merged")
 
-        feedback.pushInfo("tidy up attributes of local densities ...")
-        # sequence fields of local densities for output. note: tmp. id for stands (= fid_stand) is not part of output!
-        field_names = ['class', 'ID_stand', 'area', 'area_stand', 'area_pct']
-        for raster in rasters_4_stats:
-            field_names.append(raster)
-            field_names.append(raster + '_stand')
-        field_names.append('hdom_stand')
-        # print(field_names)
-
-        # get ID_stand's meta data
-        ID_stand_field = den_polys.fields()['ID_stand']
-        ID_stand_type = ID_stand_field.type()
-        ID_stand_type_name = ID_stand_field.typeName()
-
-        # select fields for local-density-output according sequence created above and prettify zonal-stats-attributes
-        fields_mapping = []
-        for field in field_names:
-            if field == 'class':
-                type = int(10)
-                type_name = 'text'
-                exp = '"class"'  # keep as is
-            elif field == 'ID_stand':
-                type = ID_stand_type  # inherit data type
-                type_name = ID_stand_type_name # inherit data type
-                exp = '"ID_stand"'  # keep as is
-            elif field == 'area_pct':
-                type = int(6)
-                type_name = 'double precision'
-                exp = '"area_pct"'  # keep as is
-            elif field == 'NH':
-                type = int(2)
-                type_name = 'integer'
-                exp = 'round("NH")'  # already %-tage
-            elif field != 'NH' and field in rasters_4_stats:
-                type = int(2)
-                type_name = 'integer'
-                exp = 'round("' + field + '" * 100)'  # [0, 1] --> [0, 100]%
-            else:
-                type = int(2)
-                type_name = 'integer'
-                exp = '' + '"' + field + '"' + ''  # keep as is
-            map = {'alias': '', 'comment': '', 'expression': exp, 'length': 0, 'name': field, 'precision': 0,
-                   'sub_type': 0, 'type': type, 'type_name': type_name}
-            fields_mapping.append(map)
-        param = {'INPUT': den_polys, 'FIELDS_MAPPING': fields_mapping, 'OUTPUT': 'TEMPORARY_OUTPUT'}
-        algoOutput = processing.run("native:refactorfields", param)
-        den_polys = algoOutput["OUTPUT"]
-
-        feedback.pushInfo("save output: TBk_local_densities" + output_suffix + ".gpkg ...")
-        # save local densities output
-        path_local_den_out = os.path.join(path_output, "TBk_local_densities" + output_suffix + ".gpkg")
-        ctc = QgsProject.instance().transformContext()
-        QgsVectorFileWriter.writeAsVectorFormatV3(den_polys, path_local_den_out, ctc,
-                                                  getVectorSaveOptions('GPKG', 'utf-8'))
-
-        feedback.pushInfo("save output: TBk_Bestandeskarte_local_densities" + output_suffix + ".gpkg ...")
-        # tmp. id (= fid_stand) and its derivative (fid_stand_group) are not part of output, same goes to attributes
-        # added by native:mergevectorlayers (layer, path)!
-        col_to_delete = ['fid_stand', 'fid_stand_group', 'layer', 'path']
-        param = {'INPUT': stands_all, 'COLUMN': col_to_delete, 'OUTPUT': 'TEMPORARY_OUTPUT'}
-        algoOutput = processing.run("native:deletecolumn", param)
-        stands_all = algoOutput["OUTPUT"]
-        # output original stands + local density stats
-        path_stands_out = os.path.join(path_output, "TBk_Bestandeskarte_local_densities" + output_suffix + ".gpkg")
-        ctc = QgsProject.instance().transformContext()
-        QgsVectorFileWriter.writeAsVectorFormatV3(stands_all, path_stands_out, ctc,
-                                                  getVectorSaveOptions('GPKG', 'utf-8'))
+        f_save_local_densities(den_polys, rasters_4_stats)
+        f_save_stands(stands_all)
 
         feedback.pushInfo("====================================================================")
         feedback.pushInfo("FINISHED")
@@ -1055,6 +1182,10 @@ To a copy of the TBk stand map attributes with metrics about each local density
 <p>Check box: if checked unclipped geometries of local density classes are saved as layer / .gpkg having suffix <i>_unclipped</i>.</p>
 <h3>Grid cell size for grouping stands by their x_min & y_min overlapping</h3>
 <p>float / [km], default 3km --> 9km&sup2; square cells. This input is used for groupwise / iterative intersection of stands and local densities, thus tackling the run time of intersection exponentially increasing with number of geometries. This parameter is experimental as the optimal cell size is unknown at the time.</p> 
+<h3>Raster-first: classify local densities per stand on the degree of cover raster grid</h3>
+<p>Check box: if checked the local density classes are determined per stand on the grid of the degree of cover raster (all classes and stands in one composite raster) and the metrics per stand are calculated directly from the raster. Holes removal, buffer smoothing and the intersection with the stands are not applied, 'clumps' below the minimum size are removed on the raster (4-connected cells of a class within a stand). Much faster for large stand maps.</p>
+<h3>Raster-first: save polygons of local densities</h3>
+<p>Check box: if checked (default) the local densities are polygonized once and saved as <i>TBk_local_densities.gpkg</i>. Only used if <i><b>Raster-first ...</i></b> is checked, if unchecked only the stand map with metrics is saved.</p>
 
 <h2>Outputs</h2>
 <h3>local_densities</h3>
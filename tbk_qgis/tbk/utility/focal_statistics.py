@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# *************************************************************************** #
+# Focal (moving window) mean of a raster for several window sizes in one pass.
+#
+# (C) Hannes Horneber, Christoph Schaller (BFH-HAFL)
+# *************************************************************************** #
+"""
+/***************************************************************************
+    TBk: Toolkit Bestandeskarte (QGIS Plugin)
+    Toolkit for the generating and processing forest stand maps
+    Copyright (C) 2025 BFH-HAFL (hannes.horneber@bfh.ch, christian.rosset@bfh.ch)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+ ***************************************************************************/
+"""
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import numpy as np
+from osgeo import gdal
+
+FOCAL_NODATA = -9999
+
+
+def circular_kernel(size):
+    """
+    Circular moving window, same as r.neighbors -c: cells within a distance of size // 2 cells from the center.
+
+    :param size: Window size in cells (odd)
+    :return: 2d float array (size, size) with 1 within the circle, else 0
+    """
+    radius = size // 2
+    offsets = np.arange(-radius, radius + 1)
+    return (offsets[:, None] ** 2 + offsets[None, :] ** 2 <= radius ** 2).astype(np.float64)
+
+
+def _next_fast_len(n):
+    """Smallest size >= n with the prime factors 2, 3 and 5 only (fast FFT sizes, same as scipy.fft.next_fast_len)"""
+    best = 2 ** int(np.ceil(np.log2(max(n, 1))))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            m = p35
+            while m < n:
+                m *= 2
+            best = min(best, m)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def _fft_shape(shape):
+    # sizes with small prime factors are much faster
+    return tuple(_next_fast_len(n) for n in shape)
+
+
+def _box_sum(a, size):
+    """Sum of a square window of size cells around each cell (zero padded) with an integral image"""
+    radius = size // 2
+    padded = np.pad(a, radius + 1)
+    integral = padded.cumsum(axis=0).cumsum(axis=1)
+    n_rows, n_cols = a.shape
+    return (integral[size:size + n_rows, size:size + n_cols] - integral[:n_rows, size:size + n_cols] -
+            integral[size:size + n_rows, :n_cols] + integral[:n_rows, :n_cols])
+
+
+def focal_mean(raster, sizes, output_files, circular=True, tile_size=2048):
+    """
+    Focal mean of a raster for several window sizes (same as r.neighbors method average with a selection of the
+    valid cells): NoData cells are ignored, cells outside the raster count as NoData, cells with NoData get NoData.
+
+    The raster is read once in tiles with a halo of the largest window radius. Circular windows are applied as
+    FFT convolution, square windows with integral images, so the cost does not grow with the window size.
+
+    :param raster: Raster file (or gdal.Dataset)
+    :param sizes: Window sizes in cells (odd)
+    :param output_files: Output file (GeoTIFF, Float32, NoData FOCAL_NODATA) per size
+    :param circular: Circular (r.neighbors -c) or square windows
+    :param tile_size: Tile size in cells (without halo)
+    """
+    ds = gdal.Open(raster, gdal.GA_ReadOnly) if isinstance(raster, str) else raster
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    n_cols, n_rows = ds.RasterXSize, ds.RasterYSize
+    halo = max(sizes) // 2
+
+    out_bands = {}
+    out_datasets = {}
+    for size, output_file in zip(sizes, output_files):
+        out_ds = gdal.GetDriverByName("GTiff").Create(output_file, n_cols, n_rows, 1, gdal.GDT_Float32,
+                                                      options=["COMPRESS=LZW", "TILED=YES", "BIGTIFF=IF_SAFER"])
+        out_ds.SetGeoTransform(ds.GetGeoTransform())
+        out_ds.SetProjection(ds.GetProjection())
+        out_band = out_ds.GetRasterBand(1)
+        out_band.SetNoDataValue(FOCAL_NODATA)
+        out_datasets[size] = out_ds
+        out_bands[size] = out_band
+
+    # one FFT shape for all tiles (the largest tile), so the kernel FFT of each size is computed once
+    if circular:
+        fft_shape = _fft_shape((min(n_rows, tile_size + 2 * halo) + 2 * halo,
+                                min(n_cols, tile_size + 2 * halo) + 2 * halo))
+        kernel_ffts = {size: np.fft.rfft2(circular_kernel(size), fft_shape) for size in sizes}
+    for row in range(0, n_rows, tile_size):
+        for col in range(0, n_cols, tile_size):
+            # tile with halo (clamped to the raster)
+            row_start, row_end = max(0, row - halo), min(n_rows, row + tile_size + halo)
+            col_start, col_end = max(0, col - halo), min(n_cols, col + tile_size + halo)
+            values = band.ReadAsArray(col_start, row_start, col_end - col_start, row_end - row_start)
+            values = values.astype(np.float64)
+            valid = ~np.isnan(values)
+            if nodata is not None and not np.isnan(nodata):
+                valid &= values != nodata
+            values[~valid] = 0
+            valid = valid.astype(np.float64)
+
+            core_rows = slice(row - row_start, min(row + tile_size, n_rows) - row_start)
+            core_cols = slice(col - col_start, min(col + tile_size, n_cols) - col_start)
+            m_valid_core = valid[core_rows, core_cols] > 0
+            if circular:
+                values_fft = np.fft.rfft2(values, fft_shape)
+                valid_fft = np.fft.rfft2(valid, fft_shape)
+
+            for size in sizes:
+                if circular:
+                    radius = size // 2
+                    kernel_fft = kernel_ffts[size]
+                    # full convolution, the window of a cell is centered at (row + radius, col + radius)
+                    sums = np.fft.irfft2(values_fft * kernel_fft, fft_shape)
+                    counts = np.fft.irfft2(valid_fft * kernel_fft, fft_shape)
+                    rows = slice(core_rows.start + radius, core_rows.stop + radius)
+                    cols = slice(core_cols.start + radius, core_cols.stop + radius)
+                    sums = sums[rows, cols]
+                    # counts are integers, FFT rounding errors are removed
+                    counts = np.rint(counts[rows, cols])
+                else:
+                    sums = _box_sum(values, size)[core_rows, core_cols]
+                    counts = _box_sum(valid, size)[core_rows, core_cols]
+
+                mean = np.full(counts.shape, FOCAL_NODATA, dtype=np.float32)
+                m_mean = m_valid_core & (counts > 0)
+                mean[m_mean] = sums[m_mean] / counts[m_mean]
+                out_bands[size].WriteArray(mean, col, row)
+
+    for size in sizes:
+        out_bands[size].FlushCache()
+    out_bands = None
+    out_datasets = None
+    band = None
+    ds = None
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# *************************************************************************** #
+# Local density classes per stand on the raster grid (raster-first local density).
+#
+# (C) Hannes Horneber, Christoph Schaller (BFH-HAFL)
+# *************************************************************************** #
+"""
+/***************************************************************************
+    TBk: Toolkit Bestandeskarte (QGIS Plugin)
+    Toolkit for the generating and processing forest stand maps
+    Copyright (C) 2025 BFH-HAFL (hannes.horneber@bfh.ch, christian.rosset@bfh.ch)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+ ***************************************************************************/
+"""
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import numpy as np
+from osgeo import gdal, ogr
+
+from tbk_qgis.tbk.utility.zonal_statistics import ZonalAccumulator
+
+
+def classify_local_densities(stand_id_raster, focal_rasters, den_classes, output_file, min_clump_cells=0,
+                             stand_ids=None, block_rows=1024):
+    """
+    Write the stands of the local density classes as a composite raster: band i contains the stand ID of the cells
+    whose focal DG is within the range of class i (min < value <= max, same as native:reclassifybytable with a
+    tolerance of 0.0001), else 0. Clumps (4-connected cells of a class within a stand) with less than min_clump_cells
+    cells are removed.
+
+    :param stand_id_raster: Stand label raster (see get_stand_id_raster) on the grid of the focal rasters
+    :param focal_rasters: Dict with the focal DG raster (see focal_mean) per window size
+    :param den_classes: List of dicts with min, max (DG [0, 1]) and size (window size) of each class
+    :param output_file: Composite raster (GeoTIFF, UInt32, one band per class)
+    :param min_clump_cells: Minimum number of cells of a clump
+    :param stand_ids: Stand IDs to classify (default: all)
+    """
+    label_ds = gdal.Open(stand_id_raster, gdal.GA_ReadOnly)
+    label_band = label_ds.GetRasterBand(1)
+    n_cols, n_rows = label_ds.RasterXSize, label_ds.RasterYSize
+    focal_datasets = {size: gdal.Open(focal_raster, gdal.GA_ReadOnly) for size, focal_raster in focal_rasters.items()}
+    focal_bands = {size: ds.GetRasterBand(1) for size, ds in focal_datasets.items()}
+    focal_nodata = {size: band.GetNoDataValue() for size, band in focal_bands.items()}
+
+    driver = gdal.GetDriverByName("GTiff")
+    options = ["COMPRESS=LZW", "TILED=YES", "BIGTIFF=IF_SAFER"]
+    classes_file = output_file if min_clump_cells <= 1 else output_file + ".unsieved.tif"
+    out_ds = driver.Create(classes_file, n_cols, n_rows, len(den_classes), gdal.GDT_UInt32, options=options)
+    out_ds.SetGeoTransform(label_ds.GetGeoTransform())
+    out_ds.SetProjection(label_ds.GetProjection())
+
+    m_stands = None
+    if stand_ids is not None:
+        stand_ids = np.asarray(list(stand_ids), dtype=np.int64)
+        m_stands = np.zeros(max(stand_ids.max(initial=0), 0) + 1, dtype=bool)
+        m_stands[stand_ids] = True
+
+    for row in range(0, n_rows, block_rows):
+        rows = min(block_rows, n_rows - row)
+        labels = label_band.ReadAsArray(0, row, n_cols, rows).astype(np.int64)
+        if m_stands is not None:
+            m_labels = labels < len(m_stands)
+            m_labels[m_labels] = m_stands[labels[m_labels]]
+            labels[~m_labels] = 0
+        # every focal raster is read once per block
+        focal = {}
+        for size, band in focal_bands.items():
+            values = band.ReadAsArray(0, row, n_cols, rows)
+            m_valid = ~np.isnan(values)
+            if focal_nodata[size] is not None:
+                m_valid &= values != focal_nodata[size]
+            focal[size] = (values, m_valid)
+        for i, cl in enumerate(den_classes):
+            values, m_valid = focal[cl["size"]]
+            m_class = m_valid & (values > cl["min"] - 0.0001) & (values <= cl["max"] + 0.0001)
+            out_ds.GetRasterBand(i + 1).WriteArray(np.where(m_class, labels, 0).astype(np.uint32), 0, row)
+    focal_bands = None
+    focal_datasets = None
+    label_band = None
+    label_ds = None
+
+    if min_clump_cells > 1:
+        # remove small clumps: clumps smaller than the threshold are merged into a neighbour by the sieve filter,
+        # their cells are kept only if they still have their stand ID
+        sieved_ds = driver.Create(output_file, n_cols, n_rows, len(den_classes), gdal.GDT_UInt32, options=options)
+        sieved_ds.SetGeoTransform(out_ds.GetGeoTransform())
+        sieved_ds.SetProjection(out_ds.GetProjection())
+        for i in range(len(den_classes)):
+            src_band = out_ds.GetRasterBand(i + 1)
+            dst_band = sieved_ds.GetRasterBand(i + 1)
+            gdal.SieveFilter(src_band, None, dst_band, min_clump_cells, 4, callback=None)
+            for row in range(0, n_rows, block_rows):
+                rows = min(block_rows, n_rows - row)
+                codes = src_band.ReadAsArray(0, row, n_cols, rows)
+                sieved = dst_band.ReadAsArray(0, row, n_cols, rows)
+                dst_band.WriteArray(np.where(sieved == codes, codes, 0).astype(np.uint32), 0, row)
+        src_band = None
+        dst_band = None
+        sieved_ds = None
+        out_ds = None
+        gdal.GetDriverByName("GTiff").Delete(classes_file)
+    out_ds = None
+
+
+def local_density_statistics(class_raster, rasters, n_classes, n_labels=0, block_rows=1024):
+    """
+    Number of cells and mean of rasters per stand and local density class with grouped reductions over the composite
+    code stand ID * n_classes + class index (see classify_local_densities).
+
+    :param class_raster: Composite raster of classify_local_densities
+    :param rasters: Dict with the rasters (on the grid of the class raster) by name
+    :param n_classes: Number of classes (bands of the class raster)
+    :param n_labels: Minimum number of stand IDs (max. stand ID + 1)
+    :return: Dict with an array (n_labels, n_classes) of the cell count ("count") and of the mean per raster name
+    """
+    class_ds = gdal.Open(class_raster, gdal.GA_ReadOnly)
+    n_cols, n_rows = class_ds.RasterXSize, class_ds.RasterYSize
+    datasets = {name: gdal.Open(raster, gdal.GA_ReadOnly) for name, raster in rasters.items()}
+    bands = {name: ds.GetRasterBand(1) for name, ds in datasets.items()}
+    nodata = {name: band.GetNoDataValue() for name, band in bands.items()}
+    counts = ZonalAccumulator(["count"], n_labels * n_classes)
+    accumulators = {name: ZonalAccumulator(["mean"], n_labels * n_classes) for name in rasters}
+
+    for row in range(0, n_rows, block_rows):
+        rows = min(block_rows, n_rows - row)
+        codes = []
+        for i in range(n_classes):
+            labels = class_ds.GetRasterBand(i + 1).ReadAsArray(0, row, n_cols, rows).astype(np.int64)
+            codes.append(np.where(labels > 0, labels * n_classes + i, -1))
+        codes = np.stack(codes)
+        m_codes = codes >= 0
+        if not m_codes.any():
+            continue
+        counts.add(codes[m_codes], np.ones(np.count_nonzero(m_codes)))
+        for name, band in bands.items():
+            # classes may overlap, the values are used for every class of a cell
+            values = np.broadcast_to(band.ReadAsArray(0, row, n_cols, rows), codes.shape)
+            m_valid = m_codes & ~np.isnan(values)
+            if nodata[name] is not None and not np.isnan(nodata[name]):
+                m_valid &= values != nodata[name]
+            accumulators[name].add(codes[m_valid], values[m_valid])
+    bands = None
+    datasets = None
+    class_ds = None
+
+    n_codes = max(counts.n_labels, n_labels * n_classes)
+    n_codes = -(-n_codes // n_classes) * n_classes
+    result = {"count": counts.result(n_codes)["count"].reshape(-1, n_classes)}
+    for name, accumulator in accumulators.items():
+        result[name] = accumulator.result(n_codes)["mean"].reshape(-1, n_classes)
+    return result
+
+
+def polygonize_local_densities(class_raster, class_names, output_file):
+    """
+    Polygonize the composite raster of classify_local_densities once per class into one layer.
+
+    :param class_raster: Composite raster of classify_local_densities
+    :param class_names: Class name per band
+    :param output_file: Output GeoPackage with the fields fid_stand and class
+    """
+    class_ds = gdal.Open(class_raster, gdal.GA_ReadOnly)
+    out_ds = ogr.GetDriverByName("GPKG").CreateDataSource(output_file)
+    out_layer = out_ds.CreateLayer("local_densities", class_ds.GetSpatialRef(), ogr.wkbPolygon)
+    out_layer.CreateField(ogr.FieldDefn("fid_stand", ogr.OFTInteger64))
+    out_layer.CreateField(ogr.FieldDefn("class", ogr.OFTString))
+    i_class = out_layer.GetLayerDefn().GetFieldIndex("class")
+    for i, class_name in enumerate(class_names):
+        band = class_ds.GetRasterBand(i + 1)
+        # polygons of the class are written to a memory layer first to set the class
+        mem_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+        mem_layer = mem_ds.CreateLayer("class", class_ds.GetSpatialRef(), ogr.wkbPolygon)
+        mem_layer.CreateField(ogr.FieldDefn("fid_stand", ogr.OFTInteger64))
+        gdal.Polygonize(band, band, mem_layer, 0, callback=None)
+        out_layer.StartTransaction()
+        for mem_feature in mem_layer:
+            out_feature = ogr.Feature(out_layer.GetLayerDefn())
+            out_feature.SetField(0, mem_feature.GetField(0))
+            out_feature.SetField(i_class, class_name)
+            out_feature.SetGeometry(mem_feature.GetGeometryRef())
+            out_layer.CreateFeature(out_feature)
+        out_layer.CommitTransaction()
+        mem_ds = None
+    out_ds = None
+    class_ds = None
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+# *************************************************************************** #
+# Topological simplification of a polygon mosaic (stand map) on its shared edges.
+#
+# (C) Hannes Horneber, Christoph Schaller (BFH-HAFL)
+# *************************************************************************** #
+"""
+/***************************************************************************
+    TBk: Toolkit Bestandeskarte (QGIS Plugin)
+    Toolkit for the generating and processing forest stand maps
+    Copyright (C) 2025 BFH-HAFL (hannes.horneber@bfh.ch, christian.rosset@bfh.ch)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+ ***************************************************************************/
+"""
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+from collections import defaultdict
+
+import numpy as np
+from qgis.core import (QgsFeature,
+                       QgsGeometry,
+                       QgsMemoryProviderUtils,
+                       QgsPointXY,
+                       QgsSpatialIndex,
+                       QgsWkbTypes)
+
+from tbk_qgis.tbk.utility.tbk_utilities import get_process_pool
+
+# Minimum number of edges to simplify them in parallel processes
+PARALLEL_MIN_EDGES = 20000
+
+
+def douglas_peucker(points, tolerance):
+    """
+    Douglas-Peucker simplification of a line keeping its end points (same as v.generalize method douglas). For
+    closed lines the distances are measured to the start point.
+
+    :param points: Array (n, 2) with the vertices
+    :param tolerance: Maximal distance of removed vertices to the simplified line
+    :return: Array with the kept vertices
+    """
+    n = len(points)
+    if n <= 2:
+        return points
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = points[first]
+        segment = points[last] - start
+        inner = points[first + 1:last] - start
+        segment_length = np.hypot(segment[0], segment[1])
+        if segment_length > 0:
+            distances = np.abs(segment[0] * inner[:, 1] - segment[1] * inner[:, 0]) / segment_length
+        else:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        i_max = int(np.argmax(distances))
+        if distances[i_max] > tolerance:
+            split = first + 1 + i_max
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+
+def simplify_edges(edges, tolerance):
+    """
+    Simplify edges of the mosaic (see douglas_peucker). Closed edges which would collapse to less than a triangle
+    are not simplified.
+
+    :param edges: List of arrays (n, 2) with the vertices of each edge
+    :return: List with the simplified edges
+    """
+    simplified = []
+    for edge in edges:
+        edge_simplified = douglas_peucker(edge, tolerance)
+        if np.array_equal(edge[0], edge[-1]) and len(edge_simplified) < 4:
+            edge_simplified = edge
+        simplified.append(edge_simplified)
+    return simplified
+
+
+def _get_rings(geom):
+    polygons = geom.asMultiPolygon() if geom.isMultipart() else [geom.asPolygon()]
+    parts = []
+    for polygon in polygons:
+        rings = []
+        for ring in polygon:
+            vertices = [(p.x(), p.y()) for p in ring]
+            # open ring without repeated vertices
+            vertices = [v for i, v in enumerate(vertices) if i == 0 or v != vertices[i - 1]]
+            if len(vertices) > 1 and vertices[0] == vertices[-1]:
+                vertices.pop()
+            if len(vertices) >= 3:
+                rings.append(vertices)
+        if rings:
+            parts.append(rings)
+    return parts
+
+
+def _insert_boundary_vertices(polygon_rings):
+    """
+    Insert the vertices of all rings into the axis-parallel segments of other rings they lie on (e.g. where two
+    polygons meet on the straight boundary of a third polygon), so that neighbouring polygons have the same vertices
+    along their common boundary. Polygons derived from a raster only have axis-parallel segments.
+
+    :param polygon_rings: Dict with the parts (list of rings, list of vertex tuples) per feature ID (changed in place)
+    """
+    vertices = np.array([v for parts in polygon_rings.values() for rings in parts for ring in rings for v in ring],
+                        dtype=np.float64).reshape(-1, 2)
+    if len(vertices) == 0:
+        return
+    xs, x_ranks = np.unique(vertices[:, 0], return_inverse=True)
+    ys, y_ranks = np.unique(vertices[:, 1], return_inverse=True)
+    n_x, n_y = len(xs), len(ys)
+    # vertices sorted along the rows (y, x) and along the columns (x, y)
+    row_keys = np.unique(y_ranks.astype(np.int64) * n_x + x_ranks)
+    col_keys = np.unique(x_ranks.astype(np.int64) * n_y + y_ranks)
+    x_rank = {x: i for i, x in enumerate(xs.tolist())}
+    y_rank = {y: i for i, y in enumerate(ys.tolist())}
+
+    for parts in polygon_rings.values():
+        for rings in parts:
+            for i_ring, ring in enumerate(rings):
+                new_ring = []
+                for a, b in zip(ring, ring[1:] + ring[:1]):
+                    new_ring.append(a)
+                    if a[1] == b[1]:
+                        row = y_rank[a[1]] * n_x
+                        first, last = sorted((x_rank[a[0]], x_rank[b[0]]))
+                        keys = row_keys[np.searchsorted(row_keys, row + first, side="right"):
+                                        np.searchsorted(row_keys, row + last, side="left")]
+                        inserted = [(xs[key - row], a[1]) for key in keys.tolist()]
+                        reverse = a[0] > b[0]
+                    elif a[0] == b[0]:
+                        col = x_rank[a[0]] * n_y
+                        first, last = sorted((y_rank[a[1]], y_rank[b[1]]))
+                        keys = col_keys[np.searchsorted(col_keys, col + first, side="right"):
+                                        np.searchsorted(col_keys, col + last, side="left")]
+                        inserted = [(a[0], ys[key - col]) for key in keys.tolist()]
+                        reverse = a[1] > b[1]
+                    else:
+                        continue
+                    new_ring.extend(reversed(inserted) if reverse else inserted)
+                rings[i_ring] = [(float(x), float(y)) for x, y in new_ring]
+
+
+class EdgeNetwork:
+    """
+    Shared edges of a polygon mosaic. Edges are the boundary parts between nodes (vertices with more or less than
+    two neighbour vertices), so every edge separates the same two polygons (or a polygon and the outside) and is
+    stored once. Rings without node (e.g. islands) form one closed edge starting at their smallest vertex.
+    """
+
+    def __init__(self, polygon_rings):
+        """
+        :param polygon_rings: Dict with the parts (list of rings, list of vertex tuples) per feature ID
+        """
+        neighbours = defaultdict(set)
+        for parts in polygon_rings.values():
+            for rings in parts:
+                for ring in rings:
+                    for a, b in zip(ring, ring[1:] + ring[:1]):
+                        neighbours[a].add(b)
+                        neighbours[b].add(a)
+        nodes = {v for v, n in neighbours.items() if len(n) != 2}
+
+        edge_ids = {}
+        self.edges = []
+        # per feature: parts -> rings -> list of (edge ID, reversed)
+        self.feature_edges = {}
+        for fid, parts in polygon_rings.items():
+            feature_parts = []
+            for rings in parts:
+                feature_rings = []
+                for ring in rings:
+                    ring_edges = []
+                    for edge in self._split_ring(ring, nodes):
+                        key = tuple(edge)
+                        canonical = min(key, key[::-1])
+                        if canonical not in edge_ids:
+                            edge_ids[canonical] = len(self.edges)
+                            self.edges.append(np.array(canonical, dtype=np.float64))
+                        ring_edges.append((edge_ids[canonical], canonical != key))
+                    feature_rings.append(ring_edges)
+                feature_parts.append(feature_rings)
+            self.feature_edges[fid] = feature_parts
+
+    @staticmethod
+    def _split_ring(ring, nodes):
+        node_positions = [i for i, v in enumerate(ring) if v in nodes]
+        if not node_positions:
+            node_positions = [ring.index(min(ring))]
+        start = node_positions[0]
+        ring = ring[start:] + ring[:start]
+        node_positions = [i - start for i in node_positions] + [len(ring)]
+        ring = ring + ring[:1]
+        return [ring[first:last + 1] for first, last in zip(node_positions[:-1], node_positions[1:])]
+
+    def get_edge_features(self):
+        """:return: Dict with the set of feature IDs bounded by each edge (one or two)"""
+        edge_features = defaultdict(set)
+        for fid, feature_parts in self.feature_edges.items():
+            for feature_rings in feature_parts:
+                for ring_edges in feature_rings:
+                    for edge_id, _ in ring_edges:
+                        edge_features[edge_id].add(fid)
+        return edge_features
+
+    def build_geometry(self, fid, edges):
+        """:return: QgsGeometry of a feature assembled from the given versions of the edges"""
+        polygons = []
+        for feature_rings in self.feature_edges[fid]:
+            rings = []
+            for ring_edges in feature_rings:
+                vertices = []
+                for edge_id, is_reversed in ring_edges:
+                    edge = edges[edge_id][::-1] if is_reversed else edges[edge_id]
+                    vertices.extend(QgsPointXY(x, y) for x, y in edge[:-1])
+                vertices.append(vertices[0])
+                rings.append(vertices)
+            polygons.append(rings)
+        if len(polygons) == 1:
+            return QgsGeometry.fromPolygonXY(polygons[0])
+        return QgsGeometry.fromMultiPolygonXY(polygons)
+
+
+def get_edge_network(features):
+    """
+    :param features: Dict with the polygon QgsFeature per feature ID (polygons must share their boundary vertices)
+    :return: EdgeNetwork of the polygons
+    """
+    polygon_rings = {fid: _get_rings(f.geometry()) for fid, f in features.items() if f.hasGeometry()}
+    _insert_boundary_vertices(polygon_rings)
+    return EdgeNetwork(polygon_rings)
+
+
+def _get_crossing_edges(edges, edge_ids):
+    """:return: IDs of edge_ids which intersect another edge apart from common end points"""
+    geometries = [QgsGeometry.fromPolylineXY([QgsPointXY(x, y) for x, y in edge]) for edge in edges]
+    index = QgsSpatialIndex()
+    for edge_id, geom in enumerate(geometries):
+        index.addFeature(edge_id, geom.boundingBox())
+
+    crossing = set()
+    for edge_id in edge_ids:
+        geom = geometries[edge_id]
+        engine = QgsGeometry.createGeometryEngine(geom.constGet())
+        engine.prepareGeometry()
+        end_points = {tuple(edges[edge_id][0]), tuple(edges[edge_id][-1])}
+        for other in index.intersects(geom.boundingBox()):
+            if other == edge_id or not engine.intersects(geometries[other].constGet()):
+                continue
+            intersection = geom.intersection(geometries[other])
+            if intersection.isEmpty():
+                continue
+            # only touching in common end points (nodes) is allowed
+            if intersection.type() != QgsWkbTypes.PointGeometry:
+                crossing.add(edge_id)
+                break
+            common_points = end_points & {tuple(edges[other][0]), tuple(edges[other][-1])}
+            points = intersection.asMultiPoint() if intersection.isMultipart() else [intersection.asPoint()]
+            if any((p.x(), p.y()) not in common_points for p in points):
+                crossing.add(edge_id)
+                break
+    return crossing
+
+
+def simplify_polygon_mosaic(layer, tolerance, n_processes=1):
+    """
+    Simplify a polygon mosaic without creating gaps or overlaps: the shared edges are extracted once, every edge is
+    simplified once (Douglas-Peucker) and the polygons are reassembled from the simplified edges. Simplified edges
+    which cross other edges or make a polygon invalid are restored, so the result is valid without fixing the
+    geometries.
+
+    :param layer: Polygon QgsVectorLayer (polygons must share their boundary vertices, e.g. polygonized raster)
+    :param tolerance: Simplification tolerance (same as v.generalize threshold)
+    :param n_processes: Number of processes to simplify the edges (None: number of CPUs, 1: no parallel processes)
+    :return: Memory layer with the fields and attributes of the input layer
+    """
+    features = {f.id(): f for f in layer.getFeatures()}
+    network = get_edge_network(features)
+    edges = network.edges
+
+    # simplify every edge once
+    if n_processes != 1 and len(edges) >= PARALLEL_MIN_EDGES:
+        n_chunks = 4 * (n_processes or 8)
+        chunk_size = -(-len(edges) // n_chunks)
+        chunks = [edges[i:i + chunk_size] for i in range(0, len(edges), chunk_size)]
+        with get_process_pool(n_processes) as pool:
+            simplified = [edge for chunk in pool.map(simplify_edges, chunks, [tolerance] * len(chunks))
+                          for edge in chunk]
+    else:
+        simplified = simplify_edges(edges, tolerance)
+
+    # restore edges creating crossings or invalid polygons until the mosaic is valid
+    changed = {edge_id for edge_id, edge in enumerate(simplified) if len(edge) != len(edges[edge_id])}
+    edge_features = network.get_edge_features()
+    bboxes = np.array([np.concatenate([edge.min(axis=0), edge.max(axis=0)]) for edge in edges]).reshape(-1, 4)
+    geometries = {}
+    check_fids = set(network.feature_edges.keys())
+    check_edges = set(changed)
+    while check_fids or check_edges:
+        restore = _get_crossing_edges(simplified, check_edges)
+        for fid in check_fids:
+            geometries[fid] = network.build_geometry(fid, simplified)
+            if not geometries[fid].isGeosValid():
+                restore.update(edge_id for feature_rings in network.feature_edges[fid]
+                               for ring_edges in feature_rings for edge_id, _ in ring_edges if edge_id in changed)
+        # check the polygons and the simplified edges near restored edges again
+        check_fids = set()
+        m_near = np.zeros(len(edges), dtype=bool)
+        for edge_id in restore:
+            simplified[edge_id] = edges[edge_id]
+            changed.discard(edge_id)
+            check_fids.update(edge_features[edge_id])
+            bbox = bboxes[edge_id]
+            m_near |= ((bboxes[:, 0] <= bbox[2]) & (bboxes[:, 2] >= bbox[0]) &
+                       (bboxes[:, 1] <= bbox[3]) & (bboxes[:, 3] >= bbox[1]))
+        check_edges = {edge_id for edge_id in changed if m_near[edge_id]}
+
+    output_layer = QgsMemoryProviderUtils.createMemoryLayer(layer.name(), layer.fields(), layer.wkbType(),
+                                                            layer.crs())
+    output_features = []
+    for fid, f in features.items():
+        out_feature = QgsFeature(layer.fields())
+        out_feature.setAttributes(f.attributes())
+        if fid in geometries:
+            out_feature.setGeometry(geometries[fid])
+        output_features.append(out_feature)
+    output_layer.dataProvider().addFeatures(output_features)
+    return output_layer
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# *************************************************************************** #
+# Cache for the outputs of the processing stages of Generate BK.
+#
+# (C) Hannes Horneber, Christoph Schaller (BFH-HAFL)
+# *************************************************************************** #
+"""
+/***************************************************************************
+    TBk: Toolkit Bestandeskarte (QGIS Plugin)
+    Toolkit for the generating and processing forest stand maps
+    Copyright (C) 2025 BFH-HAFL (hannes.horneber@bfh.ch, christian.rosset@bfh.ch)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+ ***************************************************************************/
+"""
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+# Increase if the format of the cache entries changes (code changes of the stages are covered by get_code_version)
+STAGE_CACHE_VERSION = 2
+_MANIFEST_NAME = "manifest.json"
+_code_version = None
+
+
+def get_code_version():
+    """
+    Returns the plugin version (metadata.txt) and a hash of the plugin's Python sources, so that cache entries of
+    other plugin versions or changed code are not used.
+    """
+    global _code_version
+    if _code_version is None:
+        plugin_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        version = None
+        metadata_path = os.path.join(plugin_dir, "metadata.txt")
+        if os.path.isfile(metadata_path):
+            with open(metadata_path, "r", encoding="utf-8") as f:
+                version = next((line.split("=", 1)[1].strip() for line in f if line.startswith("version=")), None)
+        source_hash = hashlib.sha256()
+        for root, dirs, files in os.walk(plugin_dir):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(".py"):
+                    path = os.path.join(root, name)
+                    source_hash.update(os.path.relpath(path, plugin_dir).encode("utf-8"))
+                    with open(path, "rb") as f:
+                        source_hash.update(f.read())
+        _code_version = [version, source_hash.hexdigest()]
+    return _code_version
+
+
+def get_file_fingerprint(path):
+    """
+    Returns a fingerprint (path, size, modification time) of an input file. QGIS layer sources with options
+    (e.g. "file.gpkg|layername=...") are supported.
+    """
+    if not path:
+        return None
+    file_path = str(path).split("|")[0]
+    if os.path.isfile(file_path):
+        stat = os.stat(file_path)
+        return [os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns]
+    return [str(path)]
+
+
+class StageCache:
+    """
+    Cache for the outputs of the stages of a processing pipeline.
+
+    A stage is identified by a hash of its name, the parameters it uses, the fingerprints of its input files, the
+    code version (see get_code_version) and the key of the previous stage (which represents the outputs of all
+    previous stages). The files a stage creates or modifies in the result directory are copied to the cache
+    directory, the files it deletes are recorded. If a stage with the same key is run again, the files are copied to
+    the result directory (and the deleted files are deleted) instead of running the stage, so unchanged stages are
+    reused and a crashed run resumes after the last completed stage.
+    """
+
+    def __init__(self, cache_dir, result_dir, exclude_files=()):
+        """
+        :param cache_dir: Directory of the cache entries. Use None to disable the cache (all stages are run).
+        :param result_dir: Directory containing all outputs of the stages
+        :param exclude_files: Files in result_dir which are not stage outputs (e.g. the log file)
+        """
+        self.cache_dir = cache_dir
+        self.result_dir = os.path.abspath(result_dir)
+        self.exclude_files = {os.path.abspath(f) for f in exclude_files}
+        self.key = ""
+        self.hits = 0
+        self.misses = 0
+        self.log = logging.getLogger(__name__)
+
+    def run(self, stage_name, stage_function, params=None, input_files=()):
+        """
+        Run a stage or restore its outputs from the cache.
+
+        :param stage_name: Unique name of the stage
+        :param stage_function: Function without arguments running the stage
+        :param params: Dict with all parameters the stage uses
+        :param input_files: Input files of the stage not created by a previous stage
+        :return: Return value of stage_function (file paths in result_dir are relocated on cache hits)
+        """
+        self.key = hashlib.sha256(json.dumps({"version": STAGE_CACHE_VERSION,
+                                              "code": get_code_version(),
+                                              "previous": self.key,
+                                              "stage": stage_name,
+                                              "params": params or {},
+                                              "inputs": [get_file_fingerprint(f) for f in input_files]},
+                                             sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        if not self.cache_dir:
+            return stage_function()
+
+        entry_dir = os.path.join(self.cache_dir, f"{stage_name}_{self.key[:20]}")
+        manifest_path = os.path.join(entry_dir, _MANIFEST_NAME)
+        if os.path.isfile(manifest_path):
+            self.hits += 1
+            self.log.info(f"   --- stage cache hit: {stage_name} ({entry_dir})")
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            for rel_path in manifest["files"]:
+                dst_path = os.path.join(self.result_dir, rel_path)
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                shutil.copy2(os.path.join(entry_dir, "files", rel_path), dst_path)
+            for rel_path in manifest.get("deleted", []):
+                path = os.path.join(self.result_dir, rel_path)
+                if os.path.isfile(path):
+                    os.remove(path)
+            return self._from_manifest_value(manifest["result"])
+
+        self.misses += 1
+        self.log.info(f"   --- stage cache miss: {stage_name}")
+        before = self._get_file_states()
+        result = stage_function()
+        after = self._get_file_states()
+        outputs = sorted(rel_path for rel_path, state in after.items() if before.get(rel_path) != state)
+        deleted = sorted(rel_path for rel_path in before if rel_path not in after)
+
+        # write the entry to a temporary directory first, so that incomplete entries are never used
+        tmp_dir = entry_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        for rel_path in outputs:
+            dst_path = os.path.join(tmp_dir, "files", rel_path)
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            shutil.copy2(os.path.join(self.result_dir, rel_path), dst_path)
+        os.makedirs(tmp_dir, exist_ok=True)
+        with open(os.path.join(tmp_dir, _MANIFEST_NAME), "w", encoding="utf-8") as f:
+            json.dump({"stage": stage_name, "files": outputs, "deleted": deleted,
+                       "result": self._to_manifest_value(result)}, f, indent=2)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+        return result
+
+    def _get_file_states(self):
+        states = {}
+        for root, dirs, files in os.walk(self.result_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if path in self.exclude_files:
+                    continue
+                stat = os.stat(path)
+                states[os.path.relpath(path, self.result_dir)] = (stat.st_size, stat.st_mtime_ns)
+        return states
+
+    def _to_manifest_value(self, value):
+        # store paths in result_dir relative to it, since every run has its own result_dir
+        if isinstance(value, str) and os.path.abspath(value).startswith(self.result_dir + os.sep):
+            return {"result_path": os.path.relpath(os.path.abspath(value), self.result_dir)}
+        return {"value": value}
+
+    def _from_manifest_value(self, value):
+        if "result_path" in value:
+            return os.path.join(self.result_dir, value["result_path"])
+        return value["value"]
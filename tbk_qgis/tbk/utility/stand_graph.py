@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+# *************************************************************************** #
+# Adjacency graph of stand polygons and merging of stands with union-find.
+#
+# (C) Hannes Horneber, Christoph Schaller (BFH-HAFL)
+# *************************************************************************** #
+"""
+/***************************************************************************
+    TBk: Toolkit Bestandeskarte (QGIS Plugin)
+    Toolkit for the generating and processing forest stand maps
+    Copyright (C) 2025 BFH-HAFL (hannes.horneber@bfh.ch, christian.rosset@bfh.ch)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+ ***************************************************************************/
+"""
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import heapq
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from PyQt5.QtCore import QVariant
+from qgis.core import (QgsFeature,
+                       QgsField,
+                       QgsFields,
+                       QgsGeometry,
+                       QgsMemoryProviderUtils,
+                       QgsSpatialIndex)
+
+from tbk_qgis.tbk.utility.mosaic_simplification import get_edge_network
+
+
+class UnionFind:
+    """
+    Disjoint sets of (stand) IDs with path compression. The root of a set is the ID the set was merged into, so
+    the surviving stand of a merge keeps its ID (and attributes).
+    """
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        parent = self.parent
+        root = x
+        while parent.get(root, root) != root:
+            root = parent[root]
+        # path compression
+        while x != root:
+            x, parent[x] = parent[x], root
+        return root
+
+    def union(self, into, other):
+        """Merge the set of other into the set of into.
+        :return: Root of the merged set
+        """
+        root_into = self.find(into)
+        root_other = self.find(other)
+        if root_into != root_other:
+            # register the root, so groups() lists it as member
+            self.parent.setdefault(root_into, root_into)
+            self.parent[root_other] = root_into
+        return root_into
+
+    def groups(self):
+        """:return: Dict with the members per root (only sets with more than one member)"""
+        groups = defaultdict(list)
+        for x in list(self.parent.keys()):
+            groups[self.find(x)].append(x)
+        return {root: members for root, members in groups.items() if len(members) > 1}
+
+
+def build_adjacency_graph(geometries, fids=None):
+    """
+    Adjacency graph of polygons with the length of the common boundary per neighbour (polygons touching in single
+    points only are no neighbours).
+
+    :param geometries: Dict with the QgsGeometry per feature ID
+    :param fids: Feature IDs whose neighbours are needed (default: all)
+    :return: Dict with a dict {neighbour fid: common boundary length} per feature ID of fids
+    """
+    index = QgsSpatialIndex()
+    for fid, geom in geometries.items():
+        index.addFeature(fid, geom.boundingBox())
+
+    fids = set(geometries.keys()) if fids is None else set(fids)
+    graph = {fid: {} for fid in fids}
+    for fid in sorted(fids):
+        geom = geometries[fid]
+        # use prepared geometries for faster intersection tests
+        engine = QgsGeometry.createGeometryEngine(geom.constGet())
+        engine.prepareGeometry()
+        for other in index.intersects(geom.boundingBox()):
+            # every pair is calculated once
+            if other == fid or (other in fids and other < fid):
+                continue
+            other_geom = geometries[other]
+            if not engine.intersects(other_geom.constGet()):
+                continue
+            length = geom.intersection(other_geom).length()
+            if length > 0:
+                graph[fid][other] = length
+                if other in graph:
+                    graph[other][fid] = length
+    return graph
+
+
+def _get_edge_table(src, nbr, lengths):
+    """Sum the lengths per pair and add both directions of every pair"""
+    table = pd.DataFrame({"src": src, "nbr": nbr, "length": lengths})
+    table = table[table.src != table.nbr].groupby(["src", "nbr"], as_index=False)["length"].sum()
+    reverse = table.rename(columns={"src": "nbr", "nbr": "src"})
+    return pd.concat([table, reverse], ignore_index=True).sort_values(["src", "nbr"], ignore_index=True)
+
+
+def build_edge_table(layer):
+    """
+    Neighbour table of a polygon mosaic with the length of the common boundary per pair, from the shared edges of
+    the mosaic (see mosaic_simplification.EdgeNetwork) without pairwise geometry operations.
+    Polygons touching in single points only are no neighbours.
+
+    :param layer: Polygon QgsVectorLayer (polygons must share their boundary vertices, e.g. simplified stands)
+    :return: pandas DataFrame with the columns src, nbr (feature IDs) and length, one row per pair and direction
+    """
+    network = get_edge_network({f.id(): f for f in layer.getFeatures()})
+    src, nbr, lengths = [], [], []
+    for edge_id, fids in network.get_edge_features().items():
+        # edges on the outer boundary of the mosaic have one polygon only
+        if len(fids) != 2:
+            continue
+        edge = network.edges[edge_id]
+        fid_a, fid_b = sorted(fids)
+        src.append(fid_a)
+        nbr.append(fid_b)
+        lengths.append(np.hypot(*np.diff(edge, axis=0).T).sum())
+    return _get_edge_table(np.array(src, dtype=np.int64), np.array(nbr, dtype=np.int64),
+                           np.array(lengths, dtype=np.float64))
+
+
+def eliminate_selected_polygons(layer, feedback=None):
+    """
+    Merge the selected polygons of a layer into the not selected neighbour with the longest common boundary (same as
+    qgis:eliminateselectedpolygons MODE 2), repeated until no more polygons can be merged.
+
+    The adjacency graph is built once. Selected polygons are processed from the smallest to the largest, a polygon
+    merged into a neighbour adds its boundaries to that neighbour (union-find), which allows selected polygons
+    without unselected neighbour to be merged in a later round. Geometries are dissolved once at the end.
+
+    :param layer: Polygon QgsVectorLayer with the polygons to eliminate selected
+    :param feedback: Optional QgsProcessingFeedback for progress messages
+    :return: Memory layer with the fields of the input layer, merged polygons keep the attributes of the neighbour,
+             polygons which could not be merged are kept
+    """
+    features = {f.id(): f for f in layer.getFeatures()}
+    geometries = {fid: f.geometry() for fid, f in features.items() if f.hasGeometry()}
+    selected = set(layer.selectedFeatureIds()) & set(geometries.keys())
+    graph = build_adjacency_graph(geometries, selected)
+
+    merged = UnionFind()
+    queue = [(geometries[fid].area(), fid) for fid in selected]
+    heapq.heapify(queue)
+    made_progress = True
+    while made_progress and queue:
+        made_progress = False
+        not_eliminated = []
+        while queue:
+            area, fid = heapq.heappop(queue)
+            # common boundary with the merged groups of unselected polygons
+            boundaries = defaultdict(float)
+            for neighbour, length in graph[fid].items():
+                root = merged.find(neighbour)
+                if root not in selected:
+                    boundaries[root] += length
+            merge_with = None
+            max_length = 0
+            for root in sorted(boundaries.keys()):
+                if boundaries[root] > max_length:
+                    max_length = boundaries[root]
+                    merge_with = root
+            if merge_with is not None:
+                merged.union(merge_with, fid)
+                made_progress = True
+            else:
+                not_eliminated.append((area, fid))
+        queue = not_eliminated
+        heapq.heapify(queue)
+    if feedback is not None:
+        feedback.pushInfo(f"{len(selected) - len(queue)} polygons eliminated, {len(queue)} not eliminated")
+
+    # dissolve the merged polygons
+    output_layer = QgsMemoryProviderUtils.createMemoryLayer(layer.name(), layer.fields(), layer.wkbType(),
+                                                            layer.crs())
+    groups = merged.groups()
+    eliminated = {fid for members in groups.values() for fid in members if fid in selected}
+    output_features = []
+    for fid, f in features.items():
+        if fid in eliminated:
+            continue
+        out_feature = QgsFeature(layer.fields())
+        out_feature.setAttributes(f.attributes())
+        if fid in groups:
+            out_feature.setGeometry(QgsGeometry.unaryUnion([geometries[member] for member in groups[fid]]))
+        elif f.hasGeometry():
+            out_feature.setGeometry(f.geometry())
+        output_features.append(out_feature)
+    output_layer.dataProvider().addFeatures(output_features)
+    return output_layer
+
+
+def resolve_merge_groups(edge_table, stands, min_area, max_hdom_diff_rel, max_area=None):
+    """
+    Resolve the merges of small stands into similar neighbours. Every small stand (area < min_area) is merged into
+    its best partner: a classified neighbour with a relative hdom difference < max_hdom_diff_rel, the smallest
+    difference first and the longest common boundary second. Merged stands form groups (union-find) with the
+    attributes (hdom, type) of their largest member and the sum of the areas. Groups which are still small are
+    merged again until no more merges are possible. As every stand belongs to exactly one group, the dissolved groups
+    can't overlap.
+
+    :param edge_table: Neighbour table with the columns src, nbr and length (see build_edge_table)
+    :param stands: pandas DataFrame indexed like src/nbr with the columns hdom, type and area_m2
+    :param min_area: Stands (groups) with a smaller area are merged
+    :param max_hdom_diff_rel: Maximum relative hdom difference (|hdom - partner hdom| / hdom) of merged stands
+    :param max_area: Maximum area of merged groups (default: no limit)
+    :return: Dict with the members per group (only groups with more than one member)
+    """
+    merged = UnionFind()
+    group_area = stands["area_m2"].astype(float).to_dict()
+    # largest member of each group, whose attributes the group keeps
+    group_largest = {fid: fid for fid in stands.index}
+    member_area = group_area.copy()
+    hdom = stands["hdom"].astype(float).to_dict()
+    stand_type = stands["type"].to_dict()
+    src_fids = edge_table["src"].to_numpy()
+    nbr_fids = edge_table["nbr"].to_numpy()
+    lengths = edge_table["length"].to_numpy()
+
+    while True:
+        # neighbour table of the groups
+        groups = pd.DataFrame({"src": [merged.find(fid) for fid in src_fids.tolist()],
+                               "nbr": [merged.find(fid) for fid in nbr_fids.tolist()],
+                               "length": lengths})
+        groups = groups[(groups.src != groups.nbr) & (groups.length > 0)]
+        groups = groups.groupby(["src", "nbr"], as_index=False)["length"].sum()
+        src_largest = groups.src.map(group_largest)
+        nbr_largest = groups.nbr.map(group_largest)
+        groups["src_area"] = groups.src.map(group_area)
+        groups["nbr_area"] = groups.nbr.map(group_area)
+        src_hdom = src_largest.map(hdom)
+        groups["hdom_diff_rel"] = (src_hdom - nbr_largest.map(hdom)).abs() / src_hdom
+        m_candidates = ((groups.src_area < min_area) &
+                        (groups.hdom_diff_rel < max_hdom_diff_rel) &
+                        (nbr_largest.map(stand_type) == "classified"))
+        if max_area is not None:
+            m_candidates &= groups.src_area + groups.nbr_area <= max_area
+        candidates = groups[m_candidates]
+        if candidates.empty:
+            break
+
+        # best partner of every small group, smallest groups first
+        best = (candidates.sort_values(["hdom_diff_rel", "length"], ascending=[True, False])
+                .drop_duplicates("src")
+                .sort_values(["src_area", "src"]))
+        made_progress = False
+        for src, nbr in zip(best.src.tolist(), best.nbr.tolist()):
+            root_src = merged.find(src)
+            root_nbr = merged.find(nbr)
+            if root_src == root_nbr:
+                continue
+            area = group_area[root_src] + group_area[root_nbr]
+            if max_area is not None and area > max_area:
+                continue
+            largest = max(group_largest[root_nbr], group_largest[root_src], key=lambda fid: (member_area[fid], -fid))
+            root = merged.union(root_nbr, root_src)
+            group_area[root] = area
+            group_largest[root] = largest
+            made_progress = True
+        if not made_progress:
+            break
+
+    return merged.groups()
+
+
+def dissolve_groups(layer, groups):
+    """
+    Dissolve groups of features in one pass over the layer, each group keeps the attributes of its largest member.
+
+    :param layer: Polygon QgsVectorLayer
+    :param groups: Dict with the list of member feature IDs per group key
+    :return: Memory layer with the fields of the input layer and the field merged (1: dissolved group, 0: feature
+             in no group), dissolved groups first
+    """
+    fields = QgsFields(layer.fields())
+    fields.append(QgsField("merged", QVariant.Int))
+    features = {f.id(): f for f in layer.getFeatures()}
+
+    output_features = []
+    grouped = set()
+    for members in groups.values():
+        members = [fid for fid in members if fid in features]
+        if not members:
+            continue
+        grouped.update(members)
+        geometries = [features[fid].geometry() for fid in members]
+        largest = max(range(len(members)), key=lambda i: geometries[i].area())
+        out_feature = QgsFeature(fields)
+        out_feature.setAttributes(features[members[largest]].attributes() + [1])
+        out_feature.setGeometry(QgsGeometry.unaryUnion(geometries))
+        output_features.append(out_feature)
+    for fid, f in features.items():
+        if fid in grouped:
+            continue
+        out_feature = QgsFeature(fields)
+        out_feature.setAttributes(f.attributes() + [0])
+        if f.hasGeometry():
+            out_feature.setGeometry(f.geometry())
+        output_features.append(out_feature)
+
+    output_layer = QgsMemoryProviderUtils.createMemoryLayer(layer.name(), fields, layer.wkbType(), layer.crs())
+    output_layer.dataProvider().addFeatures(output_features)
+    return output_layer
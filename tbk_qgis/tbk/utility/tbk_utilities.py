@@ -36,7 +36,11 @@ from qgis.core import *
 
 import os
 import sys
+import json
+import hashlib
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from osgeo import ogr
 from osgeo import gdal
@@ -122,6 +126,102 @@ def create_empty_copy(input_raster, output_raster):
     out_ds = None
 
 
+#Function to rasterize the feature IDs (fid) of a vector layer on the grid of a reference raster
+def rasterize_feature_ids(vector_file, reference_raster, output_file="", driver_name="MEM", options=None,
+                          feature_ids=None):
+    """Burn the feature ID (fid) of each feature into a UInt32 label raster aligned with a reference raster.
+    Cells are assigned to a feature if their center is within the feature, cells without feature are 0.
+
+    :param vector_file: Vector file (or open gdal dataset) of the features (first layer is used)
+    :param reference_raster: Raster file defining extent, resolution and projection
+    :param output_file: Output file (ignored for the MEM driver)
+    :param driver_name: GDAL driver of the label raster
+    :param options: Creation options of the label raster
+    :param feature_ids: Feature IDs to rasterize (default: all)
+    :return: gdal.Dataset of the label raster
+    """
+    ref_ds = gdal.Open(reference_raster, gdal.GA_ReadOnly)
+    out_ds = gdal.GetDriverByName(driver_name).Create(output_file, ref_ds.RasterXSize, ref_ds.RasterYSize, 1,
+                                                      gdal.GDT_UInt32, options=options or [])
+    out_ds.SetGeoTransform(ref_ds.GetGeoTransform())
+    out_ds.SetProjection(ref_ds.GetProjection())
+    ref_ds = None
+
+    vector_ds = gdal.OpenEx(vector_file, gdal.OF_VECTOR) if isinstance(vector_file, str) else vector_file
+    layer = vector_ds.GetLayer()
+    if layer.GetFIDColumn():
+        # e.g. GeoPackage: SQLite dialect with the fid column
+        sql = f'SELECT "{layer.GetFIDColumn()}" AS feature_id, "{layer.GetGeometryColumn()}" FROM "{layer.GetName()}"'
+    else:
+        sql = f'SELECT FID AS feature_id FROM "{layer.GetName()}"'
+    if feature_ids is not None:
+        fid_column = f'"{layer.GetFIDColumn()}"' if layer.GetFIDColumn() else "FID"
+        sql += f' WHERE {fid_column} IN ({", ".join(str(int(fid)) for fid in feature_ids)})'
+    sql_layer = vector_ds.ExecuteSQL(sql)
+    gdal.RasterizeLayer(out_ds, [1], sql_layer, options=["ATTRIBUTE=feature_id"])
+    vector_ds.ReleaseResultSet(sql_layer)
+    out_ds.FlushCache()
+    return out_ds
+
+#Function to get the (cached) stand ID raster of a stand map on the grid of a reference raster
+def get_stand_id_raster(stands_file, reference_raster, tmp_output_folder):
+    """Get a UInt32 label raster with the stand fid per cell of a reference raster (see rasterize_feature_ids).
+    The label raster is created once per stand map and grid in <tmp_output_folder>/stand_ids and reused by all
+    later calls (e.g. DG and coniferous proportion). Attribute changes of the stand map keep the label raster valid,
+    it is identified by the file name, feature count, extent and a hash of the feature IDs and geometries of the
+    stand map and the grid of the reference raster.
+
+    :param stands_file: Stand map (e.g. stands_clipped.gpkg)
+    :param reference_raster: Raster file defining extent, resolution and projection
+    :param tmp_output_folder: Folder for temporary files
+    :return: Path of the label raster (GeoTIFF)
+    """
+    ref_ds = gdal.Open(reference_raster, gdal.GA_ReadOnly)
+    grid = [ref_ds.GetGeoTransform(), ref_ds.RasterXSize, ref_ds.RasterYSize, ref_ds.GetProjection()]
+    ref_ds = None
+    vector_ds = gdal.OpenEx(stands_file, gdal.OF_VECTOR)
+    layer = vector_ds.GetLayer()
+    # hash of the feature IDs and geometries: attribute changes (e.g. DG written before NH) keep the key, changed
+    # geometries with the same feature count and extent don't
+    geometry_hash = hashlib.sha1()
+    layer.SetIgnoredFields([layer.GetLayerDefn().GetFieldDefn(i).GetName()
+                            for i in range(layer.GetLayerDefn().GetFieldCount())])
+    for f in layer:
+        geom = f.GetGeometryRef()
+        geometry_hash.update(str(f.GetFID()).encode("utf-8"))
+        if geom is not None:
+            geometry_hash.update(geom.ExportToWkb())
+    layer.SetIgnoredFields([])
+    layer.ResetReading()
+    fingerprint = [os.path.basename(stands_file), layer.GetFeatureCount(), layer.GetExtent(), grid,
+                   geometry_hash.hexdigest()]
+    key = hashlib.sha1(json.dumps(fingerprint).encode("utf-8")).hexdigest()[:16]
+
+    stand_id_folder = os.path.join(tmp_output_folder, "stand_ids")
+    stand_id_raster = os.path.join(stand_id_folder,
+                                   f"{os.path.splitext(os.path.basename(stands_file))[0]}_ids_{key}.tif")
+    if not os.path.exists(stand_id_raster):
+        ensure_dir(stand_id_folder)
+        # write to a temporary file first, so that incomplete label rasters are never used
+        tmp_raster = os.path.join(stand_id_folder, f"tmp_{key}.tif")
+        out_ds = rasterize_feature_ids(vector_ds, reference_raster, tmp_raster, "GTiff",
+                                       ["COMPRESS=DEFLATE", "TILED=YES"])
+        out_ds = None
+        os.replace(tmp_raster, stand_id_raster)
+        print("File %s saved" % stand_id_raster)
+    vector_ds = None
+    return stand_id_raster
+
+#Function to get the path of a raster which may be stored as VRT
+def resolve_raster_file(raster):
+    """Returns the raster path, or the VRT with the same name if only the VRT exists
+    (e.g. dg_layers/dg_layer_os.tif of bit-packed DG layers, see calculate_dg).
+    """
+    vrt = os.path.splitext(raster)[0] + ".vrt"
+    if not os.path.exists(raster) and os.path.exists(vrt):
+        return vrt
+    return raster
+
 # Delete files
 # Code basing on https://gis.stackexchange.com/a/190435
 def delete_shapefile_old(path):
@@ -152,6 +252,23 @@ def ensure_dir (path):
     if not os.path.isdir(path):
         return os.makedirs(path, exist_ok=True)
 
+def get_process_pool(n_processes=None):
+    """Function to create a pool of worker processes
+    Within QGIS, sys.executable is the QGIS application and not a python interpreter,
+    the worker processes are then started with the python interpreter of the QGIS installation.
+
+    :param n_processes: Number of worker processes (None: number of CPUs)
+    :return: concurrent.futures.ProcessPoolExecutor
+    """
+    context = multiprocessing.get_context('spawn')
+    if not os.path.basename(sys.executable).lower().startswith('python'):
+        for python_exe in [os.path.join(sys.exec_prefix, 'python3.exe'), os.path.join(sys.exec_prefix, 'python.exe'),
+                           os.path.join(sys.exec_prefix, 'bin', 'python3')]:
+            if os.path.isfile(python_exe):
+                context.set_executable(python_exe)
+                break
+    return ProcessPoolExecutor(max_workers=n_processes, mp_context=context)
+
 def getVectorSaveOptions(format, encoding, only_selected_features = False, in_crs = None, out_crs = None):
     save_options = QgsVectorFileWriter.SaveVectorOptions()
     save_options.driverName = format
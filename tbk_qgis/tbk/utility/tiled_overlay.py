@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# *************************************************************************** #
+# Clip stands to a perimeter and eliminate gaps tile by tile in parallel processes.
+#
+# (C) Hannes Horneber, Christoph Schaller (BFH-HAFL)
+# *************************************************************************** #
+"""
+/***************************************************************************
+    TBk: Toolkit Bestandeskarte (QGIS Plugin)
+    Toolkit for the generating and processing forest stand maps
+    Copyright (C) 2025 BFH-HAFL (hannes.horneber@bfh.ch, christian.rosset@bfh.ch)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+ ***************************************************************************/
+"""
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import math
+import os
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+
+from osgeo import ogr
+from qgis.core import (QgsFeature,
+                       QgsFeatureRequest,
+                       QgsGeometry,
+                       QgsMemoryProviderUtils,
+                       QgsRectangle,
+                       QgsSpatialIndex,
+                       QgsWkbTypes)
+
+from tbk_qgis.tbk.utility.stand_graph import UnionFind
+from tbk_qgis.tbk.utility.tbk_utilities import get_process_pool
+
+
+def _from_wkb(wkb):
+    geom = ogr.CreateGeometryFromWkb(wkb)
+    if geom is not None and not geom.IsValid():
+        geom = geom.Buffer(0)
+    return geom
+
+
+def _get_polygon_parts(geom):
+    """:return: List with the (single) polygons of an OGR geometry with area > 0"""
+    if geom is None or geom.IsEmpty():
+        return []
+    if geom.GetGeometryType() in (ogr.wkbPolygon, ogr.wkbPolygon25D):
+        return [geom] if geom.GetArea() > 0 else []
+    parts = []
+    for i in range(geom.GetGeometryCount()):
+        parts.extend(_get_polygon_parts(geom.GetGeometryRef(i).Clone()))
+    return parts
+
+
+def overlay_tile(task):
+    """
+    Clip the stands of a tile to the perimeter and determine the gaps of the tile (perimeter parts without stand)
+    with the length of their common boundary with each stand, run in a worker process by clip_to_perimeter_tiled.
+
+    :param task: Dict with the tile rectangle (xmin, ymin, xmax, ymax), the perimeter (WKB, clipped to the extent of
+                 the stands) and the stands (list of (stand ID, WKB, owned by the tile)) intersecting the tile
+    :return: Dict with the clipped owned stands (WKB per stand ID, None: outside the perimeter) and the gaps (list of
+             (WKB, dict with the common boundary length per stand ID))
+    """
+    xmin, ymin, xmax, ymax = task['rect']
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in ((xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax), (xmin, ymin)):
+        ring.AddPoint_2D(x, y)
+    rect = ogr.Geometry(ogr.wkbPolygon)
+    rect.AddGeometry(ring)
+
+    perimeter = _from_wkb(task['perimeter'])
+    clipped = {}
+    result = {'stands': {}, 'gaps': []}
+    for stand_id, wkb, owned in task['stands']:
+        geom = _from_wkb(wkb).Intersection(perimeter)
+        parts = _get_polygon_parts(geom)
+        if parts:
+            clipped[stand_id] = geom
+        if owned:
+            result['stands'][stand_id] = geom.ExportToWkb() if parts else None
+
+    # gaps of the tile
+    covered = ogr.Geometry(ogr.wkbMultiPolygon)
+    for geom in clipped.values():
+        for part in _get_polygon_parts(geom):
+            covered.AddGeometry(part)
+    gaps = perimeter.Intersection(rect)
+    if not covered.IsEmpty():
+        gaps = gaps.Difference(covered.UnionCascaded())
+
+    # every stand touching a gap of the tile intersects the tile, so the lengths are complete within the tile
+    for gap in _get_polygon_parts(gaps):
+        lengths = {}
+        for stand_id in sorted(clipped.keys()):
+            geom = clipped[stand_id]
+            if gap.Intersects(geom):
+                length = gap.Intersection(geom).Length()
+                if length > 0:
+                    lengths[stand_id] = length
+        result['gaps'].append((gap.ExportToWkb(), lengths))
+    return result
+
+
+def clip_to_perimeter_tiled(stands_layer, perimeter_layer, tile_size, n_processes=None):
+    """
+    Clip the stands to the perimeter and eliminate the gaps between stands and perimeter (gaps are merged into the
+    stand with the longest common boundary, gaps without stand are removed) on a regular grid of tiles in parallel
+    processes.
+
+    Every stand is clipped entirely by the tile containing the center of its bounding box, so stands are not cut at
+    the tile seams. Gaps are cut at the seams, the gap parts are stitched by connectivity and every gap is merged
+    into the stand with the longest common boundary summed over its parts, so the result is the same as without
+    tiles.
+
+    The tiles are prepared while the workers run (at most two tiles per worker are queued) and the results are
+    collected as they arrive, so only the stand geometries of the queued tiles are held besides the result.
+
+    :param stands_layer: Polygon QgsVectorLayer with the stands
+    :param perimeter_layer: Polygon QgsVectorLayer with the perimeter (same CRS as the stands)
+    :param tile_size: Tile size in map units
+    :param n_processes: Number of worker processes (None: number of CPUs)
+    :return: Memory layer with the fields of the stands layer, stands outside the perimeter are removed
+    """
+    # bounding boxes of the stands, the geometries are read tile by tile
+    stand_index = QgsSpatialIndex()
+    stand_bboxes = {}
+    for f in stands_layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+        if f.hasGeometry():
+            stand_bboxes[f.id()] = f.geometry().boundingBox()
+            stand_index.addFeature(f.id(), stand_bboxes[f.id()])
+    perimeter_geometries = [f.geometry() for f in perimeter_layer.getFeatures() if f.hasGeometry()]
+    perimeter_index = QgsSpatialIndex()
+    for i, geom in enumerate(perimeter_geometries):
+        perimeter_index.addFeature(i, geom.boundingBox())
+
+    # regular grid of tiles over the perimeter
+    extent = QgsRectangle()
+    extent.setMinimal()
+    for geom in perimeter_geometries:
+        extent.combineExtentWith(geom.boundingBox())
+    n_tile_cols = max(1, math.ceil(extent.width() / tile_size))
+    n_tile_rows = max(1, math.ceil(extent.height() / tile_size))
+
+    def get_tasks():
+        for tile_row in range(n_tile_rows):
+            for tile_col in range(n_tile_cols):
+                xmin = extent.xMinimum() + tile_col * tile_size
+                ymin = extent.yMinimum() + tile_row * tile_size
+                rect = QgsRectangle(xmin, ymin, xmin + tile_size, ymin + tile_size)
+                clip_extent = QgsRectangle(rect)
+                stands = []
+                request = QgsFeatureRequest().setFilterFids(stand_index.intersects(rect)).setNoAttributes()
+                for f in stands_layer.getFeatures(request):
+                    bbox = stand_bboxes[f.id()]
+                    center = bbox.center()
+                    # bounding box centers on the seams belong to the upper/right tile, outside the grid to the
+                    # border tile
+                    col = min(max(math.floor((center.x() - extent.xMinimum()) / tile_size), 0), n_tile_cols - 1)
+                    row = min(max(math.floor((center.y() - extent.yMinimum()) / tile_size), 0), n_tile_rows - 1)
+                    stands.append((f.id(), f.geometry().asWkb().data(), (col, row) == (tile_col, tile_row)))
+                    clip_extent.combineExtentWith(bbox)
+                perimeter_parts = [perimeter_geometries[i].clipped(clip_extent)
+                                   for i in perimeter_index.intersects(clip_extent)]
+                perimeter_parts = [geom for geom in perimeter_parts if not geom.isEmpty()]
+                if not perimeter_parts:
+                    continue
+                perimeter = QgsGeometry.unaryUnion(perimeter_parts)
+                yield {'rect': (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()),
+                       'perimeter': perimeter.asWkb().data(),
+                       'stands': stands}
+
+    parts = {}
+    tile_gap_parts = {}
+
+    def collect(i_tile, result):
+        for fid, wkb in result['stands'].items():
+            if wkb is not None:
+                parts.setdefault(fid, []).append(QgsGeometry.fromWkb(wkb))
+        tile_gap_parts[i_tile] = [(QgsGeometry.fromWkb(wkb), lengths) for wkb, lengths in result['gaps']]
+
+    max_pending = 2 * (n_processes or os.cpu_count() or 1)
+    n_tiles = 0
+    print("clip tiles...")
+    with get_process_pool(n_processes) as pool:
+        pending = {}
+        for i_tile, task in enumerate(get_tasks()):
+            pending[pool.submit(overlay_tile, task)] = i_tile
+            n_tiles += 1
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(pending.pop(future), future.result())
+        for future in as_completed(pending):
+            collect(pending[future], future.result())
+    print("%s tiles clipped" % n_tiles)
+
+    # --- stitch the gap parts of neighbouring tiles (touching at a seam) to gaps, in tile order (independent of the
+    # order the results arrive)
+    gap_parts = []
+    gap_tiles = []
+    for i_tile in sorted(tile_gap_parts):
+        gap_parts.extend(tile_gap_parts[i_tile])
+        gap_tiles.extend([i_tile] * len(tile_gap_parts[i_tile]))
+    del tile_gap_parts
+    gap_index = QgsSpatialIndex()
+    for i, (geom, lengths) in enumerate(gap_parts):
+        gap_index.addFeature(i, geom.boundingBox())
+    connected = UnionFind()
+    for i, (geom, lengths) in enumerate(gap_parts):
+        for j in gap_index.intersects(geom.boundingBox()):
+            if j > i and gap_tiles[j] != gap_tiles[i] and geom.intersects(gap_parts[j][0]):
+                connected.union(i, j)
+
+    # --- merge every gap into the stand with the longest common boundary (summed over the parts)
+    gaps = {}
+    for i in range(len(gap_parts)):
+        gaps.setdefault(connected.find(i), []).append(i)
+    n_removed = 0
+    for members in gaps.values():
+        lengths = {}
+        for i in members:
+            for fid, length in gap_parts[i][1].items():
+                lengths[fid] = lengths.get(fid, 0) + length
+        # longest boundary, the smallest stand ID on ties
+        lengths = {fid: length for fid, length in lengths.items() if fid in parts}
+        if not lengths:
+            n_removed += 1
+            continue
+        merge_with = min(lengths, key=lambda fid: (-lengths[fid], fid))
+        parts[merge_with].extend(gap_parts[i][0] for i in members)
+    geometries = {fid: QgsGeometry.unaryUnion(geoms) for fid, geoms in parts.items()}
+    print("%s gaps could not be eliminated and are removed" % n_removed)
+
+    output_layer = QgsMemoryProviderUtils.createMemoryLayer(stands_layer.name(), stands_layer.fields(),
+                                                            QgsWkbTypes.MultiPolygon, stands_layer.crs())
+    output_features = []
+    for f in stands_layer.getFeatures(QgsFeatureRequest().setFilterFids(list(geometries))):
+        fid = f.id()
+        if geometries[fid].area() <= 0:
+            continue
+        geom = geometries[fid]
+        geom.convertToMultiType()
+        out_feature = QgsFeature(stands_layer.fields())
+        out_feature.setAttributes(f.attributes())
+        out_feature.setGeometry(geom)
+        output_features.append(out_feature)
+    output_layer.dataProvider().addFeatures(output_features)
+    return output_layer
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+# *************************************************************************** #
+# Zonal statistics of several rasters and statistics per stand in one pass.
+#
+# (C) Hannes Horneber, Christoph Schaller (BFH-HAFL)
+# *************************************************************************** #
+"""
+/***************************************************************************
+    TBk: Toolkit Bestandeskarte (QGIS Plugin)
+    Toolkit for the generating and processing forest stand maps
+    Copyright (C) 2025 BFH-HAFL (hannes.horneber@bfh.ch, christian.rosset@bfh.ch)
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+ ***************************************************************************/
+"""
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import re
+
+import numpy as np
+from osgeo import gdal
+from qgis.core import NULL, edit
+
+from tbk_qgis.tbk.utility.tbk_utilities import rasterize_feature_ids, get_stand_id_raster
+
+
+def _is_percentile(statistic):
+    match = re.fullmatch(r"p(\d+(\.\d*)?)", statistic)
+    return match is not None and float(match.group(1)) <= 100
+
+
+class ZonalAccumulator:
+    """
+    Grouped reductions of the values of one raster per zone (label), fed block by block.
+
+    Supported statistics:
+    count, sum, mean, min, max,
+    p<N> (e.g. p80, N from 0 to 100): percentile without interpolation, same as r.univar (v.rast.stats),
+    class_<V> (e.g. class_1): fraction of the cells with value V.
+
+    Results are arrays indexed by label, NaN for labels without values (count: 0).
+    """
+
+    def __init__(self, statistics, n_labels=0):
+        for statistic in statistics:
+            if not (statistic in ("count", "sum", "mean", "min", "max") or _is_percentile(statistic)
+                    or statistic.startswith("class_")):
+                raise ValueError(f"Unknown zonal statistic: {statistic}")
+        self.statistics = list(statistics)
+        self.n_labels = n_labels
+        self.counts = np.zeros(n_labels, dtype=np.int64)
+        self.sums = np.zeros(n_labels)
+        self.mins = np.full(n_labels, np.nan)
+        self.maxs = np.full(n_labels, np.nan)
+        self.class_values = [float(s[len("class_"):]) for s in self.statistics if s.startswith("class_")]
+        self.class_counts = {value: np.zeros(n_labels, dtype=np.int64) for value in self.class_values}
+        # percentiles need all values, they are kept until the result is requested
+        self.percentiles = [float(s[1:]) for s in self.statistics if _is_percentile(s)]
+        self.value_chunks = []
+
+    def _grow(self, n_labels):
+        if n_labels <= self.n_labels:
+            return
+        n_new = n_labels - self.n_labels
+        self.counts = np.concatenate([self.counts, np.zeros(n_new, dtype=np.int64)])
+        self.sums = np.concatenate([self.sums, np.zeros(n_new)])
+        self.mins = np.concatenate([self.mins, np.full(n_new, np.nan)])
+        self.maxs = np.concatenate([self.maxs, np.full(n_new, np.nan)])
+        for value in self.class_values:
+            self.class_counts[value] = np.concatenate([self.class_counts[value], np.zeros(n_new, dtype=np.int64)])
+        self.n_labels = n_labels
+
+    def add(self, labels, values):
+        """
+        Add the values of valid cells.
+
+        :param labels: 1d array with the label of each cell
+        :param values: 1d array with the value of each cell
+        """
+        if labels.size == 0:
+            return
+        labels = labels.astype(np.int64, copy=False)
+        self._grow(int(labels.max()) + 1)
+        self.counts += np.bincount(labels, minlength=self.n_labels)
+        if "sum" in self.statistics or "mean" in self.statistics:
+            self.sums += np.bincount(labels, weights=values, minlength=self.n_labels)
+        if "min" in self.statistics or "max" in self.statistics:
+            # reduce the values of each label of the block at once
+            order = np.argsort(labels, kind="stable")
+            labels_sorted = labels[order]
+            values_sorted = values[order].astype(np.float64)
+            block_labels, starts = np.unique(labels_sorted, return_index=True)
+            self.mins[block_labels] = np.fmin(self.mins[block_labels], np.minimum.reduceat(values_sorted, starts))
+            self.maxs[block_labels] = np.fmax(self.maxs[block_labels], np.maximum.reduceat(values_sorted, starts))
+        for value in self.class_values:
+            m_class = values == value
+            self.class_counts[value] += np.bincount(labels[m_class], minlength=self.n_labels)
+        if self.percentiles:
+            self.value_chunks.append((labels, values))
+
+    def result(self, n_labels=0):
+        """
+        :param n_labels: Minimum length of the result arrays
+        :return: Dict with an array indexed by label per statistic
+        """
+        self._grow(n_labels)
+        m_labels = self.counts > 0
+        counts = np.maximum(self.counts, 1)
+        result = {}
+        for statistic in self.statistics:
+            if statistic == "count":
+                result[statistic] = self.counts.copy()
+            elif statistic == "sum":
+                result[statistic] = np.where(m_labels, self.sums, np.nan)
+            elif statistic == "mean":
+                result[statistic] = np.where(m_labels, self.sums / counts, np.nan)
+            elif statistic == "min":
+                result[statistic] = self.mins.copy()
+            elif statistic == "max":
+                result[statistic] = self.maxs.copy()
+            elif statistic.startswith("class_"):
+                class_counts = self.class_counts[float(statistic[len("class_"):])]
+                result[statistic] = np.where(m_labels, class_counts / counts, np.nan)
+        if self.percentiles:
+            result.update(self._get_percentiles())
+        return result
+
+    def _get_percentiles(self):
+        labels = np.concatenate([chunk[0] for chunk in self.value_chunks])
+        values = np.concatenate([chunk[1] for chunk in self.value_chunks])
+        # sort by label, then by value
+        values_sorted = values[np.lexsort((values, labels))]
+        ends = np.cumsum(self.counts)
+        starts = ends - self.counts
+        m_labels = self.counts > 0
+        result = {}
+        for statistic in self.statistics:
+            if not _is_percentile(statistic):
+                continue
+            label_percentile = np.full(self.n_labels, np.nan)
+            i_percentile = (self.counts[m_labels] * 1e-2 * float(statistic[1:]) - 0.5).astype(np.int64)
+            label_percentile[m_labels] = values_sorted[starts[m_labels] + np.maximum(i_percentile, 0)]
+            result[statistic] = label_percentile
+        return result
+
+
+def _open_raster(raster):
+    return gdal.Open(raster, gdal.GA_ReadOnly) if isinstance(raster, str) else raster
+
+
+def _get_grid(ds):
+    return ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize
+
+
+def _is_raster(zones):
+    if not isinstance(zones, str):
+        return getattr(zones, "RasterCount", 0) > 0
+    try:
+        return gdal.OpenEx(zones, gdal.OF_RASTER) is not None
+    except RuntimeError:
+        return False
+
+
+def _get_non_overlapping_subsets(zones):
+    """
+    Partition the features of a polygon layer into subsets without overlapping features (interiors intersect), the
+    first subset gets as many features as possible (greedy).
+
+    :param zones: Polygon layer (path or gdal vector dataset)
+    :return: List with the feature IDs per subset
+    """
+    vector_ds = gdal.OpenEx(zones, gdal.OF_VECTOR) if isinstance(zones, str) else zones
+    layer = vector_ds.GetLayer()
+    geometries = {}
+    for f in layer:
+        if f.GetGeometryRef() is not None:
+            geometries[f.GetFID()] = f.GetGeometryRef().Clone()
+    subset_of = {}
+    subsets = []
+    for fid in sorted(geometries):
+        geom = geometries[fid]
+        layer.SetSpatialFilter(geom)
+        used = set()
+        for other in layer:
+            other_fid = other.GetFID()
+            if other_fid in subset_of and geom.Intersects(geometries[other_fid]) and \
+                    not geom.Touches(geometries[other_fid]):
+                used.add(subset_of[other_fid])
+        subset = 0
+        while subset in used:
+            subset += 1
+        if subset == len(subsets):
+            subsets.append([])
+        subsets[subset].append(fid)
+        subset_of[fid] = subset
+    layer.SetSpatialFilter(None)
+    layer = None
+    vector_ds = None
+    return subsets
+
+
+def _get_points_on_surface(zones):
+    """
+    :param zones: Polygon layer (path or gdal vector dataset)
+    :return: Dict with a point (x, y) on the surface of each feature by feature ID
+    """
+    vector_ds = gdal.OpenEx(zones, gdal.OF_VECTOR) if isinstance(zones, str) else zones
+    layer = vector_ds.GetLayer()
+    layer.ResetReading()
+    points = {}
+    for f in layer:
+        geom = f.GetGeometryRef()
+        if geom is not None and not geom.IsEmpty():
+            point = geom.PointOnSurface()
+            if point is not None and not point.IsEmpty():
+                points[f.GetFID()] = (point.GetX(), point.GetY())
+    layer.ResetReading()
+    layer = None
+    vector_ds = None
+    return points
+
+
+def zonal_statistics(zones, rasters, statistics, n_labels=0, tmp_output_folder=None, block_cells=2 ** 22,
+                     overlapping=False):
+    """
+    Calculate several statistics of several rasters per zone in one block-streamed pass.
+
+    Cells are assigned to a zone by the label raster, or for polygon zones if their center is within the polygon
+    (see rasterize_feature_ids). NoData and NaN cells of a raster are ignored. A label raster holds one zone per
+    cell, so polygon zones which may overlap (e.g. buffered or nested polygons) need overlapping=True: the features
+    are rasterized in subsets without overlaps and every cell is counted for each polygon containing it (same as
+    native:zonalstatisticsfb). Polygons without any cell center (smaller than a cell, e.g. slivers) get the value of
+    the cell containing a point on their surface (count 1, like the precise fallback of qgis:zonalstatistics).
+
+    :param zones: Label raster (path or gdal.Dataset, 0: no zone) on the grid of all rasters, or polygon layer
+                  (path or gdal vector dataset, labels are the feature IDs) which is rasterized per raster grid
+    :param rasters: Dict with the rasters (path or gdal.Dataset) by name
+    :param statistics: List of statistics for all rasters or dict with a list per raster name (see ZonalAccumulator)
+    :param n_labels: Minimum length of the result arrays (e.g. max fid + 1)
+    :param tmp_output_folder: If set, the label rasters of polygon zones are cached there (see get_stand_id_raster)
+    :param block_cells: Approximate number of cells processed at once (bounds the memory use)
+    :param overlapping: Polygon zones may overlap (label rasters are not cached)
+    :return: Dict with the columns "<raster name>_<statistic>", arrays indexed by label
+    """
+    if not isinstance(statistics, dict):
+        statistics = {name: statistics for name in rasters.keys()}
+
+    # group the rasters by grid, every grid is streamed once
+    datasets = {name: _open_raster(raster) for name, raster in rasters.items()}
+    grids = {}
+    for name, ds in datasets.items():
+        grids.setdefault(_get_grid(ds), []).append(name)
+
+    zones_are_raster = _is_raster(zones)
+    # subsets of overlapping polygon zones, each is rasterized on its own (feature IDs are unique across subsets)
+    subsets = [None]
+    if overlapping and not zones_are_raster:
+        subsets = _get_non_overlapping_subsets(zones) or [None]
+    points = None if zones_are_raster else _get_points_on_surface(zones)
+    table = {}
+    for grid, names in grids.items():
+        bands = {name: datasets[name].GetRasterBand(1) for name in names}
+        nodata = {name: band.GetNoDataValue() for name, band in bands.items()}
+        accumulators = {name: ZonalAccumulator(statistics[name], n_labels) for name in names}
+        label_counts = np.zeros(0, dtype=np.int64)
+
+        for subset in subsets:
+            if zones_are_raster:
+                label_ds = _open_raster(zones)
+                if _get_grid(label_ds) != grid:
+                    raise ValueError(f"Raster {names[0]} is not on the grid of the zones")
+            elif tmp_output_folder is not None and isinstance(zones, str) and not overlapping:
+                label_ds = gdal.Open(get_stand_id_raster(zones, rasters[names[0]], tmp_output_folder),
+                                     gdal.GA_ReadOnly)
+            else:
+                reference_raster = rasters[names[0]]
+                if not isinstance(reference_raster, str):
+                    reference_raster = reference_raster.GetDescription()
+                label_ds = rasterize_feature_ids(zones, reference_raster, feature_ids=subset)
+            label_band = label_ds.GetRasterBand(1)
+
+            n_cols, n_rows = grid[1], grid[2]
+            block_rows = max(1, block_cells // n_cols)
+            for row in range(0, n_rows, block_rows):
+                rows = min(block_rows, n_rows - row)
+                labels = label_band.ReadAsArray(0, row, n_cols, rows)
+                m_labels = labels > 0
+                if not m_labels.any():
+                    continue
+                if points is not None:
+                    block_counts = np.bincount(labels[m_labels].astype(np.int64))
+                    label_counts = np.concatenate([label_counts, np.zeros(max(0, len(block_counts) - len(label_counts)),
+                                                                          dtype=np.int64)])
+                    label_counts[:len(block_counts)] += block_counts
+                for name, band in bands.items():
+                    values = band.ReadAsArray(0, row, n_cols, rows)
+                    m_valid = m_labels.copy()
+                    if np.issubdtype(values.dtype, np.floating):
+                        m_valid &= ~np.isnan(values)
+                    if nodata[name] is not None and not np.isnan(nodata[name]):
+                        m_valid &= values != nodata[name]
+                    accumulators[name].add(labels[m_valid], values[m_valid])
+
+            label_band = None
+            label_ds = None
+
+        # polygons without cell center: value of the cell containing a point on the surface
+        if points is not None:
+            geotransform, n_cols, n_rows = grid
+            for fid, (x, y) in points.items():
+                if fid < len(label_counts) and label_counts[fid] > 0:
+                    continue
+                col = int(np.floor((x - geotransform[0]) / geotransform[1]))
+                row = int(np.floor((y - geotransform[3]) / geotransform[5]))
+                if not (0 <= col < n_cols and 0 <= row < n_rows):
+                    continue
+                for name, band in bands.items():
+                    value = band.ReadAsArray(col, row, 1, 1)[0]
+                    if (np.issubdtype(value.dtype, np.floating) and np.isnan(value[0])) or \
+                            (nodata[name] is not None and not np.isnan(nodata[name]) and value[0] == nodata[name]):
+                        continue
+                    accumulators[name].add(np.array([fid]), value)
+        for name, accumulator in accumulators.items():
+            for statistic, values in accumulator.result(n_labels).items():
+                table[f"{name}_{statistic}"] = values
+    datasets = None
+
+    # same length for all columns
+    n_rows_table = max([len(values) for values in table.values()] + [n_labels])
+    for column, values in table.items():
+        if len(values) < n_rows_table:
+            fill = 0 if column.endswith("_count") else np.nan
+            table[column] = np.concatenate([values, np.full(n_rows_table - len(values), fill, dtype=values.dtype)])
+    return table
+
+
+def write_zonal_statistics(layer, table, fields):
+    """
+    Write columns of a zonal statistics table to the features of a layer (labels = feature IDs) in one edit session.
+    Missing fields are added, NaN values and features without label are written as NULL.
+
+    :param layer: QgsVectorLayer
+    :param table: Dict with arrays indexed by feature ID (see zonal_statistics)
+    :param fields: Dict with the QgsField per column of the table
+    """
+    with edit(layer):
+        provider = layer.dataProvider()
+        provider.addAttributes([field for field in fields.values() if layer.fields().indexOf(field.name()) < 0])
+        layer.updateFields()
+
+        for f in layer.getFeatures():
+            fid = f.id()
+            for column, field in fields.items():
+                values = table[column]
+                value = values[fid] if 0 <= fid < len(values) else np.nan
+                f[field.name()] = NULL if np.isnan(value) else value.item()
+            layer.updateFeature(f)
@@ -98,5 +98,7 @@ processing.run("TBk:TBk postprocess local density", {
     'buffer_smoothing': True,
     'buffer_smoothing_dist': 7,
     'save_unclipped': False,
-    'grid_cell_size': 3
+    'grid_cell_size': 3,
+    'raster_first': False,
+    'save_density_polygons': True
 })
\ No newline at end of file